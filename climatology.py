@@ -0,0 +1,230 @@
+#-------------------------------------------------------------------------------
+# Name:         climatology.py
+#
+# Summary:      The climatology module keeps a day-of-year LST climatology (mean, standard
+#               deviation and percentiles) for every grid cell and every RCA of a project.
+#               The climatology is updated as each year's LST table is compiled, so anomaly
+#               maps and year-to-year comparisons only need the new year's values and the
+#               stored climatology, rather than re-reading every LST table.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import re
+import csv
+import warnings
+import numpy as np
+import prep
+import lib.spatial_index as spatial_index
+
+# Global constants
+CLIM_DAYS = 366
+PERCENTILE_BLOCK_ROWS = 4096 # locations read per block when computing percentiles
+
+
+class Climatology(object):
+    """Day-of-year climatology of a set of locations (grid cells or RCAs). The values of each year are
+    kept as a (locations x 366) layer, and running sums give the mean and standard deviation, so a
+    year can be added, or replaced when its table is re-compiled, without reading the other years.
+    Percentiles cannot be kept as running sums, so they are not updated with each year; they are computed
+    on demand from the year layers, for the requested locations only (see percentile).
+    Locations seen for the first time are appended, and are missing in the earlier years."""
+
+    def __init__(self, clim_dir, name='cell'):
+        self.clim_dir = clim_dir
+        self.name = name
+        self.ids = []
+        self.row_index = {}
+        self.years = []
+        self.count = np.zeros((0, CLIM_DAYS), dtype=np.int32)
+        self.total = np.zeros((0, CLIM_DAYS), dtype=np.float64)
+        self.total_sq = np.zeros((0, CLIM_DAYS), dtype=np.float64)
+        stats_file = self.stats_file()
+        if os.path.exists(stats_file):
+            stats = np.load(stats_file)
+            self.ids = [str(i) for i in stats['ids']]
+            self.row_index = dict((i, row) for row, i in enumerate(self.ids))
+            self.years = [int(y) for y in stats['years']]
+            self.count = stats['count']
+            self.total = stats['total']
+            self.total_sq = stats['total_sq']
+
+    def stats_file(self):
+        return os.path.join(self.clim_dir, '%s_stats.npz' % self.name)
+
+    def layer_file(self, year):
+        return os.path.join(self.clim_dir, '%s_%s.npy' % (self.name, year))
+
+    def _read_layer(self, year):
+        """Reads a year's layer, padded with NaN for locations added after it was written."""
+        layer = np.load(self.layer_file(year))
+        if len(layer) < len(self.ids):
+            padding = np.empty((len(self.ids) - len(layer), CLIM_DAYS), dtype=np.float32)
+            padding.fill(np.nan)
+            layer = np.vstack([layer, padding])
+        return layer
+
+    def _add_ids(self, id_list):
+        new_ids = [i for i in id_list if i not in self.row_index]
+        for i in new_ids:
+            self.row_index[i] = len(self.ids)
+            self.ids.append(i)
+        if new_ids:
+            extra = len(new_ids)
+            self.count = np.vstack([self.count, np.zeros((extra, CLIM_DAYS), dtype=np.int32)])
+            self.total = np.vstack([self.total, np.zeros((extra, CLIM_DAYS), dtype=np.float64)])
+            self.total_sq = np.vstack([self.total_sq, np.zeros((extra, CLIM_DAYS), dtype=np.float64)])
+        return
+
+    def _accumulate(self, layer, sign):
+        valid = ~np.isnan(layer)
+        values = np.where(valid, layer, 0.0).astype(np.float64)
+        self.count += sign * valid.astype(np.int32)
+        self.total += sign * values
+        self.total_sq += sign * values * values
+        return
+
+    def update(self, id_list, year, doy_list, lst_cube):
+        """Adds a year of LST values (locations x DOYs) to the climatology, replacing the year if it was
+        added before, and saves the climatology."""
+        year = int(year)
+        id_list = [str(i) for i in id_list]
+        self._add_ids(id_list)
+        if year in self.years:
+            self._accumulate(self._read_layer(year), -1)
+            self.years.remove(year)
+        layer = np.empty((len(self.ids), CLIM_DAYS), dtype=np.float32)
+        layer.fill(np.nan)
+        rows = np.array([self.row_index[i] for i in id_list], dtype=np.int64)
+        cols = np.asarray(doy_list, dtype=np.int64) - 1
+        layer[rows[:, np.newaxis], cols[np.newaxis, :]] = lst_cube
+        self._accumulate(layer, 1)
+        self.years = sorted(self.years + [year])
+        if not os.path.exists(self.clim_dir):
+            os.makedirs(self.clim_dir)
+        np.save(self.layer_file(year), layer)
+        self.save()
+        return
+
+    def save(self):
+        with open(self.stats_file(), 'wb') as out_file:
+            np.savez(out_file, ids=np.array(self.ids), years=np.array(self.years, dtype=np.int32),
+                     count=self.count, total=self.total, total_sq=self.total_sq)
+        return
+
+    def mean(self):
+        """Returns the mean LST of each location and day of year, NaN where there are no values."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / self.count, np.nan)
+
+    def std(self):
+        """Returns the standard deviation of LST of each location and day of year across years."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.total / self.count
+            variance = np.maximum(self.total_sq / self.count - mean * mean, 0.0)
+            return np.where(self.count > 0, np.sqrt(variance), np.nan)
+
+    def percentile(self, q, id_list=None, block_rows=PERCENTILE_BLOCK_ROWS):
+        """Returns the q-th percentile of each location (or of the locations in id_list) and day of year,
+        NaN where there are no values. The year layers are memory-mapped and only the rows of the requested
+        locations are read, block_rows locations at a time, so memory is bounded by years x block_rows x 366
+        values. The tradeoff is that each call reads every year's layer, where the mean and standard
+        deviation come from the running sums; a percentile map of every location should be computed
+        once and kept by the caller."""
+        if id_list is None:
+            rows = np.arange(len(self.ids), dtype=np.int64)
+        else:
+            rows = np.array([self.row_index.get(str(i), -1) for i in id_list], dtype=np.int64)
+        layers = [np.load(self.layer_file(y), mmap_mode='r') for y in self.years]
+        result = np.empty((len(rows), CLIM_DAYS), dtype=np.float32)
+        result.fill(np.nan)
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            stack = np.empty((len(layers), len(block), CLIM_DAYS), dtype=np.float32)
+            stack.fill(np.nan)
+            for i, layer in enumerate(layers):
+                have = (block >= 0) & (block < len(layer)) # rows added after the layer was written are missing
+                stack[i, have] = layer[block[have]]
+            if len(layers):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning) # locations and days without any values
+                    result[start:start + block_rows] = np.nanpercentile(stack, q, axis=0)
+        return result
+
+    def anomaly(self, id_list, doy_list, lst_cube):
+        """Returns lst_cube (locations x DOYs) minus the climatological mean of the same locations and days.
+        Locations without a climatology get NaN."""
+        mean = self.mean()
+        rows = np.array([self.row_index.get(str(i), -1) for i in id_list], dtype=np.int64)
+        cols = np.asarray(doy_list, dtype=np.int64) - 1
+        clim = mean[np.maximum(rows, 0)[:, np.newaxis], cols[np.newaxis, :]]
+        clim[rows < 0] = np.nan
+        return lst_cube - clim
+
+
+def table_year(in_csv):
+    """Returns the year of an LST table from its file name, i.e. LST_2016.csv -> 2016."""
+    return int(re.search(r'(\d{4})', os.path.basename(in_csv)).group(1))
+
+
+def rca_lst(id_rows, lst_cube, in_rca, id_field=None):
+    """Averages the LST values of the grid cells within each RCA. Returns (rca_ids, rca_cube)."""
+    layer_index = spatial_index.open_layer_index(in_rca, id_field)
+    cell_rca = []
+    for row in id_rows:
+        rca = layer_index.point_query(float(row[1]), float(row[2]))
+        cell_rca.append(str(rca[0]) if rca else None)
+    rca_ids = sorted(set(r for r in cell_rca if r is not None))
+    rca_row = dict((r, i) for i, r in enumerate(rca_ids))
+    in_rca_mask = np.array([r is not None for r in cell_rca], dtype=bool)
+    groups = np.array([rca_row[r] for r in cell_rca if r is not None], dtype=np.int64)
+    cube = lst_cube[in_rca_mask]
+    valid = ~np.isnan(cube)
+    value_sum = np.zeros((len(rca_ids), lst_cube.shape[1]), dtype=np.float64)
+    value_count = np.zeros(value_sum.shape, dtype=np.int32)
+    np.add.at(value_sum, groups, np.where(valid, cube, 0.0))
+    np.add.at(value_count, groups, valid.astype(np.int32))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rca_cube = np.where(value_count > 0, value_sum / value_count, np.nan).astype(np.float32)
+    return rca_ids, rca_cube
+
+
+def update_climatology(in_csv, clim_dir, in_rca=None, id_field=None, year=None, compact=False):
+    """Adds a compiled LST table to the per-cell climatology, and to the per-RCA climatology if an RCA
+    shapefile is given. Returns the list of climatology files written."""
+    print "Updating the LST climatology..."
+    if year is None:
+        year = table_year(in_csv)
+    id_rows, doy_list, lst_cube = prep.read_LST_table(in_csv, compact)
+    cell_clim = Climatology(clim_dir, 'cell')
+    cell_clim.update([row[0] for row in id_rows], year, doy_list, lst_cube)
+    out_list = [cell_clim.stats_file(), cell_clim.layer_file(year)]
+    if in_rca is not None:
+        rca_ids, rca_cube = rca_lst(id_rows, lst_cube, in_rca, id_field)
+        rca_clim = Climatology(clim_dir, 'rca')
+        rca_clim.update(rca_ids, year, doy_list, rca_cube)
+        out_list += [rca_clim.stats_file(), rca_clim.layer_file(year)]
+    return out_list
+
+
+def anomaly_LST_table(in_csv, clim_dir, out_csv, compact=False):
+    """Writes an LST anomaly table: the values of an LST table minus the per-cell climatological mean,
+    with the same layout as the LST table."""
+    print "Building LST anomaly table..."
+    id_rows, doy_list, lst_cube = prep.read_LST_table(in_csv, compact)
+    anomaly = Climatology(clim_dir, 'cell').anomaly([row[0] for row in id_rows], doy_list, lst_cube)
+    with open(out_csv, 'wb') as out_file:
+        writer = csv.writer(out_file, delimiter=',')
+        writer.writerow(["UID", "X", "Y"] + [str(d) for d in doy_list])
+        for id_row, values in zip(id_rows, anomaly):
+            writer.writerow(id_row + ['' if np.isnan(v) else '%.2f' % v for v in values])
+    return out_csv
@@ -0,0 +1,268 @@
+#-------------------------------------------------------------------------------
+# Name:         cluster.py
+#
+# Summary:      The cluster module runs LST pre-processing across several machines. The work
+#               is split into shards by MODIS tile, year and date range, and the shards are
+#               handed out through a directory on a shared filesystem: each worker claims a
+#               shard by atomically renaming its task file, processes it, and writes a partial
+#               LST cube. The partial cubes are then merged into one cube, in an order that does
+#               not depend on which worker ran which shard.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import json
+import time
+import glob
+import socket
+import traceback
+import multiprocessing
+import numpy as np
+import lib.modis_grid as modis_grid
+
+# Global constants
+DAYS_PER_SHARD = 32
+CLUSTER_SUBDIRS = ['tasks', 'claimed', 'done', 'failed', 'results']
+
+
+def make_shards(tile_list, year_list, doy_start=1, doy_end=366, days_per_shard=DAYS_PER_SHARD):
+    """Splits a run into shards of one tile, one year and at most days_per_shard days."""
+    shard_list = []
+    for tile in sorted(tile_list):
+        for year in sorted(str(y) for y in year_list):
+            for start in range(doy_start, doy_end + 1, days_per_shard):
+                end = min(start + days_per_shard - 1, doy_end)
+                shard_list.append({'shard_id': '%s_%s_%03d_%03d' % (tile, year, start, end),
+                                   'tile': tile, 'year': year, 'doy_start': start, 'doy_end': end})
+    return shard_list
+
+
+def make_cluster_dirs(cluster_dir):
+    """Creates the coordination directories under the shared cluster directory."""
+    for d in CLUSTER_SUBDIRS:
+        if not os.path.exists(os.path.join(cluster_dir, d)):
+            os.makedirs(os.path.join(cluster_dir, d))
+    return
+
+
+def submit_shards(cluster_dir, shard_list):
+    """Writes one task file per shard to the shared cluster directory."""
+    make_cluster_dirs(cluster_dir)
+    for shard in shard_list:
+        task_file = os.path.join(cluster_dir, 'tasks', shard['shard_id'] + '.json')
+        with open(task_file + '.tmp', 'w') as out_file:
+            json.dump(shard, out_file)
+        os.rename(task_file + '.tmp', task_file)
+    return
+
+
+def claim_task(cluster_dir, worker_id):
+    """Claims the next unclaimed shard, or returns None when there are none left. The task file is
+    renamed into the claimed directory; rename is atomic on a shared filesystem, so a shard can only be
+    claimed by one worker. The claimed file's modified time is set to the claim time, as rename keeps the
+    submit time, which requeue_stale_tasks would otherwise read as the start of the shard."""
+    for task_file in sorted(glob.glob(os.path.join(cluster_dir, 'tasks', '*.json'))):
+        claimed_file = os.path.join(cluster_dir, 'claimed', '%s@%s' % (os.path.basename(task_file), worker_id))
+        try:
+            os.rename(task_file, claimed_file)
+            os.utime(claimed_file, None)
+        except OSError:
+            continue # claimed by another worker first
+        with open(claimed_file, 'r') as in_file:
+            return json.load(in_file), claimed_file
+    return None
+
+
+def requeue_stale_tasks(cluster_dir, max_age=3600):
+    """Returns shards claimed more than max_age seconds ago to the task list, i.e. after a node failed.
+    max_age must be longer than a shard takes to run, or running shards are handed out again."""
+    for claimed_file in glob.glob(os.path.join(cluster_dir, 'claimed', '*.json@*')):
+        if time.time() - os.path.getmtime(claimed_file) > max_age:
+            task_name = os.path.basename(claimed_file).split('@', 1)[0]
+            try:
+                os.rename(claimed_file, os.path.join(cluster_dir, 'tasks', task_name))
+            except OSError:
+                pass
+    return
+
+
+def save_partial_cube(cluster_dir, shard_id, cell_ids, date_list, lst_cube):
+    """Writes a shard's partial LST cube (cells x dates) to the results directory. Compact cubes (UInt16
+    digital numbers, see prep.LST_NODATA) are kept as UInt16, and other cubes are written as Float32."""
+    out_file = os.path.join(cluster_dir, 'results', shard_id + '.npz')
+    tmp_file = out_file + '.tmp'
+    lst_cube = np.asarray(lst_cube)
+    if lst_cube.dtype != np.uint16:
+        lst_cube = lst_cube.astype(np.float32)
+    with open(tmp_file, 'wb') as tmp:
+        np.savez(tmp, cell_ids=np.asarray(cell_ids, dtype=np.int64), date_list=np.asarray(date_list, dtype=np.int32),
+                 lst_cube=lst_cube)
+    os.rename(tmp_file, out_file)
+    return out_file
+
+
+def _finish_task(claimed_file, out_file, shard):
+    """Moves a claimed task file to the done or failed directory. If the claim was requeued while the
+    shard ran, the claimed file is gone, so the task is written there instead."""
+    try:
+        os.rename(claimed_file, out_file)
+    except OSError:
+        with open(out_file, 'w') as out:
+            json.dump(shard, out)
+    return
+
+
+def run_worker(cluster_dir, runner=None, worker_id=None, **options):
+    """Processes shards until none are left. The runner is called as runner(shard, **options) and returns
+    (cell_ids, date_list, lst_cube) for the shard. Failed shards are moved to the failed directory with
+    the error."""
+    if runner is None:
+        runner = run_shard
+    if worker_id is None:
+        worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+    while True:
+        claim = claim_task(cluster_dir, worker_id)
+        if claim is None:
+            return
+        shard, claimed_file = claim
+        try:
+            cell_ids, date_list, lst_cube = runner(shard, **options)
+            save_partial_cube(cluster_dir, shard['shard_id'], cell_ids, date_list, lst_cube)
+        except Exception:
+            with open(os.path.join(cluster_dir, 'failed', shard['shard_id'] + '.txt'), 'w') as out_file:
+                out_file.write(traceback.format_exc())
+            _finish_task(claimed_file, os.path.join(cluster_dir, 'failed', shard['shard_id'] + '.json'), shard)
+        else:
+            _finish_task(claimed_file, os.path.join(cluster_dir, 'done', shard['shard_id'] + '.json'), shard)
+
+
+def failed_shards(cluster_dir):
+    """Returns the sorted IDs of the shards that failed and have not since been completed by a retry."""
+    failed_list = []
+    for failed_file in glob.glob(os.path.join(cluster_dir, 'failed', '*.json')):
+        shard_id = os.path.basename(failed_file)[:-len('.json')]
+        if not os.path.exists(os.path.join(cluster_dir, 'done', shard_id + '.json')):
+            failed_list.append(shard_id)
+    return sorted(failed_list)
+
+
+def merge_results(cluster_dir, allow_failed=False):
+    """Merges the partial LST cubes into one cube with sorted cell IDs and dates. Where shards overlap,
+    the mean of their valid values is used, so the result does not depend on the order shards finished.
+    Raises a RuntimeError naming the failed shards (see failed/<shard_id>.txt for the errors) if any
+    shards failed, unless allow_failed is True. If the partial cubes are compact (UInt16), the merged cube
+    is compact too, with means rounded to the nearest digital number. Returns (cell_ids, date_list, lst_cube)."""
+    import prep
+    failed_list = failed_shards(cluster_dir)
+    if failed_list and not allow_failed:
+        raise RuntimeError("%d shard(s) failed: %s" % (len(failed_list), ', '.join(failed_list)))
+    partial_list = []
+    for result_file in sorted(glob.glob(os.path.join(cluster_dir, 'results', '*.npz'))):
+        partial = np.load(result_file)
+        partial_list.append((partial['cell_ids'], partial['date_list'], partial['lst_cube']))
+    if not partial_list:
+        return np.array([], dtype=np.int64), [], np.zeros((0, 0), dtype=np.float32)
+    compact_list = [p[2].dtype == np.uint16 for p in partial_list]
+    if any(compact_list) and not all(compact_list):
+        raise ValueError("Cannot merge compact (UInt16) and degrees C partial cubes.")
+    cell_ids = np.unique(np.concatenate([p[0] for p in partial_list]))
+    date_list = np.unique(np.concatenate([p[1] for p in partial_list]))
+    value_sum = np.zeros((len(cell_ids), len(date_list)), dtype=np.float64)
+    value_count = np.zeros(value_sum.shape, dtype=np.int32)
+    for partial_cells, partial_dates, partial_cube in partial_list:
+        rows = np.searchsorted(cell_ids, partial_cells)[:, np.newaxis]
+        cols = np.searchsorted(date_list, partial_dates)[np.newaxis, :]
+        valid = ~prep.lst_missing(partial_cube)
+        value_sum[rows, cols] += np.where(valid, partial_cube, 0.0)
+        value_count[rows, cols] += valid
+    has_value = value_count > 0
+    if all(compact_list):
+        lst_cube = np.empty(value_sum.shape, dtype=np.uint16)
+        lst_cube.fill(prep.LST_NODATA)
+        lst_cube[has_value] = np.round(value_sum[has_value] / value_count[has_value])
+    else:
+        lst_cube = np.empty(value_sum.shape, dtype=np.float32)
+        lst_cube.fill(np.nan)
+        lst_cube[has_value] = value_sum[has_value] / value_count[has_value]
+    return cell_ids, [int(d) for d in date_list], lst_cube
+
+
+def run_shard(shard, project_dir, basin=None, product='Daily', platform=None, lst_sds='LST_Day_1km', compact=False):
+    """Default shard runner. Converts the downloaded HDF files of one tile, year and date range, and
+    returns the LST values as a cube of cells x dates, with dates as YYYYDDD integers. Cells are identified by their row-major index in
+    the global MODIS 1km grid, so cubes from different tiles can be merged. If basin (an RCA shapefile)
+    is given, only cells within its MODIS sinusoidal bounding box are kept. With compact=True, the cube
+    holds UInt16 digital numbers (see prep.LST_NODATA) rather than degrees C. Terra and Aqua granules are
+    both read, and platform and lst_sds select the LST band (see prep.lst_band)."""
+    import get
+    import prep
+    from osgeo import gdal
+    h, v = modis_grid.parse_tile(shard['tile'])
+    dir_list = get.build_granule_dir_list(project_dir, product, [shard['year']])
+    hdf_filename_list, hdf_filepath_list = get.get_hdf_filepaths(dir_list)
+    keep = [f.split(".")[2] == shard['tile'] and
+            shard['doy_start'] <= int(f.split(".")[1][-3:]) <= shard['doy_end'] for f in hdf_filename_list]
+    hdf_filename_list = [f for f, k in zip(hdf_filename_list, keep) if k]
+    hdf_filepath_list = [f for f, k in zip(hdf_filepath_list, keep) if k]
+    shard_dir = os.path.join(project_dir, 'shards', shard['shard_id'])
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    geotiff_list = []
+    if hdf_filepath_list:
+        geotiff_list = prep.convert_hdf(project_dir, [shard_dir], hdf_filepath_list, hdf_filename_list,
+                                        compact=compact)[0]
+
+    # global MODIS grid index of every cell in the tile
+    tile_rows, tile_cols = np.mgrid[0:modis_grid.TILE_CELLS, 0:modis_grid.TILE_CELLS]
+    grid_rows = v * modis_grid.TILE_CELLS + tile_rows.ravel()
+    grid_cols = h * modis_grid.TILE_CELLS + tile_cols.ravel()
+    in_window = np.ones(grid_rows.shape, dtype=bool)
+    if basin is not None:
+        # the bounding box is snapped to cell edges, so cell centres are strictly inside or outside it
+        sin_bbox = prep.get_sin_bbox(basin)
+        (x, y) = modis_grid.grid_to_sin(grid_rows, grid_cols)
+        in_window = (x > sin_bbox[0]) & (x < sin_bbox[1]) & (y > sin_bbox[2]) & (y < sin_bbox[3])
+    cell_ids = modis_grid.cell_id(grid_rows[in_window], grid_cols[in_window])
+
+    date_list = []
+    columns = []
+    if geotiff_list:
+        band = prep.lst_band(set(f[:3] for f in hdf_filename_list), platform, lst_sds)
+    for geotiff in sorted(geotiff_list):
+        date_list.append(int(os.path.basename(geotiff).split(".")[1][1:])) # i.e. A2016001 -> 2016001
+        lst_array = gdal.Open(geotiff).GetRasterBand(band).ReadAsArray()
+        columns.append(lst_array.ravel()[in_window])
+    if columns:
+        lst_cube = np.column_stack(columns)
+    elif compact:
+        lst_cube = np.zeros((len(cell_ids), 0), dtype=np.uint16)
+    else:
+        lst_cube = np.zeros((len(cell_ids), 0), dtype=np.float32)
+    return cell_ids, date_list, lst_cube
+
+
+def run_local(cluster_dir, shard_list, num_workers=None, runner=None, **options):
+    """Runs shards with several local worker processes standing in for cluster nodes, and returns the
+    merged cube. Other machines can join the same run by calling run_worker on the shared directory.
+    Raises a RuntimeError if any shards failed (see merge_results)."""
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    submit_shards(cluster_dir, shard_list)
+    workers = []
+    for i in range(num_workers):
+        worker = multiprocessing.Process(target=run_worker, args=(cluster_dir, runner, 'local-%d' % i),
+                                         kwargs=options)
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return merge_results(cluster_dir)
@@ -0,0 +1,166 @@
+#-------------------------------------------------------------------------------
+# Name:         daemon.py
+#
+# Summary:      The daemon module runs a long-lived local STeAMM worker, which imports GDAL,
+#               NumPy and the STeAMM modules once and then runs requests from the steamm
+#               command line tool. GDAL drivers stay registered, and layer indexes and other
+#               module level caches stay warm between requests, so short interactive runs do
+#               not pay the start-up cost again.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import types
+import socket
+import threading
+import traceback
+import importlib
+from multiprocessing.connection import Listener, Client
+
+# Global constants
+DAEMON_ADDRESS = ('localhost', 6177)
+AUTHKEY_FILE = os.path.join(os.path.expanduser('~'), '.steamm', 'daemon.key')
+DAEMON_MODULES = ['get', 'prep', 'model', 'process', 'climatology', 'timeseries'] # modules whose functions the daemon may run
+
+
+def get_authkey():
+    """Returns the key shared by the daemon and its clients, creating it on first use. The key file is
+    only readable by the user, so other users on the machine can not send requests to the daemon."""
+    if not os.path.exists(AUTHKEY_FILE):
+        if not os.path.exists(os.path.dirname(AUTHKEY_FILE)):
+            os.makedirs(os.path.dirname(AUTHKEY_FILE))
+        fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT, 0600)
+        os.write(fd, os.urandom(32).encode('hex'))
+        os.close(fd)
+    with open(AUTHKEY_FILE, 'rb') as key_file:
+        return key_file.read().strip()
+
+
+class Callback(object):
+    """Stands in for a function passed as an argument of a daemon request (i.e. a progress reporter). The
+    daemon passes a function in its place that sends the call back to the client, which runs the
+    client's function, so progress is reported in the client's terminal."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _handle(conn):
+    """Runs requests from one client connection. A request is a (module, function, args, kwargs) tuple,
+    and the reply is ('ok', result) or ('error', traceback text). Callback arguments are replaced by
+    functions that send ('callback', index, args) messages to the client while the request runs; their
+    return value is always None."""
+    send_lock = threading.Lock() # callbacks can be called from other threads of the request
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def client_function(arg):
+        if isinstance(arg, Callback):
+            return lambda *callback_args: send(('callback', arg.index, callback_args))
+        return arg
+
+    try:
+        while True:
+            try:
+                module_name, func_name, args, kwargs = conn.recv()
+            except EOFError:
+                return
+            if module_name == 'daemon' and func_name == 'shutdown':
+                send(('ok', None))
+                os._exit(0)
+            try:
+                if module_name not in DAEMON_MODULES:
+                    raise ValueError("Module %s can not be run by the daemon." % module_name)
+                func = getattr(importlib.import_module(module_name), func_name)
+                args = [client_function(a) for a in args]
+                kwargs = dict((k, client_function(v)) for k, v in kwargs.items())
+                send(('ok', func(*args, **kwargs)))
+            except Exception:
+                send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def serve(address=DAEMON_ADDRESS):
+    """Starts the daemon: imports GDAL and the STeAMM modules, then serves client connections until
+    it is shut down."""
+    from osgeo import gdal
+    gdal.AllRegister()
+    for module_name in DAEMON_MODULES:
+        importlib.import_module(module_name)
+    listener = Listener(address, authkey=get_authkey())
+    print "STeAMM daemon listening on %s:%d..." % address
+    while True:
+        conn = listener.accept()
+        handler = threading.Thread(target=_handle, args=(conn,))
+        handler.daemon = True
+        handler.start()
+
+
+def connect(address=DAEMON_ADDRESS):
+    """Returns a connection to a running daemon, or None if no daemon is running."""
+    try:
+        return Client(address, authkey=get_authkey())
+    except socket.error:
+        return None
+
+
+def call(module_name, func_name, *args, **kwargs):
+    """Runs module_name.func_name(*args, **kwargs) in the daemon if one is running, and otherwise in this
+    process, importing the module only when it is needed. Functions passed as arguments (i.e. progress
+    reporters) are not sent to the daemon; they are run in this process when the daemon calls them."""
+    conn = connect()
+    if conn is None:
+        func = getattr(importlib.import_module(module_name), func_name)
+        return func(*args, **kwargs)
+    callback_list = []
+
+    def to_daemon(arg):
+        if isinstance(arg, (types.FunctionType, types.MethodType)):
+            callback_list.append(arg)
+            return Callback(len(callback_list) - 1)
+        return arg
+
+    try:
+        conn.send((module_name, func_name, [to_daemon(a) for a in args],
+                   dict((k, to_daemon(v)) for k, v in kwargs.items())))
+        while True:
+            reply = conn.recv()
+            if reply[0] != 'callback':
+                break
+            callback_list[reply[1]](*reply[2])
+        status, result = reply
+    finally:
+        conn.close()
+    if status == 'error':
+        raise RuntimeError("STeAMM daemon request failed:\n%s" % result)
+    return result
+
+
+def shutdown(address=DAEMON_ADDRESS):
+    """Stops a running daemon. Returns False if no daemon was running."""
+    conn = connect(address)
+    if conn is None:
+        return False
+    try:
+        conn.send(('daemon', 'shutdown', (), {}))
+        conn.recv()
+    except (EOFError, IOError):
+        pass
+    conn.close()
+    return True
+
+
+if __name__ == '__main__':
+    serve()
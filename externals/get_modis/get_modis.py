@@ -21,15 +21,18 @@
 
 import optparse
 import os
-try:
-    import urllib.request as urllib2
-except ImportError:
-    import urllib2
 import time
 import calendar
 import logging
 import sys
 import fnmatch
+import threading
+import subprocess
+import xml.etree.ElementTree as ElementTree
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 
 # From StackOverflow user:chnrxn, see https://stackoverflow.com/a/24175862/1618640 for source
 import ssl
@@ -106,20 +109,161 @@ HEADERS = { 'User-Agent' : 'get_modis Python %s' % __version__ }
 
 CHUNKS = 65536
 
+MAX_CONNECTIONS = 4 # maximum simultaneous connections to the USGS host
+
+
+def _cksum_table():
+    """CRC table for the POSIX `cksum` algorithm (polynomial 0x04C11DB7)."""
+    table = []
+    for i in range(256):
+        c = i << 24
+        for j in range(8):
+            if c & 0x80000000:
+                c = ((c << 1) ^ 0x04C11DB7) & 0xFFFFFFFF
+            else:
+                c = (c << 1) & 0xFFFFFFFF
+        table.append(c)
+    return table
+
+CKSUM_TABLE = _cksum_table()
+
+
+def make_session(username=None, password=None, proxy=None,
+                 max_connections=MAX_CONNECTIONS):
+    """Create a pooled HTTP session shared by the listing and download workers.
+
+    Connections are kept alive and re-used between requests. The pool blocks
+    when `max_connections` connections to the same host are in use, so the
+    number of concurrent requests to the USGS server never exceeds it.
 
-def return_url(url):
+    Parameters
+    ----------
+    username: str
+        The EarthData username string
+    password: str
+        The EarthData password string
+    proxy: dict
+        A proxy definition, such as {'http': 'http://127.0.0.1:8080'}
+    max_connections: int
+        The maximum number of connections per host
+
+    Returns
+    -------
+    A `requests.Session`
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections,
+                                            pool_maxsize=max_connections,
+                                            pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    session.verify = False
+    if username is not None:
+        session.auth = (username, password)
+    if proxy is not None:
+        session.proxies.update(proxy)
+    return session
+
+
+def return_url(url, session=None):
     the_day_today = time.asctime().split()[0]
     the_hour_now = int(time.asctime().split()[3].split(":")[0])
     if the_day_today == "Wed" and 14 <= the_hour_now <= 17:
         LOG.info("Sleeping for %d hours... Yawn!" % (18 - the_hour_now))
         time.sleep(60 * 60 * (18 - the_hour_now))
 
-    req = urllib2.Request("%s" % (url), None, HEADERS)
-    html = urllib2.urlopen(req).readlines()
+    if session is None:
+        session = make_session()
+    r = session.get(url)
+    try:
+        if not r.ok:
+            raise IOError("Can't get listing... [%s]" % url)
+        html = r.content.splitlines()
+    finally:
+        r.close()
     return html
 
 
-def parse_modis_dates ( url, dates, product, out_dir, ruff=False ):
+def cksum(fname):
+    """Return the POSIX `cksum` CRC of a file, as used in the MODIS XML
+    metadata. The system `cksum` program is used when available, as it is
+    much faster than the pure Python fallback."""
+    try:
+        out = subprocess.check_output(["cksum", fname])
+        return int(out.split()[0])
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    crc = 0
+    size = 0
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNKS), b''):
+            for byte in bytearray(chunk):
+                crc = ((crc << 8) & 0xFFFFFFFF) ^ \
+                      CKSUM_TABLE[(crc >> 24) ^ byte]
+            size += len(chunk)
+    while size:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CKSUM_TABLE[(crc >> 24) ^ (size & 0xFF)]
+        size >>= 8
+    return (~crc) & 0xFFFFFFFF
+
+
+def read_xml_metadata(xml_fname):
+    """Read the file size and checksum of a granule from its `.hdf.xml`
+    metadata file.
+
+    Parameters
+    ----------
+    xml_fname: str
+        The metadata file, i.e. MOD11A1.A2016001.h09v04.006.2016007192412.hdf.xml
+
+    Returns
+    -------
+    A tuple of (file size, checksum type, checksum). The checksum type and
+    checksum are None if the metadata doesn't include them.
+    """
+    hdf_name = os.path.basename(xml_fname)[:-len(".xml")]
+    tree = ElementTree.parse(xml_fname)
+    for container in tree.getroot().iter("DataFileContainer"):
+        if container.findtext("DistributedFileName") == hdf_name:
+            checksum = container.findtext("Checksum")
+            return (int(container.findtext("FileSize")),
+                    container.findtext("ChecksumType"),
+                    int(checksum) if checksum is not None else None)
+    raise IOError("No metadata for %s in %s" % (hdf_name, xml_fname))
+
+
+def verify_granule(fname, xml_fname=None):
+    """Check a downloaded granule against its `.hdf.xml` metadata.
+
+    The file size is compared first, and the checksum is only computed when
+    the sizes agree. Only the `CKSUM` checksum type is verified.
+
+    Parameters
+    ----------
+    fname: str
+        The granule file
+    xml_fname: str
+        The metadata file. Defaults to `fname` + ".xml"
+
+    Returns
+    -------
+    True if the granule is complete and matches its metadata.
+    """
+    if xml_fname is None:
+        xml_fname = fname + ".xml"
+    if not (os.path.exists(fname) and os.path.exists(xml_fname)):
+        return False
+    file_size, checksum_type, checksum = read_xml_metadata(xml_fname)
+    if os.path.getsize(fname) != file_size:
+        return False
+    if checksum_type == "CKSUM" and checksum is not None:
+        return cksum(fname) == checksum
+    return True
+
+
+def parse_modis_dates ( url, dates, product, out_dir, ruff=False,
+                        session=None ):
     """Parse returned MODIS dates.
 
     This function gets the dates listing for a given MODIS products, and
@@ -142,6 +286,8 @@ def parse_modis_dates ( url, dates, product, out_dir, ruff=False ):
         The output dir
     ruff: bool
         Whether to check for present files
+    session: requests.Session
+        The session used for the listing (see `make_session`)
     Returns
     -------
     A (sorted) list with the dates that will be downloaded.
@@ -153,7 +299,7 @@ def parse_modis_dates ( url, dates, product, out_dir, ruff=False ):
         already_here_dates = [x.split(".")[-5][1:]
                               for x in already_here]
 
-    html = return_url(url)
+    html = return_url(url, session)
 
     available_dates = []
     for line in html:
@@ -183,23 +329,114 @@ def parse_modis_dates ( url, dates, product, out_dir, ruff=False ):
     return suitable_dates
 
 
+def list_granules(session, url, date, tile, out_dir, get_xml=False,
+                  verify=False, verbose=False):
+    """Return the URLs of the files for a tile in the listing of one date.
+    When `verify` is set, the `.hdf.xml` files are left to `fetch_granule`,
+    and granules already present are only skipped if they pass
+    `verify_granule`."""
+    them_urls = []
+    for line in return_url("%s%s" % (url, date), session):
+        line = line.decode()
+        if line.find(tile) >= 0 and line.find(".hdf") >= 0:
+            fname = line.split("href=")[1].split(">")[0].strip('"')
+            if fname.endswith(".hdf.xml") and (verify or not get_xml):
+                continue
+            out_fname = os.path.join(out_dir, fname)
+            if not os.path.exists(out_fname):
+                them_urls.append("%s%s/%s" % (url, date, fname))
+            elif verify and not verify_granule(out_fname):
+                LOG.info("File %s failed verification. Downloading again" %
+                         fname)
+                them_urls.append("%s%s/%s" % (url, date, fname))
+            elif verbose:
+                LOG.info("File %s already present. Skipping" % fname)
+    return them_urls
+
+
+def download_granule(session, the_url, out_dir, verbose=False):
+    """Download a single file to `out_dir`, streaming it to disk in chunks."""
+    # The first request follows the redirect to the EarthData login and
+    # picks up the session cookies; the body itself is not read.
+    # Both responses are streamed, so they hold a pooled connection until
+    # they are closed; close them on every path, or failed downloads would
+    # use up the pool and block the other threads.
+    r1 = session.get(the_url, stream=True)
+    r1.close()
+    r = session.get(r1.url, stream=True)
+    fname = the_url.split("/")[-1]
+    part_fname = os.path.join(out_dir, fname + ".part")
+    try:
+        if not r.ok:
+            raise IOError("Can't start download... [%s]" % the_url)
+        file_size = r.headers.get('content-length', 'unknown')
+        LOG.info("Starting download on %s(%s bytes) ..." %
+                 (os.path.join(out_dir, fname), file_size))
+        # Download to a temporary name, so an interrupted download is never
+        # mistaken for a complete file
+        with open(part_fname, 'wb') as fp:
+            for chunk in r.iter_content(chunk_size=CHUNKS):
+                if chunk:
+                    fp.write(chunk)
+            fp.flush()
+            os.fsync(fp)
+    except:
+        if os.path.exists(part_fname):
+            os.remove(part_fname)
+        raise
+    finally:
+        r.close()
+    if os.path.exists(os.path.join(out_dir, fname)):
+        os.remove(os.path.join(out_dir, fname))
+    os.rename(part_fname, os.path.join(out_dir, fname))
+    if verbose:
+        LOG.info("\tDone!")
+
+
+def fetch_granule(session, the_url, out_dir, verify=False, verbose=False):
+    """Download a granule and, if `verify` is set, its `.hdf.xml` metadata.
+    The granule is checked against the metadata and removed if it doesn't
+    match, so it will be downloaded again on the next run."""
+    if not verify:
+        download_granule(session, the_url, out_dir, verbose)
+        return
+    fname = os.path.join(out_dir, the_url.split("/")[-1])
+    download_granule(session, the_url + ".xml", out_dir, verbose)
+    if verify_granule(fname):
+        if verbose:
+            LOG.info("File %s verified. Skipping" % fname)
+        return
+    download_granule(session, the_url, out_dir, verbose)
+    if not verify_granule(fname):
+        os.remove(fname)
+        raise IOError("Downloaded file failed verification... [%s]" %
+                      the_url)
+
+
 def get_modisfiles(username, password, platform, product, year, tile, proxy,
                    doy_start=1, doy_end=-1, out_dir=".",
                    base_url="http://e4ftl01.cr.usgs.gov",
-                   ruff=False, get_xml=False, verbose=False):
+                   ruff=False, get_xml=False, verbose=False,
+                   max_connections=MAX_CONNECTIONS, verify=False):
 
     """Download MODIS products for a given tile, year & period of interest
 
-    This function uses the `urllib2` module to download MODIS "granules" from
-    the USGS website. The approach is based on downloading the index files for
-    any date of interest, and parsing the HTML (rudimentary parsing!) to search
-    for the relevant filename for the tile the user is interested in. This file
-    is then downloaded in the directory specified by `out_dir`.
+    This function downloads MODIS "granules" from the USGS website. The
+    approach is based on downloading the index files for any date of interest,
+    and parsing the HTML (rudimentary parsing!) to search for the relevant
+    filename for the tile the user is interested in. This file is then
+    downloaded in the directory specified by `out_dir`.
+
+    Listing and downloading run concurrently on a pool of worker threads that
+    share one keep-alive session (see `make_session`). Files are queued for
+    download as soon as their date listing has been parsed, so downloads
+    start before all listings have been fetched. At most `max_connections`
+    requests are open to the server at any time.
 
     The function also checks to see if the selected remote file exists locally.
-    If it does, it checks that the remote and local file sizes are identical.
-    If they are, file isn't downloaded, but if they are different, the remote
-    file is downloaded.
+    If it does, the file isn't downloaded. With `verify` set, the `.hdf.xml`
+    metadata is always downloaded, and a local file is only skipped if its
+    size and checksum match the metadata (see `verify_granule`).
 
     Parameters
     ----------
@@ -235,16 +472,15 @@ def get_modisfiles(username, password, platform, product, year, tile, proxy,
     get_xml: Boolean
         Whether to get the XML metadata files or not. Someone uses them,
         apparently ;-)
+    max_connections: int
+        The maximum number of concurrent connections to the server.
+    verify: Boolean
+        Whether to verify files against their XML metadata.
     Returns
     -------
     Nothing
     """
 
-    if proxy is not None:
-        proxy = urllib2.ProxyHandler(proxy)
-        opener = urllib2.build_opener(proxy)
-        urllib2.install_opener(opener)
-
     if not os.path.exists(out_dir):
         if verbose:
             LOG.info("Creating outupt dir %s" % out_dir)
@@ -259,43 +495,59 @@ def get_modisfiles(username, password, platform, product, year, tile, proxy,
                                                      "%j/%Y")) for i in
              range(doy_start, doy_end)]
     url = "%s/%s/%s/" % (base_url, platform, product)
-    dates = parse_modis_dates(url, dates, product, out_dir, ruff=ruff)
-    them_urls = []
+
+    session = make_session(username, password, proxy, max_connections)
+    dates = parse_modis_dates(url, dates, product, out_dir, ruff=ruff,
+                              session=session)
+
+    date_queue = Queue.Queue()
+    url_queue = Queue.Queue()
     for date in dates:
-        r = requests.get("%s%s" % (url, date), verify=False)
-        for line in r.text.split("\n"):
-            if line.decode().find(tile) >= 0:
-                if line.decode().find(".hdf")  >= 0:
-                    fname = line.decode().split("href=")[1].split(">")[0].strip('"')                    
-                    if fname.endswith(".hdf.xml") and not get_xml:
-                        pass
-                    else:
-                        if not os.path.exists(os.path.join(out_dir, fname)):
-                            them_urls.append("%s/%s/%s" % (url, date, fname))
-                        else:
-                            if verbose:
-                                LOG.info("File %s already present. Skipping" % fname)
-            
-    with requests.Session() as s:
-        s.auth = (username, password)
-        for the_url in them_urls:
-            r1 = s.request('get', the_url)
-            r = s.get(r1.url, stream=True)
-
-            if not r.ok:
-                raise IOError("Can't start download... [%s]" % the_url)
-            file_size = int(r.headers['content-length'])
-            fname = the_url.split("/")[-1]
-            LOG.info("Starting download on %s(%d bytes) ..." %
-                     (os.path.join(out_dir, fname), file_size))
-            with open(os.path.join(out_dir, fname), 'wb') as fp:
-                for chunk in r.iter_content(chunk_size=CHUNKS):
-                    if chunk:
-                        fp.write(chunk)
-                fp.flush()
-                os.fsync(fp)
-                if verbose:
-                    LOG.info("\tDone!")
+        date_queue.put(date)
+    errors = []
+
+    def lister():
+        while True:
+            try:
+                date = date_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for the_url in list_granules(session, url, date, tile,
+                                             out_dir, get_xml, verify,
+                                             verbose):
+                    url_queue.put(the_url)
+            except Exception as e:
+                errors.append(e)
+
+    def downloader():
+        while True:
+            the_url = url_queue.get()
+            if the_url is None:
+                return
+            try:
+                fetch_granule(session, the_url, out_dir, verify, verbose)
+            except Exception as e:
+                errors.append(e)
+
+    n_workers = max(1, max_connections)
+    listers = [threading.Thread(target=lister) for i in range(n_workers)]
+    downloaders = [threading.Thread(target=downloader)
+                   for i in range(n_workers)]
+    for t in listers + downloaders:
+        t.daemon = True
+        t.start()
+    for t in listers:
+        t.join()
+    for t in downloaders:
+        url_queue.put(None)
+    for t in downloaders:
+        t.join()
+    session.close()
+
+    if errors:
+        raise IOError("%d listing/download requests failed, first error: %s"
+                      % (len(errors), errors[0]))
     if verbose:
         LOG.info("Completely finished downlading all there was")
 
@@ -333,6 +585,13 @@ if __name__ == "__main__":
     parser.add_option ('-x', '--xml', action="store_true", dest="get_xml",
                      default=False,
                      help="Get the XML metadata files too.")
+    parser.add_option('-c', '--connections', action="store",
+                      dest="max_connections", type=int,
+                      default=MAX_CONNECTIONS,
+                      help="Maximum concurrent connections to the server")
+    parser.add_option('-k', '--verify', action="store_true", dest="verify",
+                      default=False,
+                      help="Verify files against their XML metadata")
     (options, args) = parser.parse_args()
     if 'username' not in options.__dict__:
         parser.error("You need to provide a username! Sgrunt!")
@@ -352,4 +611,6 @@ if __name__ == "__main__":
                    doy_start=options.doy_start, doy_end=options.doy_end,
                    out_dir=options.dir_out,
                    verbose=options.verbose, ruff=options.quick,
-                   get_xml=options.get_xml)
+                   get_xml=options.get_xml,
+                   max_connections=options.max_connections,
+                   verify=options.verify)
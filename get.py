@@ -23,7 +23,9 @@
 # Import modules
 import os
 import sys
+import csv
 import shutil
+import lib.modis_grid as modis_grid
 # import gdal
 # import gdalconst
 
@@ -33,6 +35,13 @@ import shutil
 PLATFORM = 'MOLT'
 MODIS_PRODUCTS = {'Daily':'MOD11A1.006', # Land Surface Temperature/Emissivity Daily L3 Global 1km'
                   '8-day':'MOD11A2.006'} # Land Surface Temperature/Emissivity 8-Day L3 Global 1km'
+# NOTE 8-day composites can also be built locally from the Daily product with prep.composite_LST_table,
+# in which case only the 'Daily' product needs to be downloaded and processed.
+AQUA_PLATFORM = 'MOLA'
+GRANULE_STORE = os.path.join(os.path.expanduser('~'), '.steamm', 'granules') # shared HDF download store
+STORE_INDEX = 'granules.csv' # index of verified granules in the store, keyed by granule ID
+AQUA_PRODUCTS = {'Daily':'MYD11A1.006', # Aqua Land Surface Temperature/Emissivity Daily L3 Global 1km'
+                 '8-day':'MYD11A2.006'} # Aqua Land Surface Temperature/Emissivity 8-Day L3 Global 1km'
 
 
 def build_dir_list(project_dir, product_list, year_list):
@@ -52,6 +61,17 @@ def build_dir_list(project_dir, product_list, year_list):
         return dir_list
 
 
+def build_granule_dir_list(project_dir, product, year_list):
+    """Creates a list of the existing directories of downloaded Terra and Aqua granules of a product
+    (i.e. 'Daily'), so granules of either platform, or both, are found for each year."""
+    dir_list = []
+    for product_list in (MODIS_PRODUCTS, AQUA_PRODUCTS):
+        if product in product_list:
+            dir_list += [d for d in build_dir_list(project_dir, {product: product_list[product]}, year_list)
+                         if os.path.isdir(d)]
+    return dir_list
+
+
 def make_dirs(dir_list):
     """Creates new directories to store downloaded MODIS files"""
     try:
@@ -70,19 +90,100 @@ def make_dirs(dir_list):
     return
 
 
-# #FIXME is this necessary? might need to change to something that just connects to the AWS S3 bucket
-# def download_hdf(product_list, year_list, swath_list, doy_start, doy_end, project_dir, username, password, proxy=None):
-#     """download HDF files for multiple years, using get_modis."""
-#     try:
-#         for product in product_list.itervalues():
-#             for year in year_list:
-#                 for swath in swath_list:
-#                     hdf_dir = """{}\{}\{}""".format(project_dir, year, product)
-#                     gm.get_modisfiles(username, password, PLATFORM, product, year, swath, proxy, doy_start, doy_end, hdf_dir)
-#                 message = 'All HDF files downloaded for %d.' % (year)
-#                 print message
-#     except Exception as e:
-#         print e
+def granule_id(hdf_filename):
+    """Returns the granule ID of a MODIS HDF file (i.e. MOD11A1.A2016001.h09v04.006.2016007192412)."""
+    return os.path.basename(hdf_filename)[:-len(".hdf")]
+
+
+def read_store_index(store_dir):
+    """Reads the granule store index as a dictionary of {granule ID: [checksum, size, relative filepath]}."""
+    store_index = {}
+    index_file = os.path.join(store_dir, STORE_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as index_csv:
+            reader = csv.reader(index_csv)
+            next(reader) # skip header
+            for row in reader:
+                store_index[row[0]] = row[1:]
+    return store_index
+
+
+def update_store_index(store_dir, store_subdir):
+    """Verifies HDF files in a store sub-directory against their .hdf.xml metadata and adds them to the
+    store index. Files that fail verification are removed so they will be downloaded again."""
+    import externals.get_modis.get_modis as gm
+    store_index = read_store_index(store_dir)
+    for file in os.listdir(store_subdir):
+        if not file.endswith(".hdf") or granule_id(file) in store_index:
+            continue
+        hdf_file = os.path.join(store_subdir, file)
+        if gm.verify_granule(hdf_file):
+            file_size, checksum_type, checksum = gm.read_xml_metadata(hdf_file + ".xml")
+            store_index[granule_id(file)] = [str(checksum), str(file_size), os.path.relpath(hdf_file, store_dir)]
+        else:
+            print "Removing incomplete granule " + hdf_file
+            os.remove(hdf_file)
+    with open(os.path.join(store_dir, STORE_INDEX), 'wb') as index_csv:
+        writer = csv.writer(index_csv)
+        writer.writerow(["granule_id", "checksum", "size", "filepath"])
+        for key in sorted(store_index):
+            writer.writerow([key] + store_index[key])
+    return store_index
+
+
+def link_granules(store_dir, store_index, hdf_dir, swath_list=None):
+    """Adds the verified granules in the store to a project directory as hardlinks, falling back
+    to symlinks and then to copies where links are not supported (i.e. Python 2 on Windows, or a store
+    on another filesystem). The project directory is created if it does not exist."""
+    product = os.path.basename(hdf_dir.rstrip(os.sep)).split(".")[0]
+    year = os.path.basename(os.path.dirname(hdf_dir.rstrip(os.sep)))
+    if not os.path.exists(hdf_dir):
+        os.makedirs(hdf_dir)
+    for key, (checksum, file_size, filepath) in sorted(store_index.items()):
+        key_split = key.split(".")
+        if key_split[0] != product or key_split[1][1:5] != str(year):
+            continue
+        if swath_list and key_split[2] not in swath_list:
+            continue
+        src_file = os.path.join(store_dir, filepath)
+        dst_file = os.path.join(hdf_dir, os.path.basename(filepath))
+        if os.path.exists(dst_file):
+            continue
+        if hasattr(os, 'link'):
+            try:
+                os.link(src_file, dst_file)
+                continue
+            except OSError:
+                pass
+        if hasattr(os, 'symlink'):
+            try:
+                os.symlink(src_file, dst_file)
+                continue
+            except OSError:
+                pass
+        shutil.copy2(src_file, dst_file)
+    return
+
+
+def download_hdf(product_list, year_list, swath_list, doy_start, doy_end, project_dir, username, password,
+                 proxy=None, store_dir=GRANULE_STORE, platform=PLATFORM):
+    """Downloads HDF files for multiple years into the shared granule store using get_modis, then links
+    them into the project directories. Granules already in the store are verified against their
+    .hdf.xml metadata and are not downloaded again."""
+    import externals.get_modis.get_modis as gm
+    for swath in swath_list:
+        modis_grid.parse_tile(swath) # fail before downloading anything if a tile name is misspelt
+    for product in product_list.itervalues():
+        for year in year_list:
+            store_subdir = os.path.join(store_dir, product, str(year))
+            for swath in swath_list:
+                gm.get_modisfiles(username, password, platform, product, int(year), swath, proxy,
+                                  doy_start, doy_end, store_subdir, verify=True)
+            store_index = update_store_index(store_dir, store_subdir)
+            link_granules(store_dir, store_index, os.path.join(project_dir, str(year), product), swath_list)
+            message = 'All HDF files downloaded for %s.' % (year)
+            print message
+    return
 
 
 # FIXME recfactor to get filepaths from AWS S3 buckets
@@ -124,12 +225,13 @@ def get_file_dates(hdf_file_array):
 
 
 def find_dup_file_dates(hdf_date_list, swath_list):
-    """Extracts list of unique days from list of all file dates."""
+    """Extracts list of unique days from list of all file dates. Terra and Aqua files share
+    collection dates, so dates are always de-duplicated."""
     print "Extracting list of non-duplicate MODIS HDF collection dates..."
     if len(swath_list) > 1:
         hdf_dates = set([d for d in hdf_date_list if hdf_date_list.count(d)>1])
     else:
-        hdf_dates = hdf_date_list
+        hdf_dates = set(hdf_date_list)
     sorted_dates = sorted(hdf_dates)
     return sorted_dates
 
@@ -44,11 +44,12 @@ try:
 except ImportError:
     import Numeric
 
-def main(srcfile, dstfile, arg = '-csv' ):
+def main(srcfile, dstfile, arg = '-csv', band_nums = None ):
     srcwin = None
     skip = 1
     delim = ' '
-    band_nums = [1]
+    if band_nums is None:
+        band_nums = [1]
     # Open source file.
     srcds = gdal.Open(srcfile)
     if srcds is None:
@@ -0,0 +1,149 @@
+#-------------------------------------------------------------------------------
+# Name:         modis_grid.py
+#
+# Summary:      Vectorized math for the MODIS sinusoidal grid (the MODIS Land grid of 36 x 18
+#               tiles). Converts between latitude/longitude, sinusoidal coordinates, tiles
+#               (i.e. h09v04) and cell indices for whole arrays of points with NumPy, so tile
+#               selection, grid snapping and cell centres do not need GDAL/OSR transforms.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import re
+import numpy as np
+
+# Global constants
+SPHERE_RADIUS = 6371007.181 # meters, sphere of the MODIS sinusoidal projection
+H_TILES = 36
+V_TILES = 18
+TILE_SIZE = 2 * np.pi * SPHERE_RADIUS / H_TILES # tile width and height, in meters (1111950.519667)
+XMIN = -H_TILES / 2 * TILE_SIZE # west edge of the grid (-20015109.355798)
+YMAX = V_TILES / 2 * TILE_SIZE # north edge of the grid (10007554.677899)
+TILE_CELLS = 1200 # cells per tile row or column of the 1km grid (2400 for 500m, 4800 for 250m)
+CELL_SIZE = TILE_SIZE / TILE_CELLS
+
+
+def latlon_to_sin(lat, lon):
+    """Converts latitudes and longitudes (degrees) to sinusoidal x, y (meters)."""
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    lon_rad = np.radians(np.asarray(lon, dtype=np.float64))
+    return SPHERE_RADIUS * lon_rad * np.cos(lat_rad), SPHERE_RADIUS * lat_rad
+
+
+def sin_to_latlon(x, y):
+    """Converts sinusoidal x, y (meters) to latitudes and longitudes (degrees). Points outside the
+    projected globe (longitude beyond +/-180) are NaN."""
+    lat_rad = np.asarray(y, dtype=np.float64) / SPHERE_RADIUS
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lon = np.degrees(np.asarray(x, dtype=np.float64) / (SPHERE_RADIUS * np.cos(lat_rad)))
+    lat = np.degrees(lat_rad)
+    outside = ~(np.abs(lon) <= 180.0) | (np.abs(lat) > 90.0)
+    return np.where(outside, np.nan, lat), np.where(outside, np.nan, lon)
+
+
+def sin_to_grid(x, y, tile_cells=TILE_CELLS):
+    """Returns the global grid (row, col) of the cells containing sinusoidal x, y. Rows count down from
+    the north edge of the grid and columns east from the west edge."""
+    cell_size = TILE_SIZE / tile_cells
+    col = np.floor((np.asarray(x, dtype=np.float64) - XMIN) / cell_size).astype(np.int64)
+    row = np.floor((YMAX - np.asarray(y, dtype=np.float64)) / cell_size).astype(np.int64)
+    return row, col
+
+
+def grid_to_sin(row, col, tile_cells=TILE_CELLS):
+    """Returns the sinusoidal x, y of the centres of global grid cells."""
+    cell_size = TILE_SIZE / tile_cells
+    x = XMIN + (np.asarray(col, dtype=np.float64) + 0.5) * cell_size
+    y = YMAX - (np.asarray(row, dtype=np.float64) + 0.5) * cell_size
+    return x, y
+
+
+def sin_to_tile(x, y, tile_cells=TILE_CELLS):
+    """Returns the tile (h, v) and the cell (row, col) within the tile of sinusoidal x, y."""
+    row, col = sin_to_grid(x, y, tile_cells)
+    return col // tile_cells, row // tile_cells, row % tile_cells, col % tile_cells
+
+
+def tile_to_sin(h, v, row, col, tile_cells=TILE_CELLS):
+    """Returns the sinusoidal x, y of the centres of cells (row, col) in tiles (h, v)."""
+    return grid_to_sin(np.asarray(v) * tile_cells + row, np.asarray(h) * tile_cells + col, tile_cells)
+
+
+def latlon_to_tile(lat, lon, tile_cells=TILE_CELLS):
+    """Returns the tile (h, v) and the cell (row, col) within the tile of latitudes and longitudes."""
+    return sin_to_tile(*latlon_to_sin(lat, lon), tile_cells=tile_cells)
+
+
+def tile_to_latlon(h, v, row, col, tile_cells=TILE_CELLS):
+    """Returns the latitudes and longitudes of the centres of cells (row, col) in tiles (h, v)."""
+    return sin_to_latlon(*tile_to_sin(h, v, row, col, tile_cells))
+
+
+def cell_id(row, col, tile_cells=TILE_CELLS):
+    """Returns the row-major index of global grid cells, a unique ID for each cell of the grid."""
+    return np.asarray(row, dtype=np.int64) * (H_TILES * tile_cells) + np.asarray(col, dtype=np.int64)
+
+
+def tile_name(h, v):
+    """Returns the name of a tile, i.e. h09v04."""
+    return "h%02dv%02d" % (h, v)
+
+
+def parse_tile(name):
+    """Returns the (h, v) of a tile name such as h09v04."""
+    match = re.match(r'^h(\d\d)v(\d\d)$', name)
+    if match is None or int(match.group(1)) >= H_TILES or int(match.group(2)) >= V_TILES:
+        raise ValueError("%s is not a MODIS sinusoidal tile name (i.e. h09v04)." % name)
+    return int(match.group(1)), int(match.group(2))
+
+
+def tile_bounds(h, v):
+    """Returns the extent (xmin, xmax, ymin, ymax) of a tile in sinusoidal coordinates."""
+    xmin = XMIN + h * TILE_SIZE
+    ymax = YMAX - v * TILE_SIZE
+    return xmin, xmin + TILE_SIZE, ymax - TILE_SIZE, ymax
+
+
+def bbox_tiles(xmin, xmax, ymin, ymax):
+    """Returns the (h, v) of the tiles overlapping a sinusoidal extent, clipped to the grid."""
+    h_min = max(int((xmin - XMIN) // TILE_SIZE), 0)
+    h_max = min(int((xmax - XMIN) // TILE_SIZE), H_TILES - 1)
+    v_min = max(int((YMAX - ymax) // TILE_SIZE), 0)
+    v_max = min(int((YMAX - ymin) // TILE_SIZE), V_TILES - 1)
+    return [(h, v) for h in range(h_min, h_max + 1) for v in range(v_min, v_max + 1)]
+
+
+def point_tiles(x, y):
+    """Returns the sorted names of the tiles containing any of the sinusoidal points x, y."""
+    h = np.floor((np.asarray(x, dtype=np.float64) - XMIN) / TILE_SIZE).astype(np.int64)
+    v = np.floor((YMAX - np.asarray(y, dtype=np.float64)) / TILE_SIZE).astype(np.int64)
+    keep = (h >= 0) & (h < H_TILES) & (v >= 0) & (v < V_TILES)
+    return [tile_name(t // V_TILES, t % V_TILES) for t in np.unique(h[keep] * V_TILES + v[keep])]
+
+
+def snap_bbox(xmin, xmax, ymin, ymax, buffer_cells=0, tile_cells=TILE_CELLS):
+    """Expands a sinusoidal extent outwards to grid cell edges, plus buffer_cells cells on each side.
+    Returns (xmin, xmax, ymin, ymax)."""
+    cell_size = TILE_SIZE / tile_cells
+    col_min = np.floor((xmin - XMIN) / cell_size) - buffer_cells
+    col_max = np.ceil((xmax - XMIN) / cell_size) + buffer_cells
+    row_min = np.floor((YMAX - ymax) / cell_size) - buffer_cells
+    row_max = np.ceil((YMAX - ymin) / cell_size) + buffer_cells
+    return (XMIN + col_min * cell_size, XMIN + col_max * cell_size,
+            YMAX - row_max * cell_size, YMAX - row_min * cell_size)
+
+
+def pixel_centres(geotransform, row, col):
+    """Returns the x, y of the centres of raster cells (row, col), from a GDAL geotransform."""
+    row = np.asarray(row, dtype=np.float64) + 0.5
+    col = np.asarray(col, dtype=np.float64) + 0.5
+    return (geotransform[0] + col * geotransform[1] + row * geotransform[2],
+            geotransform[3] + col * geotransform[4] + row * geotransform[5])
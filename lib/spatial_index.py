@@ -0,0 +1,184 @@
+#-------------------------------------------------------------------------------
+# Name:         spatial_index.py
+#
+# Summary:      In-memory spatial index for the RCA polygon and stream network shapefiles.
+#               Each layer is read through OGR once, and its features are indexed in a
+#               packed R-tree built with the Sort-Tile-Recursive (STR) algorithm. The index
+#               answers point-in-polygon, bounding box and nearest feature queries for the
+#               webSTeAMM front end without re-opening the shapefile.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import heapq
+import threading
+import numpy as np
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+# Global constants
+NODE_CAPACITY = 16 # maximum number of children per R-tree node
+
+_layer_cache = {}
+_layer_lock = threading.Lock()
+
+
+class STRtree(object):
+    """Packed R-tree over an array of bounding boxes (xmin, ymin, xmax, ymax), bulk loaded with the
+    Sort-Tile-Recursive algorithm. Queries return the indices of the boxes in the input array."""
+
+    def __init__(self, bounds, node_capacity=NODE_CAPACITY):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.node_capacity = node_capacity
+        self.item_count = len(bounds)
+        # levels[0] holds the items in tree order; each level has the bounds of its nodes and the
+        # start and count of each node's children in the level below
+        order = self._str_order(bounds, np.arange(len(bounds)))
+        self.levels = [(bounds[order], order, None, None)]
+        while len(self.levels[-1][0]) > 1:
+            self.levels.append(self._pack(self.levels[-1][0]))
+
+    def _str_order(self, bounds, index):
+        """Orders boxes into vertical slices by x centre, then by y centre within each slice."""
+        if len(index) == 0:
+            return index
+        x_centre = (bounds[index, 0] + bounds[index, 2]) / 2.0
+        y_centre = (bounds[index, 1] + bounds[index, 3]) / 2.0
+        node_count = int(np.ceil(len(index) / float(self.node_capacity)))
+        slice_size = int(np.ceil(np.sqrt(node_count))) * self.node_capacity
+        by_x = index[np.argsort(x_centre, kind='mergesort')]
+        y_by_x = y_centre[np.argsort(x_centre, kind='mergesort')]
+        order = []
+        for start in range(0, len(index), slice_size):
+            slice_y = y_by_x[start:start + slice_size]
+            order.append(by_x[start:start + slice_size][np.argsort(slice_y, kind='mergesort')])
+        return np.concatenate(order)
+
+    def _pack(self, child_bounds):
+        """Groups consecutive children into nodes, returning the next level up."""
+        child_start = np.arange(0, len(child_bounds), self.node_capacity)
+        child_count = np.minimum(self.node_capacity, len(child_bounds) - child_start)
+        node_bounds = np.column_stack([np.minimum.reduceat(child_bounds[:, 0], child_start),
+                                       np.minimum.reduceat(child_bounds[:, 1], child_start),
+                                       np.maximum.reduceat(child_bounds[:, 2], child_start),
+                                       np.maximum.reduceat(child_bounds[:, 3], child_start)])
+        return (node_bounds, None, child_start, child_count)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Returns the indices of all boxes that intersect the query box."""
+        if self.item_count == 0:
+            return np.array([], dtype=np.int64)
+        top = len(self.levels) - 1
+        candidates = np.arange(len(self.levels[top][0]))
+        for level in range(top, -1, -1):
+            node_bounds, order, child_start, child_count = self.levels[level]
+            b = node_bounds[candidates]
+            candidates = candidates[(b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin)]
+            if level == 0:
+                return order[candidates]
+            # expand the remaining nodes to the indices of their children
+            counts = child_count[candidates]
+            offsets = np.repeat(child_start[candidates] - np.cumsum(counts) + counts, counts)
+            candidates = offsets + np.arange(counts.sum())
+
+    def nearest(self, x, y, distance, max_distance=np.inf):
+        """Returns the (index, distance) of the item closest to point x, y, searching nodes in order of
+        their box distance. distance(index) gives the exact distance from the point to an item."""
+        if self.item_count == 0:
+            return None, None
+        top = len(self.levels) - 1
+        heap = [(0.0, top, i) for i in range(len(self.levels[top][0]))]
+        best_index, best_distance = None, max_distance
+        while heap:
+            box_distance, level, i = heapq.heappop(heap)
+            if box_distance > best_distance:
+                break
+            if level == 0:
+                item = self.levels[0][1][i]
+                item_distance = distance(item)
+                if item_distance < best_distance:
+                    best_index, best_distance = item, item_distance
+                continue
+            child_bounds = self.levels[level - 1][0]
+            start, count = self.levels[level][2][i], self.levels[level][3][i]
+            b = child_bounds[start:start + count]
+            dx = np.maximum(np.maximum(b[:, 0] - x, x - b[:, 2]), 0.0)
+            dy = np.maximum(np.maximum(b[:, 1] - y, y - b[:, 3]), 0.0)
+            for child, child_distance in zip(range(start, start + count), np.hypot(dx, dy)):
+                if child_distance <= best_distance:
+                    heapq.heappush(heap, (child_distance, level - 1, child))
+        return best_index, best_distance
+
+
+class LayerIndex(object):
+    """Features of a shapefile layer, held in memory with an STRtree over their envelopes. Query results
+    are feature IDs, or values of id_field if one is given."""
+
+    def __init__(self, in_shp, id_field=None):
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        in_ds = driver.Open(in_shp, 0)
+        in_lyr = in_ds.GetLayer()
+        self.spatial_ref = in_lyr.GetSpatialRef().Clone()
+        self.extent = in_lyr.GetExtent() # (xmin, xmax, ymin, ymax), as returned by OGR
+        self.geoms = []
+        self.ids = []
+        bounds = []
+        for feature in in_lyr:
+            geom = feature.GetGeometryRef().Clone()
+            (xmin, xmax, ymin, ymax) = geom.GetEnvelope()
+            self.geoms.append(geom)
+            self.ids.append(feature.GetField(id_field) if id_field else feature.GetFID())
+            bounds.append((xmin, ymin, xmax, ymax))
+        self.tree = STRtree(bounds)
+        in_ds = None
+
+    def point_query(self, x, y):
+        """Returns the IDs of the features containing point x, y (i.e. the RCA a coordinate falls in)."""
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        return [self.ids[i] for i in self.tree.query(x, y, x, y) if self.geoms[i].Contains(point)]
+
+    def bbox_query(self, xmin, ymin, xmax, ymax, exact=False):
+        """Returns the IDs of the features whose envelopes intersect the box, or, with exact=True, the
+        features whose geometries intersect it."""
+        index = self.tree.query(xmin, ymin, xmax, ymax)
+        if exact:
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for (x, y) in ((xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax), (xmin, ymin)):
+                ring.AddPoint_2D(x, y)
+            box = ogr.Geometry(ogr.wkbPolygon)
+            box.AddGeometry(ring)
+            index = [i for i in index if self.geoms[i].Intersects(box)]
+        return [self.ids[i] for i in index]
+
+    def nearest(self, x, y, max_distance=np.inf):
+        """Returns the (ID, distance) of the feature closest to point x, y (i.e. the nearest stream reach),
+        or (None, None) if there is no feature within max_distance."""
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        index, distance = self.tree.nearest(x, y, lambda i: self.geoms[i].Distance(point), max_distance)
+        if index is None:
+            return None, None
+        return self.ids[index], distance
+
+
+def open_layer_index(in_shp, id_field=None):
+    """Returns the shared LayerIndex of a shapefile, loading it on first use. The index is re-loaded if
+    the shapefile has been modified since it was loaded."""
+    key = (os.path.abspath(in_shp), id_field)
+    mtime = os.path.getmtime(in_shp)
+    with _layer_lock:
+        if key not in _layer_cache or _layer_cache[key][0] != mtime:
+            _layer_cache[key] = (mtime, LayerIndex(in_shp, id_field))
+        return _layer_cache[key][1]
@@ -23,14 +23,40 @@
 
 # Import modules
 import os
-import shutil
+import csv
+import collections
+import multiprocessing
+import numpy as np
 from osgeo import ogr
+import lib.spatial_index as spatial_index
+import project
 
 # Input variables
 
 # Stream network shapefile to which interpolated temperatures will be attached
 geo_strm = ""
 
+# Spatial gap filling (inverse distance weighting of the nearest valid LST cells)
+IDW_NEIGHBOURS = 8
+IDW_POWER = 2.0
+IDW_MAX_DISTANCE = 5000.0 # map units of the LST cell coordinates
+IDW_TREE_CACHE = 8 # number of KD-trees kept for re-use across dates
+
+# Linear model variants compared by cross-validation: (name, include Julian day, first DOY, last DOY)
+MODEL_VARIANTS = [('lst_year', False, 1, 366),
+                  ('lst_julian_year', True, 1, 366),
+                  ('lst_half1', False, 1, 182),
+                  ('lst_julian_half1', True, 1, 182),
+                  ('lst_half2', False, 183, 366),
+                  ('lst_julian_half2', True, 183, 366)]
+CV_FOLDS = 10
+CV_SEED = 0
+
+# Rolling thermal metrics of the predicted stream temperatures
+METRIC_WINDOW = 7 # days, i.e. MWMT and 7DADM
+METRIC_THRESHOLDS = [13.0, 16.0, 18.0, 20.0] # degrees C, common salmonid criteria
+METRIC_CHUNK_ROWS = 5000 # reaches read from the prediction table at a time
+
 
 # TODO move functions to new STeAMM utility module and class
 
@@ -47,51 +73,39 @@ def predict_subdir_list(input_dir, dir_list, source_subdir_list, products_subdir
     """Create list of full paths to all project subdirectories."""
     proj_dir_list = []
     for d in dir_list:
-        proj_dir_list.append(input_dir + "\\" + d)
+        proj_dir_list.append(os.path.join(input_dir, d))
     # create sub-directories for 1source_data folder
     for s in source_subdir_list:
-        proj_dir_list.append(input_dir + "\\" + dir_list[0] + "\\" + s)
+        proj_dir_list.append(os.path.join(input_dir, dir_list[0], s))
     # create sub-directories for 3products folder
     for p in products_subdir_list:
-        proj_dir_list.append(input_dir + "\\" + dir_list[2] + "\\" + p)
+        proj_dir_list.append(os.path.join(input_dir, dir_list[2], p))
     print "Project directory list created..."
     return proj_dir_list
 
 
 def predict_create_dir(input_dir, dir_list, source_subdir_list, products_subdir_list):
-    """Create new project directory using STeAMM project directory schema."""
+    """Create new project directory using STeAMM project directory schema. An existing project is kept,
+    and only missing directories are created, so re-running does not delete previous outputs."""
     if not os.path.exists(input_dir):
-        os.makedirs(input_dir)
         print "Project directory created..."
     else:
-        shutil.rmtree(input_dir)
-        os.makedirs(input_dir)
-        print "Project directory already exists! Overwriting..."
-        # create top level directories
-    for d in dir_list:
-        os.makedirs(os.path.join(input_dir, d))
-    # create sub-directories for 1source_data folder
-    for s in source_subdir_list:
-        dir_1source = input_dir + "\\" + dir_list[0]
-        os.makedirs(os.path.join(dir_1source, s))
-    # create sub-directories for 3products folder
-    for p in products_subdir_list:
-        dir_3products = input_dir + "\\" + dir_list[2]
-        os.makedirs(os.path.join(dir_3products, p))
+        print "Project directory already exists! Adding missing directories..."
+    db = project.ProjectDB(input_dir)
+    proj_dir_list = predict_subdir_list(input_dir, dir_list, source_subdir_list, products_subdir_list)
+    for d in proj_dir_list:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    db.add_dirs(proj_dir_list)
+    db.close()
     return
 
 
 def predict_check_schema(input_dir, proj_dir_list):
     """If the "existing project" option is selected in the plugin form, check if directory with STeAMM schema exists."""
-    user_dir_list = []
-    missing_dir_list = []
-    for user_root, user_dir, user_files in os.\
-            walk(input_dir):
-        for d in user_dir:
-            user_dir_list.append(os.path.join(user_root, d))
-    for ideal_dir in proj_dir_list:
-        if ideal_dir not in user_dir_list:
-            missing_dir_list.append(ideal_dir)
+    db = project.ProjectDB(input_dir)
+    missing_dir_list = db.missing_dirs(proj_dir_list)
+    db.close()
     if len(missing_dir_list) >= 1:
         message = "Missing directories: %s" % (str(missing_dir_list))
     else:
@@ -101,9 +115,14 @@ def predict_check_schema(input_dir, proj_dir_list):
 
 def predict_create_year_folders(year_list, input_dir, dir_list, source_subdir_list):
     """Add a folder to .\1source_data for each selected year."""
-    subdir_hdf = input_dir + "\\" + dir_list[0] + "\\" + source_subdir_list[0]
-    for y in year_list:
-        os.makedirs(os.path.join(subdir_hdf, str(y)))
+    subdir_hdf = os.path.join(input_dir, dir_list[0], source_subdir_list[0])
+    year_dir_list = [os.path.join(subdir_hdf, str(y)) for y in year_list]
+    for d in year_dir_list:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    db = project.ProjectDB(input_dir)
+    db.add_dirs(year_dir_list)
+    db.close()
     return
 
 
@@ -113,6 +132,15 @@ def predict_create_year_folders(year_list, input_dir, dir_list, source_subdir_li
 
 
 
+# find the stream reach nearest to a coordinate, i.e. for a web map click
+def nearest_reach(x, y, in_strm=None, id_field=None, max_distance=1000.0):
+    """Returns the (ID, distance) of the stream segment nearest to point x, y, within max_distance map units,
+    using the shared in-memory spatial index of the stream network."""
+    if in_strm is None:
+        in_strm = geo_strm
+    return spatial_index.open_layer_index(in_strm, id_field).nearest(x, y, max_distance)
+
+
 # interpolate missing LST values
 
 def interpolate_lst(  ):
@@ -121,7 +149,7 @@ def interpolate_lst(  ):
     ###PSEUDO-CODE
     #open LST_value table
     #convert to Numpy array
-    #convert zeros to NaN
+    #rejected QC cells are already NaN (see prep.qc_filter)
     #per row, create list of indexes of cells that are NaN
     #use numpy.interp to do interpolation per row
     #fill in first day of values if NaN
@@ -130,6 +158,65 @@ def interpolate_lst(  ):
     #export interpolated array to csv
     return intrp_lst_csv
 
+# fill cloud-masked LST cells from their valid neighbours on the same date
+def fill_lst_spatial(xy_array, lst_cube, k=IDW_NEIGHBOURS, power=IDW_POWER, max_distance=IDW_MAX_DISTANCE):
+    """Fills missing (NaN) LST values with the inverse distance weighted mean of the k nearest valid cells
+    on the same date, within max_distance. xy_array holds the cell centroid coordinates (i.e. the X and Y
+    columns of the LST table) and lst_cube has one row per cell and one column per date. All missing cells
+    of a date are filled with a single batched KD-tree query, and a tree is re-used for every date with the
+    same valid cell mask (the IDW_TREE_CACHE most recently used trees are kept). Cells with no valid neighbour within max_distance stay NaN."""
+    from scipy.spatial import cKDTree
+    xy_array = np.asarray(xy_array, dtype=np.float64)
+    lst_cube = np.asarray(lst_cube, dtype=np.float32)
+    filled_cube = lst_cube.copy()
+    tree_cache = collections.OrderedDict()
+    for j in range(lst_cube.shape[1]):
+        valid = ~np.isnan(lst_cube[:, j])
+        if valid.all() or not valid.any():
+            continue
+        mask_key = np.packbits(valid).tobytes()
+        if mask_key in tree_cache:
+            tree_cache[mask_key] = tree_cache.pop(mask_key) # move to most recently used
+        else:
+            if len(tree_cache) >= IDW_TREE_CACHE:
+                tree_cache.popitem(last=False)
+            tree_cache[mask_key] = (cKDTree(xy_array[valid]), np.nonzero(valid)[0])
+        tree, valid_index = tree_cache[mask_key]
+
+        missing_index = np.nonzero(~valid)[0]
+        n_neighbours = min(k, len(valid_index))
+        distance, neighbour = tree.query(xy_array[missing_index], k=n_neighbours,
+                                         distance_upper_bound=max_distance)
+        distance = distance.reshape(len(missing_index), n_neighbours)
+        neighbour = neighbour.reshape(len(missing_index), n_neighbours)
+        in_range = np.isfinite(distance)
+        weights = np.where(in_range, 1.0 / np.power(np.maximum(distance, 1e-9), power), 0.0)
+        values = lst_cube[valid_index[np.where(in_range, neighbour, 0)], j]
+        weight_sum = weights.sum(axis=1)
+        has_neighbour = weight_sum > 0
+        filled_cube[missing_index[has_neighbour], j] = \
+            (weights * values).sum(axis=1)[has_neighbour] / weight_sum[has_neighbour]
+    return filled_cube
+
+
+def fill_LST_table(in_csv, out_csv, k=IDW_NEIGHBOURS, power=IDW_POWER, max_distance=IDW_MAX_DISTANCE,
+                   compact=False):
+    """Fills missing values of an LST table (see prep.compile_LST_table) with fill_lst_spatial, before
+    temporal interpolation, so cells with no valid values for several days in a row still get estimates.
+    A compact input table is decoded to degrees C, and the output table is always in degrees C."""
+    import prep
+    print "Filling missing LST values from neighbouring cells..."
+    id_rows, doy_list, lst_cube = prep.read_LST_table(in_csv, compact)
+    xy_array = np.array([[float(r[1]), float(r[2])] for r in id_rows])
+    filled_cube = fill_lst_spatial(xy_array, lst_cube, k, power, max_distance)
+    with open(out_csv, 'wb') as out_file:
+        writer = csv.writer(out_file, delimiter=',')
+        writer.writerow(["UID", "X", "Y"] + [str(d) for d in doy_list])
+        for id_row, values in zip(id_rows, filled_cube):
+            writer.writerow(id_row + ['' if np.isnan(v) else '%.2f' % v for v in values])
+    return out_csv
+
+
 # convert interpolated LST csv table to grid
 def convert_to_grid( ):
     pass
@@ -163,7 +250,228 @@ def poly_stat(in_ply, clipped_raster_list):
 # - for whole year
 # - for half years
 
+
+# cross-validated errors of the linear models, computed in closed form from the hat matrix
+def design_matrix(lst, doy, julian=False):
+    """Builds the design matrix of a simple fixed-effects linear model: intercept and LST, plus Julian day."""
+    columns = [np.ones(len(lst)), np.asarray(lst, dtype=np.float64)]
+    if julian:
+        columns.append(np.asarray(doy, dtype=np.float64))
+    return np.column_stack(columns)
+
+
+def cv_residuals(X, y, folds=None, seed=CV_SEED):
+    """Returns the cross-validation residuals of an ordinary least squares fit without refitting the model.
+    With folds=None the residuals are leave-one-out, e_i / (1 - h_ii). Otherwise the rows are split into
+    random folds, and the residuals of each held-out fold S are (I - H_SS)^-1 e_S, where H_SS is the block
+    of the hat matrix for the fold."""
+    xtx_inv = np.linalg.pinv(X.T.dot(X))
+    residuals = y - X.dot(xtx_inv.dot(X.T.dot(y)))
+    if folds is None:
+        leverage = np.einsum('ij,jk,ik->i', X, xtx_inv, X)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return residuals / (1.0 - leverage)
+    fold_index = np.random.RandomState(seed).permutation(len(y)) % folds
+    cv_resid = np.empty(len(y))
+    for f in range(folds):
+        rows = np.nonzero(fold_index == f)[0]
+        X_f = X[rows]
+        h_ff = X_f.dot(xtx_inv).dot(X_f.T)
+        cv_resid[rows] = np.linalg.pinv(np.eye(len(rows)) - h_ff).dot(residuals[rows])
+    return cv_resid
+
+
+def rmse(residuals):
+    """Root mean square of the finite residuals, or NaN if there are none."""
+    residuals = np.asarray(residuals)
+    residuals = residuals[np.isfinite(residuals)]
+    if len(residuals) == 0:
+        return np.nan
+    return float(np.sqrt(np.mean(np.square(residuals))))
+
+
+def _cv_variants(args):
+    """Leave-one-out and k-fold residuals of every model variant for one set of observations."""
+    lst, doy, temp, folds = args
+    variant_resid = {}
+    for name, julian, doy_start, doy_end in MODEL_VARIANTS:
+        rows = (doy >= doy_start) & (doy <= doy_end)
+        X = design_matrix(lst[rows], doy[rows], julian)
+        if rows.sum() <= X.shape[1]: # too few observations to fit the model
+            variant_resid[name] = (np.array([]), np.array([]))
+            continue
+        variant_resid[name] = (cv_residuals(X, temp[rows]), cv_residuals(X, temp[rows], min(folds, rows.sum())))
+    return variant_resid
+
+
+def read_observation_table(in_csv):
+    """Reads a table of observed stream temperatures with RCA_ID, DOY, LST and TEMP columns into a
+    dictionary of {RCA ID: (LST, DOY, TEMP arrays)}."""
+    obs_dict = {}
+    with open(in_csv, 'rb') as in_file:
+        for row in csv.DictReader(in_file):
+            obs_dict.setdefault(row['RCA_ID'], []).append((float(row['LST']), float(row['DOY']), float(row['TEMP'])))
+    for rca_id, rows in obs_dict.items():
+        values = np.array(rows, dtype=np.float64)
+        obs_dict[rca_id] = (values[:, 0], values[:, 1], values[:, 2])
+    return obs_dict
+
+
+def cross_validate(obs_csv, out_dir, folds=CV_FOLDS, processes=None):
+    """Computes leave-one-out and k-fold RMSE of each model variant in MODEL_VARIANTS for per-RCA models
+    (fitted in parallel across RCAs) and for a single per-basin model, and writes them to cv_rca.csv and
+    cv_basin.csv in out_dir. The per-basin table also has the pooled RMSE of the per-RCA models."""
+    print "Cross-validating stream temperature models..."
+    obs_dict = read_observation_table(obs_csv)
+    rca_list = sorted(obs_dict)
+    pool = multiprocessing.Pool(processes)
+    try:
+        rca_resid = pool.map(_cv_variants, [obs_dict[r] + (folds,) for r in rca_list])
+    finally:
+        pool.close()
+        pool.join()
+    basin_obs = [np.concatenate([obs_dict[r][i] for r in rca_list]) for i in range(3)]
+    basin_resid = _cv_variants(tuple(basin_obs) + (folds,))
+
+    variant_names = [v[0] for v in MODEL_VARIANTS]
+    header = []
+    for name in variant_names:
+        header += [name + '_loo', name + '_kfold']
+    rca_csv = os.path.join(out_dir, 'cv_rca.csv')
+    with open(rca_csv, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['RCA_ID', 'N'] + header)
+        for rca_id, variant_resid in zip(rca_list, rca_resid):
+            row = [rca_id, len(obs_dict[rca_id][0])]
+            for name in variant_names:
+                row += ['%.4f' % rmse(variant_resid[name][0]), '%.4f' % rmse(variant_resid[name][1])]
+            writer.writerow(row)
+    basin_csv = os.path.join(out_dir, 'cv_basin.csv')
+    with open(basin_csv, 'wb') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(['MODEL', 'N'] + header)
+        row = ['per_basin', len(basin_obs[0])]
+        for name in variant_names:
+            row += ['%.4f' % rmse(basin_resid[name][0]), '%.4f' % rmse(basin_resid[name][1])]
+        writer.writerow(row)
+        row = ['per_rca', len(basin_obs[0])]
+        for name in variant_names:
+            row += ['%.4f' % rmse(np.concatenate([r[name][0] for r in rca_resid])),
+                    '%.4f' % rmse(np.concatenate([r[name][1] for r in rca_resid]))]
+        writer.writerow(row)
+    return rca_csv, basin_csv
+
+
 # Output stats for modeling results
 ## use matplotlib to display graphs on-screen
 
-## Summarize predictions
\ No newline at end of file
+## Summarize predictions
+# trailing N-day moving average of every reach, from cumulative sums along the day axis
+def rolling_mean(cube, window=METRIC_WINDOW, min_valid=None):
+    """Returns the trailing moving average over window days of a (reaches x days) cube. A window needs
+    min_valid values (by default all of them); otherwise, and for the first window - 1 days, it is NaN."""
+    if min_valid is None:
+        min_valid = window
+    valid = ~np.isnan(cube)
+    value_sum = np.zeros((cube.shape[0], cube.shape[1] + 1), dtype=np.float64)
+    value_count = np.zeros(value_sum.shape, dtype=np.int32)
+    np.cumsum(np.where(valid, cube, 0.0), axis=1, out=value_sum[:, 1:])
+    np.cumsum(valid, axis=1, out=value_count[:, 1:])
+    window_sum = value_sum[:, window:] - value_sum[:, :-window]
+    window_count = value_count[:, window:] - value_count[:, :-window]
+    moving_mean = np.empty(cube.shape, dtype=np.float64)
+    moving_mean.fill(np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moving_mean[:, window - 1:] = np.where(window_count >= min_valid, window_sum / window_count, np.nan)
+    return moving_mean
+
+
+def _row_max(cube):
+    """Returns the maximum of each row and its column index, ignoring NaN (NaN and -1 for empty rows)."""
+    filled = np.where(np.isnan(cube), -np.inf, cube)
+    col = np.argmax(filled, axis=1)
+    row_max = filled[np.arange(len(cube)), col]
+    empty = np.isneginf(row_max)
+    return np.where(empty, np.nan, row_max), np.where(empty, -1, col)
+
+
+def day_axis(doy_list, cube):
+    """Places the columns of a (reaches x DOYs) cube on a continuous day axis from the first to the last
+    DOY, with NaN for missing days, so moving windows span calendar days rather than columns."""
+    doy_array = np.asarray(doy_list, dtype=np.int64)
+    first_doy = doy_array.min()
+    full_cube = np.empty((cube.shape[0], doy_array.max() - first_doy + 1), dtype=np.float64)
+    full_cube.fill(np.nan)
+    full_cube[:, doy_array - first_doy] = cube
+    return full_cube, first_doy
+
+
+def metric_names(thresholds=METRIC_THRESHOLDS, with_mean=False):
+    """Names of the metrics returned by thermal_metrics, in order."""
+    names = ['MAX', 'MWMT', 'MWMT_DOY']
+    if with_mean:
+        names += ['MWAT', 'MWAT_DOY']
+    names += ['DAYS_GT_%g' % t for t in thresholds]
+    names += ['7DADM_GT_%g' % t for t in thresholds]
+    return names
+
+
+def thermal_metrics(tmax_cube, doy_list, thresholds=METRIC_THRESHOLDS, window=METRIC_WINDOW, tmean_cube=None):
+    """Computes the thermal metrics of every reach from a (reaches x DOYs) cube of daily maximum
+    temperatures, and optionally a cube of daily mean temperatures: the maximum, the maximum weekly maximum
+    temperature (MWMT, the highest 7-day average of daily maximums, or 7DADM) and its DOY, the maximum
+    weekly average temperature (MWAT) and its DOY, and the days with a daily maximum, and with a 7DADM,
+    above each threshold. Returns a (reaches x metrics) array, with columns as in metric_names."""
+    tmax_cube, first_doy = day_axis(doy_list, tmax_cube)
+    columns = []
+    columns.append(_row_max(tmax_cube)[0])
+    dadm = rolling_mean(tmax_cube, window)
+    mwmt, mwmt_col = _row_max(dadm)
+    columns += [mwmt, np.where(mwmt_col >= 0, mwmt_col + first_doy, np.nan)]
+    if tmean_cube is not None:
+        mwat, mwat_col = _row_max(rolling_mean(day_axis(doy_list, tmean_cube)[0], window))
+        columns += [mwat, np.where(mwat_col >= 0, mwat_col + first_doy, np.nan)]
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        # (reaches x days x thresholds) comparisons, summed over days
+        columns += list((tmax_cube[:, :, np.newaxis] > thresholds).sum(axis=1).T)
+        columns += list((dadm[:, :, np.newaxis] > thresholds).sum(axis=1).T)
+    return np.column_stack(columns)
+
+
+def metrics_table(tmax_csv, out_csv, thresholds=METRIC_THRESHOLDS, window=METRIC_WINDOW, tmean_csv=None,
+                  chunk_rows=METRIC_CHUNK_ROWS):
+    """Builds a table of thermal metrics per reach from a year of predicted daily maximum stream
+    temperatures (and optionally daily means), in one pass over the prediction tables. A prediction
+    table has the reach ID in the first column and one column per DOY; the reaches are read chunk_rows
+    at a time, so the whole table is never held in memory."""
+    print "Computing thermal metrics..."
+    tmax_file = open(tmax_csv, 'rb')
+    tmean_file = open(tmean_csv, 'rb') if tmean_csv is not None else None
+    try:
+        tmax_reader = csv.reader(tmax_file)
+        doy_list = [int(float(d)) for d in next(tmax_reader)[1:]]
+        tmean_reader = None
+        if tmean_file is not None:
+            tmean_reader = csv.reader(tmean_file)
+            next(tmean_reader)
+        with open(out_csv, 'wb') as out_file:
+            writer = csv.writer(out_file, delimiter=',')
+            writer.writerow(['REACH_ID'] + metric_names(thresholds, tmean_file is not None))
+            while True:
+                rows = [r for _, r in zip(range(chunk_rows), tmax_reader)]
+                if not rows:
+                    break
+                tmax_cube = np.array([[float(v) if v != '' else np.nan for v in r[1:]] for r in rows])
+                tmean_cube = None
+                if tmean_reader is not None:
+                    tmean_rows = [r for _, r in zip(range(len(rows)), tmean_reader)]
+                    tmean_cube = np.array([[float(v) if v != '' else np.nan for v in r[1:]] for r in tmean_rows])
+                metrics = thermal_metrics(tmax_cube, doy_list, thresholds, window, tmean_cube)
+                for r, values in zip(rows, metrics):
+                    writer.writerow([r[0]] + ['' if np.isnan(v) else '%.2f' % v for v in values])
+    finally:
+        tmax_file.close()
+        if tmean_file is not None:
+            tmean_file.close()
+    return out_csv
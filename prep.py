@@ -24,57 +24,251 @@
 import os
 import sys
 import csv
+import multiprocessing
 import gdal
 import gdalconst
 import ogr
 import osr
 import numpy as np
+import lib.spatial_index as spatial_index
+import lib.modis_grid as modis_grid
 
 # Drainage polygon shapefile to summarize values (i.e. watersheds, RCAs, etc.): ')
 geo_rca = ""
 
-
-def convert_hdf(proj_dir, dir_list, hdf_filepath_list, hdf_filename_list):
-    """Converts downloaded HDF file into geotiff file format."""
+# MODIS LST sub-datasets and scaling (MOD11 User's Guide, collection 6)
+# LST/QC sub-dataset pairs written to the output geotiff, one band per pair and platform
+INGEST_SDS = [('LST_Day_1km', 'QC_Day'),
+              ('LST_Night_1km', 'QC_Night')]
+PLATFORM_PREFIX = ['MOD', 'MYD'] # Terra, Aqua (band order of the output geotiff)
+MERGED_PREFIX = 'MCD' # used in output file names when Terra and Aqua are merged
+LST_SCALE = 0.02        # scale factor, digital number to Kelvin
+LST_FILL = 0            # fill value for cells with no LST retrieval
+KELVIN_OFFSET = 273.15
+
+# Compact LST representation. With compact=True, LST stays as the MODIS uint16 digital number
+# (Kelvin / LST_SCALE) in rasters, cubes and tables, with LST_NODATA as the single no-data value
+# for rejected, missing and clipped cells. Use decode_lst to convert to degrees C at model time.
+LST_NODATA = 0
+
+# QC bit-mask filter. Cells are kept where (QC & QC_MASK) == QC_GOOD. The default
+# keeps cells whose mandatory QA flags (bits 0-1) are "LST produced, good quality".
+# Use QC_MASK = 0b10000010, QC_GOOD = 0b00000000 to also keep "other quality" cells
+# with an average LST error (bits 6-7) of <= 2K.
+QC_MASK = 0b00000011
+QC_GOOD = 0b00000000
+
+# Number of days in a local LST composite. 8 matches the MOD11A2 product periods (DOY 1, 9, 17...)
+COMPOSITE_PERIOD = 8
+
+# Tiled output rasters for web maps
+BLOCK_SIZE = 256 # internal tile size of tiled geotiffs
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+XYZ_ZOOM = '6-12' # zoom levels of XYZ tile pyramids
+XYZ_SCALE = (-10, 40) # degrees C range mapped to the 8-bit XYZ tile values 1-255
+GDAL2TILES_XYZ_VERSION = 3010000 # gdal2tiles.py --xyz needs GDAL 3.1 or later
+
+# Parallel reprojection into a memory-mapped LST cube (cells x dates)
+REPROJECT_PROCESSES = None # worker processes, None for one per CPU
+CUBE_FILE = 'LST_cube_%s.dat' # formatted with a run ID, so concurrent runs never share a cube
+
+# MODIS sinusoidal grid (MODIS Land grid, 36 x 18 tiles of 1200 x 1200 1km cells)
+MODIS_SIN_PROJ4 = '+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 +b=6371007.181 +units=m +no_defs'
+MODIS_XMIN = modis_grid.XMIN
+MODIS_YMAX = modis_grid.YMAX
+MODIS_TILE_SIZE = modis_grid.TILE_SIZE # tile width and height, in meters
+MODIS_CELL_SIZE = modis_grid.CELL_SIZE # 1km cell size, in meters
+
+
+def get_subdataset(src_subdatasets, sds_name):
+    """Returns the full GDAL name of an HDF sub-dataset, matched on the sub-dataset short name."""
+    for sds_fullname, sds_desc in src_subdatasets:
+        if sds_fullname.split(':')[-1] == sds_name:
+            return sds_fullname
+    raise ValueError("Sub-dataset %s not found in HDF file." % sds_name)
+
+
+def decode_lst(lst_array):
+    """Converts compact LST digital numbers to degrees C as float32, with NaN for LST_NODATA cells."""
+    lst_array = np.asarray(lst_array)
+    out_array = lst_array.astype(np.float32) * LST_SCALE - KELVIN_OFFSET
+    out_array[lst_array == LST_NODATA] = np.nan
+    return out_array
+
+
+def encode_lst(lst_array):
+    """Converts degrees C to compact LST digital numbers (uint16), with LST_NODATA for NaN cells."""
+    lst_array = np.asarray(lst_array, dtype=np.float32)
+    valid = ~np.isnan(lst_array)
+    out_array = np.empty(lst_array.shape, dtype=np.uint16)
+    out_array.fill(LST_NODATA)
+    out_array[valid] = np.clip(np.round((lst_array[valid] + KELVIN_OFFSET) / LST_SCALE), 1, 65535)
+    return out_array
+
+
+def qc_filter(lst_array, qc_array, qc_mask=QC_MASK, qc_good=QC_GOOD, compact=False):
+    """Applies the QC bit-mask to raw LST digital numbers and converts the accepted cells to degrees C.
+    A cell is kept where (QC & qc_mask) == qc_good and the LST value is not the fill value. Rejected
+    cells are returned as NaN. With compact=True, the digital numbers are returned unconverted as uint16,
+    with LST_NODATA for rejected cells."""
+    lst_array = np.asarray(lst_array)
+    qc_array = np.asarray(qc_array)
+    keep = ((qc_array & qc_mask) == qc_good) & (lst_array != LST_FILL)
+    if compact:
+        return np.where(keep, lst_array, LST_NODATA).astype(np.uint16)
+    out_array = np.empty(lst_array.shape, dtype=np.float32)
+    out_array.fill(np.nan)
+    out_array[keep] = lst_array[keep].astype(np.float32) * LST_SCALE - KELVIN_OFFSET
+    return out_array
+
+
+def qc_weights(qc_array, qc_mask=QC_MASK, qc_good=QC_GOOD):
+    """Converts QC flags to compositing weights, based on the average LST error in bits 6-7 of the QC
+    flags (<= 1K, <= 2K, <= 3K, > 3K are weighted 1, 1/4, 1/9 and 1/16). Cells rejected by the QC
+    bit-mask filter are given a weight of 0."""
+    qc_array = np.asarray(qc_array)
+    lst_error = ((qc_array >> 6) & 0b11).astype(np.float32)
+    weight_array = 1.0 / np.square(lst_error + 1.0)
+    weight_array[(qc_array & qc_mask) != qc_good] = 0.0
+    return weight_array.astype(np.float32)
+
+
+def qc_weight_band(band, platform_count, sds_list=INGEST_SDS):
+    """Returns the band number of the QC weights of LST band number band, in a geotiff written by
+    convert_hdf with with_weights=True from the HDF files of platform_count platforms. The weight bands
+    follow the LST bands, in the same order."""
+    return band + platform_count * len(sds_list)
+
+
+def lst_band(found_platforms, platform=None, sds_name=INGEST_SDS[0][0], sds_list=INGEST_SDS):
+    """Returns the band number of an LST sub-dataset (i.e. 'LST_Night_1km') of one platform (a prefix in
+    PLATFORM_PREFIX) in a geotiff written by convert_hdf from granules of the platforms in found_platforms.
+    With platform=None, the first platform found is used, so Terra if there are Terra granules and
+    Aqua otherwise."""
+    platform_list = [p for p in PLATFORM_PREFIX if p in found_platforms]
+    if platform is None and platform_list:
+        platform = platform_list[0]
+    if platform not in platform_list:
+        raise ValueError("No %s granules were converted." % platform)
+    sds_names = [sds[0] for sds in sds_list]
+    if sds_name not in sds_names:
+        raise ValueError("Sub-dataset %s is not in the converted geotiffs." % sds_name)
+    return platform_list.index(platform) * len(sds_list) + sds_names.index(sds_name) + 1
+
+
+def group_granules(hdf_filepath_list, hdf_filename_list):
+    """Groups HDF files by acquisition date and tile, so Terra and Aqua granules for the same day are
+    processed together. Returns a dictionary of {(date, tile): {platform prefix: filepath}}."""
+    granule_dict = {}
+    for in_filepath, in_filename in zip(hdf_filepath_list, hdf_filename_list):
+        name_split = in_filename.split(".")
+        platform = name_split[0][:3]
+        granule_dict.setdefault((name_split[1], name_split[2]), {})[platform] = in_filepath
+    return granule_dict
+
+
+def read_hdf_bands(in_filepath, sds_list, qc_mask=QC_MASK, qc_good=QC_GOOD, compact=False, with_weights=False):
+    """Opens an HDF file once and reads every LST/QC sub-dataset pair in sds_list into a QC filtered
+    array of degrees C. With with_weights=True, the QC weight arrays of the pairs (see qc_weights) follow
+    the LST arrays. Returns the list of arrays with the geotransform and projection of the file."""
+    src_open = gdal.Open(in_filepath, gdalconst.GA_ReadOnly) # open file with all sub-datasets
+    src_subdatasets = src_open.GetSubDatasets() # make a list of sub-datasets in the HDF file
+    band_list = []
+    weight_list = []
+    for lst_sds, qc_sds in sds_list:
+        subdataset = gdal.Open(get_subdataset(src_subdatasets, lst_sds))
+        qc_subdataset = gdal.Open(get_subdataset(src_subdatasets, qc_sds))
+        src_array = subdataset.GetRasterBand(1).ReadAsArray()
+        qc_array = qc_subdataset.GetRasterBand(1).ReadAsArray()
+        band_list.append(qc_filter(src_array, qc_array, qc_mask, qc_good, compact))
+        if with_weights:
+            weight_list.append(qc_weights(qc_array, qc_mask, qc_good))
+    return band_list + weight_list, subdataset.GetGeoTransform(), subdataset.GetProjection()
+
+
+def convert_hdf(proj_dir, dir_list, hdf_filepath_list, hdf_filename_list,
+                sds_list=INGEST_SDS, qc_mask=QC_MASK, qc_good=QC_GOOD, compact=False, with_weights=False):
+    """Converts MODIS HDF files to a multi-band geotiff format. Each HDF file is read once, and every
+    LST/QC sub-dataset pair in sds_list is QC filtered and written as degrees C (or, with compact=True,
+    as UInt16 digital numbers with LST_NODATA as no data). Terra and Aqua granules for the same date and
+    tile are merged into one geotiff, with bands ordered by platform and then by sub-dataset (i.e. MOD day,
+    MOD night, MYD day, MYD night). With with_weights=True, the compositing weights of each LST band (see
+    qc_weights) are written as extra bands after the LST bands, in the same order (see qc_weight_band).
+    Weights are fractions, so they cannot be combined with compact=True."""
     src_xres = None
     src_yres = None
     geotiff_list = []
-    """Converts MODIS HDF files to a geotiff format."""
+    if compact and with_weights:
+        raise ValueError("QC weight bands are Float32, so they cannot be written to compact (UInt16) geotiffs.")
     print "Converting MODIS HDF files to geotiff format..."
     out_format = 'GTiff'
-    local_array = zip(hdf_filepath_list, hdf_filename_list)
-
-    for dir in dir_list:
-        for in_filepath, out_filename in local_array:
-
-            # Open the LST_Day_1km dataset
-            src_open = gdal.Open(in_filepath, gdalconst.GA_ReadOnly) # open file with all sub-datasets
-            src_subdatasets = src_open.GetSubDatasets() # make a list of sub-datasets in the HDF file
-            subdataset = gdal.Open(src_subdatasets[0][0])
-
-            # Get parameters from LST dataset
-            src_cols = subdataset.RasterXSize
-            src_rows = subdataset.RasterYSize
-            src_band_count = subdataset.RasterCount
-            src_geotransform = subdataset.GetGeoTransform()
-            src_xres = src_geotransform[1]
-            src_yres = src_geotransform[5]
-            src_proj = subdataset.GetProjection()
-
-            # Read dataset to array
-            src_band = subdataset.GetRasterBand(1)
-            src_array = src_band.ReadAsArray(0, 0, src_cols, src_rows).astype(np.float)
+    if compact:
+        out_type, out_nodata = gdal.GDT_UInt16, LST_NODATA
+    else:
+        out_type, out_nodata = gdal.GDT_Float32, float('nan')
+    driver = gdal.GetDriverByName(out_format)
+    granule_dict = group_granules(hdf_filepath_list, hdf_filename_list)
+
+    # use the same band layout for every date, based on all platforms found in the HDF file list
+    found_platforms = set([p for platform_dict in granule_dict.values() for p in platform_dict])
+    platform_list = [p for p in PLATFORM_PREFIX if p in found_platforms]
+    if not platform_list:
+        print "No Terra (MOD) or Aqua (MYD) HDF files to convert."
+        return geotiff_list, src_xres, src_yres
+    if len(platform_list) > 1:
+        out_prefix = MERGED_PREFIX
+    else:
+        out_prefix = platform_list[0]
+
+    for (acq_date, tile), platform_dict in sorted(granule_dict.items()):
+        if not any(p in platform_dict for p in platform_list):
+            continue # only granules of other platforms on this date
+
+        # Read all sub-datasets from each platform's HDF file
+        cube = []
+        for platform in platform_list:
+            if platform in platform_dict:
+                band_list, src_geotransform, src_proj = read_hdf_bands(platform_dict[platform], sds_list,
+                                                                       qc_mask, qc_good, compact, with_weights)
+                cube.append(band_list)
+            else:
+                cube.append(None)
+        src_rows, src_cols = [b for b in cube if b is not None][0][0].shape
+        src_xres = src_geotransform[1]
+        src_yres = src_geotransform[5]
+
+        # Product name (i.e. MOD11A1) from any granule in the group
+        in_filename = os.path.basename(platform_dict.values()[0])
+        product = out_prefix + in_filename.split(".")[0][3:]
 
+        for dir in dir_list:
             # Set up output file
-            driver = gdal.GetDriverByName(out_format)
-            #out_file = "%s\%s.%s" % (dir, out_filename, "tif")
-            filename = os.path.splitext(out_filename)
-            out_file = os.path.join(dir, filename[0] + ".tif")
-            out_geotiff = driver.Create(out_file, src_cols, src_rows, src_band_count, gdal.GDT_Float32)
+            out_file = os.path.join(dir, "%s.%s.%s.tif" % (product, acq_date, tile))
+            band_count = len(platform_list) * len(sds_list)
+            if with_weights:
+                band_count *= 2
+            out_geotiff = driver.Create(out_file, src_cols, src_rows, band_count, out_type)
             out_geotiff.SetGeoTransform(src_geotransform)
             out_geotiff.SetProjection(src_proj)
-            out_geotiff.GetRasterBand(1).WriteArray(src_array)
+            band_num = 1
+            for platform, band_list in zip(platform_list, cube):
+                for i, (lst_sds, qc_sds) in enumerate(sds_list):
+                    # (band number, description, index in band_list) of the LST band and its weights
+                    out_list = [(band_num, "%s %s" % (platform, lst_sds), i)]
+                    if with_weights:
+                        out_list.append((qc_weight_band(band_num, len(platform_list), sds_list),
+                                         "%s %s QC weight" % (platform, lst_sds), len(sds_list) + i))
+                    for out_num, description, array_index in out_list:
+                        out_band = out_geotiff.GetRasterBand(out_num)
+                        out_band.SetDescription(description)
+                        out_band.SetNoDataValue(out_nodata)
+                        if band_list is not None:
+                            out_band.WriteArray(band_list[array_index])
+                        else:  # no granule from this platform on this date
+                            out_band.Fill(out_nodata)
+                    band_num += 1
             out_geotiff.FlushCache()
+            out_geotiff = None
 
             # Create list of output geotiffs
             geotiff_list.append(out_file)
@@ -93,20 +287,30 @@ def build_mosaic_io_array(geotiff_list, hdf_dates):
     return mosaic_io_array
 
 
-def convert_to_vrt(mosaic_io_array, swath_ids, input_dir, dir_list, modis_wkt):
-    """Generates mosaics as GDAL VRT files for MODIS tiles collected on the same day."""
+def convert_to_vrt(mosaic_io_array, swath_ids, input_dir, dir_list, modis_wkt, sin_bbox_list=None):
+    """Generates mosaics as GDAL VRT files for MODIS tiles collected on the same day. If a bounding box in
+    MODIS sinusoidal coordinates is supplied (see get_sin_bbox), the VRT only covers that window."""
     print "Generating GDAL VRT files from geotiffs..."
     out_vrt_list = []
     # iterate through list of geotiff file names
     for row in mosaic_io_array:
         for dir in dir_list:
+            out_vrt = os.path.join(dir, row[-1] + ".vrt")
             if len(swath_ids) > 1: # if more than one geotiff in list, mosaic into a vrt file
-                in_rasters = ' '.join(row[0:2])
-                out_vrt = os.path.join(dir, row[2] + ".vrt")
-                expr = 'gdalbuildvrt -a_srs %s %s %s' % (modis_wkt, out_vrt, in_rasters)
+                in_rasters = ' '.join(row[:-1])
+                if sin_bbox_list:
+                    expr = 'gdalbuildvrt -a_srs %s -te %f %f %f %f %s %s' % \
+                           (modis_wkt, sin_bbox_list[0], sin_bbox_list[2], sin_bbox_list[1], sin_bbox_list[3],
+                            out_vrt, in_rasters)
+                else:
+                    expr = 'gdalbuildvrt -a_srs %s %s %s' % (modis_wkt, out_vrt, in_rasters)
             else:  # otherwise, just convert the geotiff to a vrt file
-                out_vrt = os.path.join(dir, row[2] + ".vrt")
-                expr = 'gdal_translate -of %s -a_srs %s %s %s' % ("VRT", modis_wkt, row[0], out_vrt)
+                if sin_bbox_list:
+                    expr = 'gdal_translate -of %s -a_srs %s -projwin %f %f %f %f %s %s' % \
+                           ("VRT", modis_wkt, sin_bbox_list[0], sin_bbox_list[3], sin_bbox_list[1], sin_bbox_list[2],
+                            row[0], out_vrt)
+                else:
+                    expr = 'gdal_translate -of %s -a_srs %s %s %s' % ("VRT", modis_wkt, row[0], out_vrt)
             os.system(expr)
             out_vrt_list.append(out_vrt)
     return out_vrt_list
@@ -115,18 +319,21 @@ def convert_to_vrt(mosaic_io_array, swath_ids, input_dir, dir_list, modis_wkt):
 def get_poly_wkt(in_poly):
     """Obtain the projection of the drainage polygon dataset as a WKT projection file."""
     print "Getting projection of drainage polygon dataset..."
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-    open_poly = driver.Open(in_poly)
-    lyr = open_poly.GetLayer()
-    spatialRef = lyr.GetSpatialRef()
+    spatialRef = spatial_index.open_layer_index(in_poly).spatial_ref
     poly_proj4 = spatialRef.ExportToProj4()
     poly_wkt = '"' + poly_proj4 + '"'
     return poly_wkt
 
 
-def reproject_rasters(in_vrt_list, input_dir, dir_list, modis_wkt, poly_wkt, bbox_list, xres, yres, in_ply):
-    """Re-projects VRT mosaics to same projection as drainage polygons, then clips extent to polygon envelope."""
+def reproject_rasters(in_vrt_list, input_dir, dir_list, modis_wkt, poly_wkt, bbox_list, xres, yres, in_ply,
+                      compact=False):
+    """Re-projects VRT mosaics to same projection as drainage polygons, then clips extent to polygon envelope.
+    With compact=True, the UInt16 mosaics keep LST_NODATA as their no-data value."""
     print "Reprojecting VRT mosaics..."
+    if compact:
+        nodata = LST_NODATA
+    else:
+        nodata = -999
     xmin = bbox_list[0]
     xmax = bbox_list[1]
     ymin = bbox_list[2]
@@ -134,17 +341,195 @@ def reproject_rasters(in_vrt_list, input_dir, dir_list, modis_wkt, poly_wkt, bbo
     out_reprj_list = []
     for in_vrt in in_vrt_list:
         out_file = '%s_%s.%s' % (in_vrt, "reprj", 'tif')
-        expr = 'gdalwarp -overwrite -t_srs %s -tr %f %f -r %s -of %s -dstnodata %d -cutline %s -cblend %d %s %s' % \
-               (poly_wkt, xres, yres, 'bilinear', 'GTiff', -999, in_ply, 5, in_vrt, out_file)
-        """
-        expr = 'gdalwarp -overwrite -t_srs %s -te %f %f %f %f -tr %f %f -r %s -of %s -dstnodata %d -cutline %s %s %s' % \
-               (poly_wkt, xmin, ymin, xmax, ymax, xres, yres, 'bilinear', 'GTiff', 0, in_ply, in_vrt, out_file)
-        """
+        expr = 'gdalwarp -overwrite -t_srs %s -te %f %f %f %f -tr %f %f -r %s -of %s -dstnodata %d -cutline %s -cblend %d %s %s' % \
+               (poly_wkt, xmin, ymin, xmax, ymax, xres, yres, 'bilinear', 'GTiff', nodata, in_ply, 5, in_vrt, out_file)
         os.system(expr)
         out_reprj_list.append(out_file)
     return out_reprj_list
 
 
+_worker_cube = None
+
+
+def _init_cube_worker(cube_file, shape, dtype=np.float32):
+    """Opens the parent's LST cube in a reprojection worker process."""
+    global _worker_cube
+    _worker_cube = np.memmap(cube_file, dtype=dtype, mode='r+', shape=shape, order='F')
+
+
+def lst_missing(lst_array):
+    """Returns a boolean array marking the cells of an LST array without a value: LST_NODATA for compact
+    (integer) arrays, NaN for degrees C arrays."""
+    lst_array = np.asarray(lst_array)
+    if lst_array.dtype.kind in 'ui':
+        return lst_array == LST_NODATA
+    return np.isnan(lst_array)
+
+
+def _warp_to_cube(args):
+    """Reprojects one date's VRT mosaic in memory and writes it into that date's column of the LST cube.
+    Only the file names and the warp options are passed to the worker, and only a cell count is returned."""
+    col, in_vrt, warp_options, band, compact = args
+    warped = gdal.Warp('', in_vrt, format='MEM', **warp_options)
+    lst_array = warped.GetRasterBand(band).ReadAsArray()
+    warped = None
+    if compact:
+        lst_array = lst_array.astype(np.uint16)
+    else:
+        lst_array = lst_array.astype(np.float32)
+        lst_array[lst_array == warp_options['dstNodata']] = np.nan
+    # the cube is stored by column, so each date is one contiguous block of the file
+    _worker_cube[:, col] = lst_array.ravel()
+    _worker_cube.flush()
+    return int(np.count_nonzero(~lst_missing(lst_array)))
+
+
+def reproject_to_cube(in_vrt_list, poly_wkt, bbox_list, xres, yres, in_ply, cube_file, processes=REPROJECT_PROCESSES,
+                      band=1, compact=False):
+    """Re-projects and clips VRT mosaics like reproject_rasters, with one worker process per date, and
+    writes the LST values (degrees C, NaN for no data) straight into a memory-mapped cube of cells x dates
+    owned by this process, instead of writing a geotiff per date and reading it back for LST_to_xyz.
+    Cells are the output grid cells in row-major order. With compact=True, the UInt16 mosaics are copied
+    into a UInt16 cube of digital numbers, with LST_NODATA for no data, at half the size of a Float32 cube.
+    Returns the cube and an array of cell centre X, Y coordinates."""
+    print "Reprojecting VRT mosaics into the LST cube..."
+    xmin, xmax, ymin, ymax = bbox_list
+    cols = int(round((xmax - xmin) / abs(xres)))
+    rows = int(round((ymax - ymin) / abs(yres)))
+    shape = (rows * cols, len(in_vrt_list))
+    if compact:
+        dtype, nodata, fill = np.uint16, LST_NODATA, LST_NODATA
+    else:
+        dtype, nodata, fill = np.float32, -999, np.nan
+    cube = np.memmap(cube_file, dtype=dtype, mode='w+', shape=shape, order='F')
+    cube[:] = fill
+    cube.flush()
+    del cube
+
+    warp_options = {'dstSRS': poly_wkt.strip('"'), 'outputBounds': (xmin, ymin, xmax, ymax),
+                    'width': cols, 'height': rows, 'resampleAlg': 'bilinear', 'dstNodata': nodata,
+                    'cutlineDSName': in_ply, 'cutlineBlend': 5}
+    pool = multiprocessing.Pool(processes, _init_cube_worker, (cube_file, shape, dtype))
+    try:
+        pool.map(_warp_to_cube, [(col, in_vrt, warp_options, band, compact)
+                                 for col, in_vrt in enumerate(in_vrt_list)])
+    finally:
+        pool.close()
+        pool.join()
+
+    cube = np.memmap(cube_file, dtype=dtype, mode='r+', shape=shape, order='F')
+    x = xmin + (np.arange(cols) + 0.5) * abs(xres)
+    y = ymax - (np.arange(rows) + 0.5) * abs(yres)
+    xy_array = np.column_stack([np.tile(x, rows), np.repeat(y, cols)])
+    return cube, xy_array
+
+
+def cube_to_LST_table(lst_cube, xy_array, date_list, out_file, block_rows=10000, mask_cube=None):
+    """Writes an LST cube from reproject_to_cube to out_file as an LST table with the layout of
+    compile_LST_table (UID, X, Y and one column per DOY). date_list has the acquisition date of each
+    column (i.e. A2016001), and all dates must be in the same year, as the columns are DOYs. Cells
+    without any LST value are left out, and UIDs are the cell numbers of the grid. If a mask cube is
+    given (i.e. the LST cube, when writing a QC weight cube), values are only written where the mask
+    cube has values, so the table has the same rows as the table of the mask cube. A compact cube
+    (UInt16, see reproject_to_cube) is written as a compact table of digital numbers, to be read with
+    read_LST_table(compact=True)."""
+    print "Building LST interpolation input table..."
+    year_list = sorted(set(d[-7:-3] for d in date_list))
+    if len(year_list) > 1:
+        raise ValueError("An LST table holds one year, but the dates span %s." % ', '.join(year_list))
+    with open(out_file, 'wb') as out_csv:
+        writer = csv.writer(out_csv, delimiter=',')
+        writer.writerow(["UID", "X", "Y"] + [str(int(d[-3:])) for d in date_list])
+        for start in range(0, len(lst_cube), block_rows):
+            block = np.asarray(lst_cube[start:start + block_rows])
+            missing = lst_missing(block)
+            if mask_cube is not None:
+                missing |= lst_missing(mask_cube[start:start + block_rows])
+            if block.dtype.kind in 'ui':
+                value_format = '%d'
+            else:
+                value_format = '%.2f'
+            for i in np.nonzero(~missing.all(axis=1))[0]:
+                writer.writerow([str(start + i + 1), '%.6f' % xy_array[start + i, 0], '%.6f' % xy_array[start + i, 1]] +
+                                ['' if m else value_format % v for v, m in zip(block[i], missing[i])])
+    print "Data pre-processing complete!"
+    return out_file
+
+
+def tms_to_xyz(tile_dir):
+    """Renames the tiles of a TMS tile pyramid (z/x/y, with y counted from the south) to the XYZ scheme,
+    with y counted from the north, for gdal2tiles.py versions without the --xyz option."""
+    for z_name in os.listdir(tile_dir):
+        if not z_name.isdigit():
+            continue
+        y_max = 2 ** int(z_name) - 1
+        z_dir = os.path.join(tile_dir, z_name)
+        for x_name in os.listdir(z_dir):
+            x_dir = os.path.join(z_dir, x_name)
+            if not os.path.isdir(x_dir):
+                continue
+            tile_list = [f for f in os.listdir(x_dir) if os.path.splitext(f)[0].isdigit()]
+            # in two steps, as a flipped y can be the name of another tile
+            for tile in tile_list:
+                os.rename(os.path.join(x_dir, tile), os.path.join(x_dir, tile + '.tms'))
+            for tile in tile_list:
+                (y, ext) = os.path.splitext(tile)
+                os.rename(os.path.join(x_dir, tile + '.tms'), os.path.join(x_dir, '%d%s' % (y_max - int(y), ext)))
+    return
+
+
+def tile_rasters(in_raster_list, xyz_dir=None, zoom=XYZ_ZOOM):
+    """Writes a tiled, compressed copy of each raster with internal overviews, in the cloud-optimized geotiff
+    layout (overviews ahead of full resolution data), so a web map can read only the tiles and zoom level it
+    needs. If xyz_dir is given, a static XYZ tile pyramid is also written for each raster, in a sub-directory
+    named after the raster. Rasters with an integer band type are taken to be compact LST rasters (UInt16
+    digital numbers, see encode_lst)."""
+    print "Writing tiled rasters with overviews..."
+    out_tiled_list = []
+    for in_raster in in_raster_list:
+        in_base = os.path.splitext(in_raster)[0]
+        out_file = '%s_%s.%s' % (in_base, "tiled", 'tif')
+        band_type = gdal.Open(in_raster).GetRasterBand(1).DataType
+        compact = band_type not in (gdal.GDT_Float32, gdal.GDT_Float64)
+        # floating point predictor for degrees C, horizontal differencing for digital numbers
+        if compact:
+            predictor = 2
+        else:
+            predictor = 3
+
+        # build overviews in an external .ovr file, which gdal_translate copies into the output
+        expr = 'gdaladdo -ro -r %s %s %s' % ('average', in_raster, ' '.join(str(l) for l in OVERVIEW_LEVELS))
+        os.system(expr)
+        expr = 'gdal_translate -of %s -co TILED=YES -co BLOCKXSIZE=%d -co BLOCKYSIZE=%d -co COMPRESS=DEFLATE ' \
+               '-co PREDICTOR=%d -co COPY_SRC_OVERVIEWS=YES %s %s' % \
+               ('GTiff', BLOCK_SIZE, BLOCK_SIZE, predictor, in_raster, out_file)
+        os.system(expr)
+        if os.path.exists(in_raster + '.ovr'):
+            os.remove(in_raster + '.ovr')
+        out_tiled_list.append(out_file)
+
+        if xyz_dir is not None:
+            # XYZ tiles are 8-bit images, so LST values are scaled to 1-255, with 0 as no data. Compact
+            # digital numbers are decoded on the way, by scaling from the digital numbers of XYZ_SCALE
+            if compact:
+                scale_min, scale_max = [(t + KELVIN_OFFSET) / LST_SCALE for t in XYZ_SCALE]
+            else:
+                scale_min, scale_max = XYZ_SCALE
+            byte_vrt = '%s_%s.%s' % (in_base, "byte", 'vrt')
+            expr = 'gdal_translate -of %s -ot Byte -scale %f %f 1 255 -a_nodata 0 %s %s' % \
+                   ("VRT", scale_min, scale_max, out_file, byte_vrt)
+            os.system(expr)
+            out_tile_dir = os.path.join(xyz_dir, os.path.basename(in_base))
+            if int(gdal.VersionInfo()) >= GDAL2TILES_XYZ_VERSION:
+                expr = 'gdal2tiles.py --xyz -z %s -w none %s %s' % (zoom, byte_vrt, out_tile_dir)
+                os.system(expr)
+            else: # older gdal2tiles.py only writes TMS tiles
+                expr = 'gdal2tiles.py -z %s -w none %s %s' % (zoom, byte_vrt, out_tile_dir)
+                os.system(expr)
+                tms_to_xyz(out_tile_dir)
+    return out_tiled_list
+
+
 def get_first_acq_date(mosaic_io_array):
     '''Get julian date from the mosaicked geotiff file name array'''
     acq_year = mosaic_io_array[0][1]
@@ -152,8 +537,13 @@ def get_first_acq_date(mosaic_io_array):
     return acq_date
 
 
-def LST_to_xyz(in_reprj_list, input_dir, dir_list):
-    """Converts a mosaicked, reprojected LST geotiff into XYZ points in a CSV file format."""
+def LST_to_xyz(in_reprj_list, input_dir, dir_list, compact=False, band=1):
+    """Converts a mosaicked, reprojected LST geotiff into XYZ points in a CSV file format. No-data cells
+    (-999, or LST_NODATA with compact=True) are left out. band selects the LST band (see lst_band)."""
+    if compact:
+        nodata = str(LST_NODATA)
+    else:
+        nodata = '-999'
     print "Converting a geotiff to a XYZ point file..."
     import lib.gdal2xyz as gdal2xyz
     out_csv_list = []
@@ -163,7 +553,7 @@ def LST_to_xyz(in_reprj_list, input_dir, dir_list):
         acq_date = tif_name_split[1][-3:]
         xyz_filename = '%s_%s.%s' % (tif_name_split[0], 'xyz', 'csv')
         csv_filename = '%s_%s.%s' % (tif_name_split[0], 'tbl', 'csv')
-        gdal2xyz.main(tif_file, xyz_filename)
+        gdal2xyz.main(tif_file, xyz_filename, band_nums=[band])
         with open(xyz_filename, 'rb') as input, open(csv_filename, 'wb') as output:
             reader = csv.reader(input, delimiter=' ')
             writer = csv.writer(output, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
@@ -171,7 +561,7 @@ def LST_to_xyz(in_reprj_list, input_dir, dir_list):
             all_rows.insert(0, ["UID", "X", "Y", str(acq_date)])
             #row = next(reader)
             for i, row in enumerate(reader):
-                if row[2] != '-999':
+                if row[2] != nodata:
                     all_rows.append([str(i + 1)] + row)
             writer.writerows(all_rows)
         out_csv_list.append(csv_filename)
@@ -184,13 +574,15 @@ def cell_centroids(in_lst_raster, out_pnt_shp, out_dir):
     '''Generates a point shapefile of centroids from a LST raster.
     Code derived from example @
     https://gis.stackexchange.com/questions/42790/gdal-and-python-how-to-get-coordinates-for-all-cells-having-a-specific-value'''
-    import numpy as np
-
     in_raster = gdal.Open(in_lst_raster) # in_lst_raster must include full filepath
-    (upper_left_x, x_size, x_rotation, upper_left_y, y_rotation, y_size) = in_raster.GetGeoTransform()
     band_LST = in_raster.GetRasterBand(1) # raster bands start at 1
-    array_LST = band_LST.ReadAsArray().astype(np.int16)
-    (y_index, x_index) = np.nonzero(array_LST) # FIXME should probably filter out no-data values (-36728?)
+    array_LST = band_LST.ReadAsArray() # keep the native data type, so no-data values are not altered
+    nodata = band_LST.GetNoDataValue()
+    has_value = ~np.isnan(array_LST) if array_LST.dtype.kind == 'f' else np.ones(array_LST.shape, dtype=bool)
+    if nodata is not None and not np.isnan(nodata):
+        has_value &= array_LST != nodata
+    (y_index, x_index) = np.nonzero(has_value)
+    (x_coords, y_coords) = modis_grid.pixel_centres(in_raster.GetGeoTransform(), y_index, x_index)
 
     # set up parameters for output centroid shapefile
     srs = osr.SpatialReference()
@@ -202,16 +594,13 @@ def cell_centroids(in_lst_raster, out_pnt_shp, out_dir):
 
     # processing loop
     fid = 0
-    for x, y in zip(x_index, y_index):
-        x_coord = x_index[x] * x_size + upper_left_x + (x_size / 2)  # add half the cell size
-        y_coord = y_index[y] * y_size + upper_left_y + (y_size / 2)  # center the point
-
+    for x_coord, y_coord in zip(x_coords, y_coords):
         point = ogr.Geometry(ogr.wkbPoint)
         point.SetPoint(0, x_coord, y_coord)
 
         feature = ogr.Feature(point_lyr_defn)
         feature.SetGeometry(point)
-        feature.SetFID(i)
+        feature.SetFID(fid)
 
         point_lyr.CreateFeature(feature)
 
@@ -239,8 +628,7 @@ def compile_LST_table(julian_csv_array, input_dir, dir_list):
     interpolation process."""
     print "Building LST interpolation input table..."
     acq_year = julian_csv_array[0][1]
-    out_dir = '%s\\%s\\' % (input_dir, dir_list[1])
-    out_file = '%s%s_%s.%s' % (out_dir, 'LST', acq_year, 'csv')
+    out_file = os.path.join(input_dir, dir_list[1], '%s_%s.%s' % ('LST', acq_year, 'csv'))
     first_filename = julian_csv_array[0][2]
     file1_rows = []
 
@@ -264,7 +652,7 @@ def compile_LST_table(julian_csv_array, input_dir, dir_list):
         for f in file1_rows:
             writer.writerow(f)
     print "Data pre-processing complete!"
-    return out_csv
+    return out_file
 
 
 def get_modis_wkt(modis_srs):
@@ -280,12 +668,141 @@ def get_bbox(in_poly):
     """Gets the extent envelope values of drainage polygons."""
     print "Calculating the extent envelope vaues of drainage polygon dataset..."
     bbox_list = []
-    in_driver = ogr.GetDriverByName("ESRI Shapefile")
-    in_ds = in_driver.Open(in_poly, 0)
-    in_lyr = in_ds.GetLayer()
-    (xmin, xmax, ymin, ymax) = in_lyr.GetExtent()
+    (xmin, xmax, ymin, ymax) = spatial_index.open_layer_index(in_poly).extent
     bbox_list.append(xmin)
     bbox_list.append(xmax)
     bbox_list.append(ymin)
     bbox_list.append(ymax)
-    return bbox_list
\ No newline at end of file
+    return bbox_list
+
+
+def get_modis_srs():
+    """Returns an OSR spatial reference for the MODIS sinusoidal projection."""
+    modis_srs = osr.SpatialReference()
+    modis_srs.ImportFromProj4(MODIS_SIN_PROJ4)
+    return modis_srs
+
+
+def get_sin_geometry(in_poly):
+    """Returns the drainage polygons as a single geometry collection in MODIS sinusoidal coordinates."""
+    poly_index = spatial_index.open_layer_index(in_poly)
+    poly_srs = poly_index.spatial_ref.Clone()
+    modis_srs = get_modis_srs()
+    for srs in (poly_srs, modis_srs):
+        if hasattr(srs, 'SetAxisMappingStrategy'): # GDAL 3 and later
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(poly_srs, modis_srs)
+    sin_geom = ogr.Geometry(ogr.wkbGeometryCollection)
+    for poly_geom in poly_index.geoms:
+        geom = poly_geom.Clone()
+        geom.Transform(transform)
+        sin_geom.AddGeometry(geom)
+    return sin_geom
+
+
+def get_rca_tiles(in_poly):
+    """Returns a sorted list of the MODIS tiles (i.e. h09v04) that intersect the drainage polygons. The
+    list can be used as the swath list when downloading HDF files."""
+    print "Finding MODIS tiles that intersect the drainage polygon dataset..."
+    sin_geom = get_sin_geometry(in_poly)
+    tile_list = []
+    for (h, v) in modis_grid.bbox_tiles(*sin_geom.GetEnvelope()):
+        (tile_xmin, tile_xmax, tile_ymin, tile_ymax) = modis_grid.tile_bounds(h, v)
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for (x, y) in ((tile_xmin, tile_ymax), (tile_xmax, tile_ymax), (tile_xmax, tile_ymin),
+                       (tile_xmin, tile_ymin), (tile_xmin, tile_ymax)):
+            ring.AddPoint(x, y)
+        tile_poly = ogr.Geometry(ogr.wkbPolygon)
+        tile_poly.AddGeometry(ring)
+        if tile_poly.Intersects(sin_geom):
+            tile_list.append(modis_grid.tile_name(h, v))
+    return sorted(tile_list)
+
+
+def get_sin_bbox(in_poly, buffer_cells=2):
+    """Gets the extent envelope values of drainage polygons in MODIS sinusoidal coordinates, buffered by
+    a number of cells and snapped to the MODIS 1km grid, in the same order as get_bbox."""
+    print "Calculating the MODIS sinusoidal extent of drainage polygon dataset..."
+    sin_geom = get_sin_geometry(in_poly)
+    sin_bbox_list = list(modis_grid.snap_bbox(*sin_geom.GetEnvelope(), buffer_cells=buffer_cells))
+    return sin_bbox_list
+
+
+def composite_lst(lst_cube, doy_list, period=COMPOSITE_PERIOD, weight_cube=None):
+    """Builds N-day composites from a cube of daily LST values, with one row per cell and one column
+    per date in doy_list. Composites are the weighted mean of the valid (non-NaN) daily values in each
+    period, using weights from qc_weights if a weight cube is supplied. Missing (NaN) weights count as
+    0. Periods start on DOY 1 and every N days after, and periods without valid values or with weights
+    of 0 are NaN. Returns the composite cube and a list of the first DOY of each period."""
+    lst_cube = np.asarray(lst_cube, dtype=np.float32)
+    period_index = (np.asarray(doy_list, dtype=np.int32) - 1) // period
+    period_list, date_period = np.unique(period_index, return_inverse=True)
+
+    # date-to-period indicator matrix, so the per-period sums are one matrix product
+    indicator = np.zeros((len(date_period), len(period_list)), dtype=np.float32)
+    indicator[np.arange(len(date_period)), date_period] = 1.0
+
+    valid = ~np.isnan(lst_cube)
+    if weight_cube is None:
+        weight_cube = valid.astype(np.float32)
+    else:
+        weight_cube = np.where(valid, np.nan_to_num(np.asarray(weight_cube, dtype=np.float32)), 0.0).astype(np.float32)
+    weight_sum = weight_cube.dot(indicator)
+    value_sum = (np.where(valid, lst_cube, 0.0) * weight_cube).dot(indicator)
+    composite_cube = np.empty(value_sum.shape, dtype=np.float32)
+    composite_cube.fill(np.nan)
+    has_value = weight_sum > 0
+    composite_cube[has_value] = value_sum[has_value] / weight_sum[has_value]
+    return composite_cube, [int(p) * period + 1 for p in period_list]
+
+
+def read_LST_table(in_csv, compact=False):
+    """Reads a compiled LST table (see compile_LST_table) into a list of [UID, X, Y] rows, a list of
+    DOYs and an array of LST values, with NaN for missing values. A compact table (UInt16 digital
+    numbers) is decoded to degrees C as it is read."""
+    if compact:
+        missing = ('', str(LST_NODATA))
+    else:
+        missing = ('', '-999')
+    id_rows = []
+    value_rows = []
+    with open(in_csv, 'rb') as in_file:
+        reader = csv.reader(in_file)
+        header = next(reader)
+        doy_list = [int(float(d)) for d in header[3:]]
+        for row in reader:
+            id_rows.append(row[:3])
+            value_rows.append([float(v) if v not in missing else np.nan for v in row[3:]])
+    lst_cube = np.array(value_rows, dtype=np.float32)
+    if compact:
+        lst_cube = lst_cube * LST_SCALE - KELVIN_OFFSET
+    return id_rows, doy_list, lst_cube
+
+
+def composite_LST_table(in_csv, out_csv, period=COMPOSITE_PERIOD, weight_csv=None, compact=False):
+    """Builds an N-day composite LST table from a daily LST table, so 8-day values do not need to be
+    downloaded and processed separately from the MOD11A2 product. An optional weight table, with the
+    same layout as the LST table, gives QC weights for the composites (see qc_weights). With compact=True,
+    the composites are written as compact digital numbers, like the input table."""
+    print "Building %d-day LST composite table..." % period
+    id_rows, doy_list, lst_cube = read_LST_table(in_csv, compact)
+    weight_cube = None
+    if weight_csv is not None:
+        weight_cube = read_LST_table(weight_csv)[2]
+    composite_cube, period_doy_list = composite_lst(lst_cube, doy_list, period, weight_cube)
+    with open(out_csv, 'wb') as out_file:
+        writer = csv.writer(out_file, delimiter=',')
+        writer.writerow(["UID", "X", "Y"] + [str(d) for d in period_doy_list])
+        if compact:
+            for id_row, values in zip(id_rows, encode_lst(composite_cube)):
+                writer.writerow(id_row + ['' if v == LST_NODATA else str(v) for v in values])
+        else:
+            for id_row, values in zip(id_rows, composite_cube):
+                writer.writerow(id_row + ['' if np.isnan(v) else '%.2f' % v for v in values])
+    return out_csv
+
+
+def find_rca(in_poly, x, y, id_field=None):
+    """Returns the IDs of the drainage polygons containing point x, y (in the polygon dataset's
+    coordinate system), using the shared in-memory spatial index of the polygon dataset."""
+    return spatial_index.open_layer_index(in_poly, id_field).point_query(x, y)
@@ -0,0 +1,506 @@
+#-------------------------------------------------------------------------------
+# Name:         process.py
+#
+# Summary:      The process module runs stream temperature model requests from the
+#               webSTeAMM front end as background jobs. Requests are queued and executed
+#               by a local pool of workers, and the front end polls or streams job progress
+#               using the job ID returned when the request was submitted.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# References:   McNyset, Kristina M., Carol J. Volk, and Chris E. Jordan. "Developing
+#               an Effective Model for Predicting Spatially and Temporally Continuous
+#               Stream Temperatures from Remotely Sensed Land Surface Temperatures."
+#               Water 7.12 (2015): 6827-6846.
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import glob
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import collections
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Global constants
+NUM_WORKERS = 2
+DEFAULT_MODEL = 'default'
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.steamm', 'results')
+CACHE_MAX_BYTES = 2 * 1024 ** 3 # on-disk size limit of the result cache
+CACHE_MEMORY_ITEMS = 64 # number of results also held in memory
+JOB_HISTORY = 1000 # finished jobs kept for status queries
+SHAPEFILE_EXTS = ['.shp', '.shx', '.dbf', '.prj']
+
+
+def job_key(basin, year_list, model, doy_start=1, doy_end=366, product='Daily'):
+    """Builds the key used to recognize identical requests (same RCA shapefile, years, DOY range, product
+    and model)."""
+    return (os.path.abspath(basin), tuple(sorted(str(y) for y in year_list)), model,
+            int(doy_start), int(doy_end), product)
+
+
+def hash_shapefile(in_shp):
+    """Returns a SHA-1 hash of the contents of a shapefile and its sidecar files, so an edited RCA layer
+    does not match results cached for an older version of the same file."""
+    file_hash = hashlib.sha1()
+    shp_base = os.path.splitext(in_shp)[0]
+    for ext in SHAPEFILE_EXTS:
+        if os.path.exists(shp_base + ext):
+            with open(shp_base + ext, 'rb') as shp_file:
+                for chunk in iter(lambda: shp_file.read(65536), b''):
+                    file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def print_report(percent, message):
+    """Job progress reporter that prints progress to the console."""
+    print "%3d%% %s" % (percent, message)
+
+
+def weight_table(lst_table):
+    """Returns the file path of the QC weight table written with an LST table by run_model_request."""
+    return os.path.join(os.path.dirname(lst_table), 'QCW' + os.path.basename(lst_table)[len('LST'):])
+
+
+def climatology_dir(project_dir, basin):
+    """Returns the climatology directory of the RCAs in basin. The grid cell UIDs of an LST table are
+    numbered within the bounding box of its basin, so each basin (name and shapefile contents) keeps its
+    own climatology rather than sharing one per project."""
+    return os.path.join(project_dir, 'climatology', '%s_%s' % (os.path.splitext(os.path.basename(basin))[0],
+                                                               hash_shapefile(basin)[:8]))
+
+
+def run_model_request(basin, year_list, model, report, project_dir, doy_start=1, doy_end=366, product='Daily',
+                      qc_weights=False, compact=False, platform=None, lst_sds='LST_Day_1km'):
+    """Default job runner. Pre-processes the downloaded HDF files of a project for the RCAs in basin,
+    reporting progress after each stage, and returns the file paths of the LST tables, one per year.
+    The tables are written to the temporary files directory of the project schema (see
+    model.predict_dir_list) and named after the year, basin, product and DOY range of the request, so
+    other requests do not overwrite them. Years whose table was completed by an earlier run, according
+    to the project database, are not processed again. The LST tables are the same for every model
+    variant, so model is only checked against MODEL_VARIANTS. With qc_weights=True, a QC weight table
+    with the same rows and columns (see weight_table) is also written for each LST table, for use with
+    prep.composite_LST_table. With compact=True, LST stays as UInt16 digital numbers from the geotiffs to
+    the tables (see prep.LST_NODATA), and the tables are named with a '_dn' suffix; read them with
+    prep.read_LST_table(compact=True). Compact tables cannot be combined with qc_weights.
+    Terra and Aqua granules are read from the product directories of both platforms (see
+    get.build_granule_dir_list). platform ('MOD' or 'MYD', or None for Terra when there are Terra
+    granules and Aqua otherwise) and lst_sds (i.e. 'LST_Night_1km') select the LST band of the tables
+    (see prep.lst_band); tables of a platform or sub-dataset other than the default are named after it."""
+    import get
+    import prep
+    import project
+    import climatology
+    from model import MODEL_VARIANTS, predict_dir_list
+    if model != DEFAULT_MODEL and model not in [v[0] for v in MODEL_VARIANTS]:
+        raise ValueError("Unknown model variant: %s" % model)
+    if compact and qc_weights:
+        raise ValueError("QC weight tables cannot be written with compact LST tables.")
+    temp_dir = os.path.join(project_dir, predict_dir_list()[0][1])
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+    product_list = {product: get.MODIS_PRODUCTS[product]}
+    table_suffix = ''
+    if platform is not None:
+        table_suffix += '_' + platform
+    if lst_sds != 'LST_Day_1km':
+        table_suffix += '_' + lst_sds
+    if compact:
+        table_suffix += '_dn'
+    year_tables = dict((str(y), os.path.join(temp_dir, 'LST_%s_%s_%s_%03d-%03d%s.csv' %
+                                             (y, os.path.splitext(os.path.basename(basin))[0], product,
+                                              doy_start, doy_end, table_suffix)))
+                       for y in year_list)
+    db = project.ProjectDB(project_dir)
+    try:
+        done_list = [y for y in sorted(year_tables) if db.is_done(year_tables[y]) and
+                     (not qc_weights or db.is_done(weight_table(year_tables[y])))]
+        todo_list = [y for y in sorted(year_tables) if y not in done_list]
+        if not todo_list:
+            report(100, "LST tables already compiled")
+            return [year_tables[y] for y in done_list]
+        if done_list:
+            report(0, "Skipping compiled years %s" % ', '.join(done_list))
+        report(0, "Finding HDF files")
+        swath_list = prep.get_rca_tiles(basin)
+        hdf_filename_list, hdf_filepath_list = get.get_hdf_filepaths(get.build_granule_dir_list(project_dir, product,
+                                                                                             todo_list))
+        # only granules of the basin's tiles, as the project can hold tiles of other basins
+        in_range = [f.split(".")[2] in swath_list and doy_start <= int(f.split(".")[1][-3:]) <= doy_end
+                    for f in hdf_filename_list]
+        hdf_filename_list = [f for f, keep in zip(hdf_filename_list, in_range) if keep]
+        hdf_filepath_list = [f for f, keep in zip(hdf_filepath_list, in_range) if keep]
+        if not hdf_filepath_list:
+            raise ValueError("No HDF files of tiles %s for %s between DOY %d and %d in %s." %
+                             (', '.join(swath_list), ', '.join(todo_list), doy_start, doy_end, project_dir))
+        hdf_years = sorted(set(f.split(".")[1][1:5] for f in hdf_filename_list) & set(todo_list))
+        modis_wkt = prep.get_modis_wkt("MODIS_sin.wkt")
+        for i, year in enumerate(hdf_years):
+            # each year is converted and mosaicked into its own Terra product directory only
+            year_dir = get.build_dir_list(project_dir, product_list, [year])[0]
+            if not os.path.exists(year_dir): # i.e. a project with only Aqua granules
+                os.makedirs(year_dir)
+            year_names = [f for f in hdf_filename_list if f.split(".")[1][1:5] == year]
+            year_paths = [p for f, p in zip(hdf_filename_list, hdf_filepath_list) if f.split(".")[1][1:5] == year]
+            report(10 + 80 * i // len(hdf_years), "Converting HDF files for %s" % year)
+            hdf_dates = get.find_dup_file_dates(get.get_file_dates(get.build_file_array(year_names)), swath_list)
+            geotiff_list, xres, yres = prep.convert_hdf(project_dir, [year_dir], year_paths, year_names,
+                                                        compact=compact, with_weights=qc_weights)
+            if not geotiff_list:
+                raise ValueError("None of the HDF files for %s are Terra (MOD) or Aqua (MYD) granules." % year)
+            db.record(geotiff_list, 'convert_hdf')
+            # the band layout of the geotiffs depends on the platforms of the year's granules
+            found_platforms = set(f[:3] for f in year_names)
+            band = prep.lst_band(found_platforms, platform, lst_sds)
+            report(10 + 80 * i // len(hdf_years) + 20 // len(hdf_years), "Building mosaics for %s" % year)
+            mosaic_io_array = prep.build_mosaic_io_array(geotiff_list, hdf_dates)
+            vrt_list = prep.convert_to_vrt(mosaic_io_array, swath_list, project_dir, [year_dir], modis_wkt,
+                                           prep.get_sin_bbox(basin))
+            db.record(vrt_list, 'convert_to_vrt')
+            date_vrt = dict((os.path.basename(v)[:-len(".vrt")], v) for v in vrt_list)
+            date_list = sorted(date_vrt)
+            report(10 + 80 * i // len(hdf_years) + 40 // len(hdf_years), "Reprojecting mosaics for %s" % year)
+            lst_table = year_tables[year]
+            cube_file = os.path.join(temp_dir, prep.CUBE_FILE % uuid.uuid4().hex)
+            weight_file = os.path.join(temp_dir, prep.CUBE_FILE % uuid.uuid4().hex)
+            lst_cube = None
+            weight_cube = None
+            try:
+                lst_cube, xy_array = prep.reproject_to_cube([date_vrt[d] for d in date_list],
+                                                            prep.get_poly_wkt(basin), prep.get_bbox(basin),
+                                                            xres, yres, basin, cube_file, band=band,
+                                                            compact=compact)
+                prep.cube_to_LST_table(lst_cube, xy_array, date_list, lst_table)
+                if qc_weights:
+                    platform_count = len(found_platforms & set(prep.PLATFORM_PREFIX))
+                    weight_cube, xy_array = prep.reproject_to_cube([date_vrt[d] for d in date_list],
+                                                                   prep.get_poly_wkt(basin), prep.get_bbox(basin),
+                                                                   xres, yres, basin, weight_file,
+                                                                   band=prep.qc_weight_band(band, platform_count))
+                    prep.cube_to_LST_table(weight_cube, xy_array, date_list, weight_table(lst_table),
+                                           mask_cube=lst_cube)
+                    db.record([weight_table(lst_table)], 'qc_weights')
+            finally:
+                lst_cube = None # close the memory maps before removing their files
+                weight_cube = None
+                for tmp_file in (cube_file, weight_file):
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+            # a climatology year holds the daily values of the whole year, so other requests would
+            # replace it with part of the year
+            if product == 'Daily' and doy_start <= 1 and doy_end >= 365:
+                db.record(climatology.update_climatology(lst_table, climatology_dir(project_dir, basin),
+                                                         basin, year=year, compact=compact), 'climatology')
+            # recorded last, so a year is only skipped by later runs once all of its stages are done
+            db.record([lst_table], 'compile_LST_table')
+            done_list.append(year)
+    finally:
+        db.close()
+    return [year_tables[y] for y in sorted(done_list)]
+
+
+class ResultCache(object):
+    """Size-bounded cache of model results (predicted stream temperatures, LST summaries), keyed by the
+    RCA shapefile hash, years, DOY range, product, model variant and runner options. Results are pickled to cache_dir so
+    they survive restarts, and the most recently used results are also held in memory. Files named by a
+    result (i.e. the LST tables returned by run_model_request) are copied into cache_dir under the key,
+    and the cached result names the copies, so later requests that rewrite the originals do not change
+    it. Copies keep their file names, and the QC weight table of an LST table (see weight_table) is
+    copied with it, so weight_table also finds the weights of a cached table. When the files in
+    cache_dir exceed max_bytes, the least recently used results are removed."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, memory_items=CACHE_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def cache_key(self, basin, year_list, model, doy_start=1, doy_end=366, product='Daily', **options):
+        """Builds the cache key of a request. options are the runner options (i.e. project_dir and
+        qc_weights of run_model_request), so services with different options do not share results."""
+        key = job_key(basin, year_list, model, doy_start, doy_end, product)
+        if 'project_dir' in options:
+            options['project_dir'] = os.path.abspath(options['project_dir'])
+        return hashlib.sha1(repr((hash_shapefile(basin),) + key[1:] +
+                                 (sorted(options.items()),)).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns a cached result, or None if the key is not in the cache."""
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = self.memory.pop(key) # move to most recently used
+                return self.memory[key]
+        cache_file = os.path.join(self.cache_dir, key + '.pkl')
+        try:
+            with open(cache_file, 'rb') as in_file:
+                result = pickle.load(in_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if not all(os.path.isfile(f) for f in self._artifacts(result)):
+            return None
+        os.utime(cache_file, None) # file modified time is used as the last access time
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        """Adds a result to the cache, then removes least recently used results if over the size limit.
+        Returns the cached result, which names the cached copies of its files."""
+        cache_file = os.path.join(self.cache_dir, key + '.pkl')
+        artifact_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = '%s.%s.tmp' % (artifact_dir, uuid.uuid4().hex)
+        copy_list = []
+        result = self._copy_artifacts(result, tmp_dir, artifact_dir, copy_list)
+        if copy_list:
+            if os.path.exists(artifact_dir):
+                shutil.rmtree(artifact_dir)
+            os.rename(tmp_dir, artifact_dir)
+        tmp_file = '%s.%s.tmp' % (cache_file, uuid.uuid4().hex)
+        with open(tmp_file, 'wb') as out_file:
+            pickle.dump(result, out_file, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(tmp_file, cache_file)
+        self._remember(key, result)
+        self.evict()
+        return result
+
+    def evict(self):
+        """Removes least recently used results, with their copied files, until the cache is within its
+        size limit."""
+        cache_files = []
+        for cache_file in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            artifact_dir = cache_file[:-len('.pkl')]
+            size = os.path.getsize(cache_file)
+            for copy_dir, dir_names, file_names in os.walk(artifact_dir):
+                size += sum(os.path.getsize(os.path.join(copy_dir, f)) for f in file_names)
+            cache_files.append((os.path.getmtime(cache_file), size, cache_file))
+        total_bytes = sum(f[1] for f in cache_files)
+        for mtime, size, cache_file in sorted(cache_files):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(cache_file)
+            if os.path.isdir(cache_file[:-len('.pkl')]):
+                shutil.rmtree(cache_file[:-len('.pkl')])
+            total_bytes -= size
+            with self.lock:
+                self.memory.pop(os.path.basename(cache_file)[:-len('.pkl')], None)
+
+    def _copy_artifacts(self, result, tmp_dir, artifact_dir, copy_list):
+        """Copies the existing files named in a result (a file path, or a list, tuple or dictionary of
+        results) to tmp_dir, and returns the result with the paths they will have in artifact_dir."""
+        if isinstance(result, basestring):
+            if not os.path.isfile(result):
+                return result
+            # in numbered directories, as files of different directories can share a name
+            copy_dir = str(len(copy_list))
+            os.makedirs(os.path.join(tmp_dir, copy_dir))
+            copy_name = os.path.join(copy_dir, os.path.basename(result))
+            shutil.copyfile(result, os.path.join(tmp_dir, copy_name))
+            if os.path.basename(result).startswith('LST') and os.path.isfile(weight_table(result)):
+                shutil.copyfile(weight_table(result), weight_table(os.path.join(tmp_dir, copy_name)))
+            copy_list.append(result)
+            return os.path.join(artifact_dir, copy_name)
+        if isinstance(result, (list, tuple)):
+            return type(result)(self._copy_artifacts(r, tmp_dir, artifact_dir, copy_list) for r in result)
+        if isinstance(result, dict):
+            return dict((k, self._copy_artifacts(v, tmp_dir, artifact_dir, copy_list)) for k, v in result.items())
+        return result
+
+    def _artifacts(self, result):
+        """Returns the cached file paths named in a result."""
+        if isinstance(result, basestring):
+            return [result] if result.startswith(os.path.join(self.cache_dir, '')) else []
+        if isinstance(result, (list, tuple)):
+            return [f for r in result for f in self._artifacts(r)]
+        if isinstance(result, dict):
+            return [f for r in result.values() for f in self._artifacts(r)]
+        return []
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.memory.pop(key, None)
+            self.memory[key] = result
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+
+class Job(object):
+    """State of a single model request. Progress events are kept as a list of (percent, message) tuples."""
+
+    def __init__(self, key):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.status = JOB_PENDING
+        self.percent = 0
+        self.events = []
+        self.result = None
+        self.error = None
+        self.cache_key = None
+        self.submitted = time.time()
+        self.finished = None
+        self.changed = threading.Condition()
+
+    def update(self, status=None, percent=None, message=None):
+        """Records a status change or progress event and wakes up anyone streaming the job's progress."""
+        with self.changed:
+            if status is not None:
+                self.status = status
+            if percent is not None:
+                self.percent = percent
+            if message is not None:
+                self.events.append((self.percent, message))
+            self.changed.notify_all()
+
+    def is_finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self):
+        """Summary of the job for the web front end."""
+        return {'job_id': self.job_id,
+                'basin': self.key[0],
+                'years': list(self.key[1]),
+                'model': self.key[2],
+                'doy_start': self.key[3],
+                'doy_end': self.key[4],
+                'product': self.key[5],
+                'status': self.status,
+                'percent': self.percent,
+                'message': self.events[-1][1] if self.events else '',
+                'result': self.result,
+                'error': self.error}
+
+
+class JobService(object):
+    """Queues model requests and runs them on a pool of worker threads. A request that is identical to
+    one already pending or running is not run again; the ID of the existing job is returned instead.
+
+    The runner is called as runner(basin, year_list, model, report, doy_start=..., doy_end=...,
+    product=..., **options), where report(percent, message) records job progress, and its return value
+    is stored as the job result. If a ResultCache is supplied, cached results are returned without
+    running the request, and new results are added to the cache. Only the job_history most recently
+    finished jobs are kept; the status of older jobs can no longer be queried."""
+
+    def __init__(self, runner=run_model_request, num_workers=NUM_WORKERS, cache=None, job_history=JOB_HISTORY,
+                 **options):
+        self.runner = runner
+        self.cache = cache
+        self.job_history = job_history
+        self.options = options
+        self.jobs = {}
+        self.active = {} # job key: job ID, for pending and running jobs
+        self.lock = threading.Lock()
+        self.job_queue = queue.Queue()
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, basin, year_list, model, doy_start=1, doy_end=366, product='Daily'):
+        """Submits a model request for a basin (RCA shapefile), list of years, DOY range, MODIS product
+        and model variant, and returns the job ID."""
+        key = job_key(basin, year_list, model, doy_start, doy_end, product)
+        cache_key = None
+        result = None
+        if self.cache is not None:
+            cache_key = self.cache.cache_key(basin, year_list, model, doy_start, doy_end, product, **self.options)
+            result = self.cache.get(cache_key)
+        with self.lock:
+            if key in self.active:
+                return self.active[key]
+            job = Job(key)
+            job.cache_key = cache_key
+            self.jobs[job.job_id] = job
+            if result is not None:
+                job.result = result
+                job.finished = time.time()
+                job.update(status=JOB_DONE, percent=100, message="Done (cached)")
+                self._prune()
+                return job.job_id
+            self.active[key] = job.job_id
+        job.update(message="Queued")
+        self.job_queue.put(job)
+        return job.job_id
+
+    def status(self, job_id):
+        """Returns the current state of a job as a dictionary."""
+        return self.jobs[job_id].to_dict()
+
+    def progress(self, job_id, timeout=None):
+        """Generator of (percent, message) progress events for a job, which blocks while waiting for
+        new events and ends when the job has finished, or when no event arrives within timeout seconds."""
+        job = self.jobs[job_id]
+        sent = 0
+        while True:
+            with job.changed:
+                if sent == len(job.events) and not job.is_finished():
+                    job.changed.wait(timeout)
+                new_events = job.events[sent:]
+                finished = job.is_finished()
+            for event in new_events:
+                yield event
+            sent += len(new_events)
+            if finished or (not new_events and timeout is not None):
+                return
+
+    def shutdown(self):
+        """Stops the workers once the queued jobs have run."""
+        for worker in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            basin, years, model, doy_start, doy_end, product = job.key
+            job.update(status=JOB_RUNNING, message="Running")
+            report = lambda percent, message: job.update(percent=percent, message=message)
+            try:
+                job.result = self.runner(basin, list(years), model, report, doy_start=doy_start,
+                                         doy_end=doy_end, product=product, **self.options)
+                if self.cache is not None:
+                    job.result = self.cache.put(job.cache_key, job.result) # names the cached copies
+                job.finished = time.time()
+                job.update(status=JOB_DONE, percent=100, message="Done")
+            except Exception as e:
+                job.error = str(e)
+                job.finished = time.time()
+                job.update(status=JOB_FAILED, message="Failed: %s" % e)
+            finally:
+                with self.lock:
+                    del self.active[job.key]
+                    self._prune()
+
+    def _prune(self):
+        """Removes the least recently finished jobs beyond job_history. Called with the lock held."""
+        finished_list = sorted((job.finished, job_id) for job_id, job in self.jobs.items() if job.is_finished())
+        for finished, job_id in finished_list[:max(0, len(finished_list) - self.job_history)]:
+            del self.jobs[job_id]
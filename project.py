@@ -0,0 +1,143 @@
+#-------------------------------------------------------------------------------
+# Name:         project.py
+#
+# Summary:      The project module keeps the state of a STeAMM project directory in a small
+#               SQLite database at the project root. The database records the directories of
+#               the project schema and the files (artifacts) written by each processing stage,
+#               with their status, so that schema checks, resuming a run and removing the
+#               outputs of a stage are queries rather than walks of the project tree.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import time
+import sqlite3
+import threading
+
+# Global constants
+PROJECT_DB = 'steamm_project.db'
+ARTIFACT_RUNNING = 'running'
+ARTIFACT_DONE = 'done'
+ARTIFACT_FAILED = 'failed'
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    size INTEGER,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS artifacts_stage ON artifacts (stage, status);
+"""
+
+
+class ProjectDB(object):
+    """State database of one project directory. Paths are stored relative to the project directory, so
+    a project can be moved or opened from another machine, and are returned as full paths."""
+
+    def __init__(self, project_dir):
+        self.project_dir = os.path.abspath(project_dir)
+        if not os.path.exists(self.project_dir):
+            os.makedirs(self.project_dir)
+        # each run opens its own ProjectDB, so the connection is not shared between runs; access is still
+        # serialised with a lock, so a ProjectDB can be used from a thread other than the one that opened it
+        self.conn = sqlite3.connect(os.path.join(self.project_dir, PROJECT_DB), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(SCHEMA_SQL)
+
+    def _relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), self.project_dir)
+
+    def _abspath(self, rel_path):
+        return os.path.join(self.project_dir, rel_path)
+
+    def add_dirs(self, dir_list):
+        """Records directories as part of the project schema."""
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO dirs (path) VALUES (?)",
+                                  [(self._relpath(d),) for d in dir_list])
+        return
+
+    def missing_dirs(self, dir_list):
+        """Returns the directories of dir_list that are not part of the project. Only the listed
+        directories are checked on disk; directories that exist but were created before the project
+        database (or by hand) are recorded on the way."""
+        with self.lock:
+            recorded = set(row[0] for row in self.conn.execute("SELECT path FROM dirs"))
+        missing_list = []
+        found_list = []
+        for d in dir_list:
+            if not os.path.isdir(d):
+                missing_list.append(d)
+            elif self._relpath(d) not in recorded:
+                found_list.append(d)
+        if found_list:
+            self.add_dirs(found_list)
+        return missing_list
+
+    def record(self, path_list, stage, status=ARTIFACT_DONE):
+        """Records the files written by a stage, with their status and current size."""
+        now = time.time()
+        rows = []
+        for path in path_list:
+            size = os.path.getsize(path) if os.path.isfile(path) else None
+            rows.append((self._relpath(path), stage, status, size, now))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO artifacts (path, stage, status, size, updated) "
+                                  "VALUES (?, ?, ?, ?, ?)", rows)
+        return
+
+    def artifacts(self, stage=None, status=None):
+        """Returns the full paths of the recorded artifacts, optionally of one stage and/or status."""
+        sql = "SELECT path FROM artifacts"
+        where = []
+        params = []
+        if stage is not None:
+            where.append("stage = ?")
+            params.append(stage)
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self.lock:
+            return [self._abspath(row[0]) for row in self.conn.execute(sql + " ORDER BY path", params)]
+
+    def is_done(self, path):
+        """True if a file was completed by a previous run and has not changed size since, so a resumed
+        run can skip it."""
+        with self.lock:
+            row = self.conn.execute("SELECT status, size FROM artifacts WHERE path = ?",
+                                    (self._relpath(path),)).fetchone()
+        return (row is not None and row[0] == ARTIFACT_DONE and os.path.isfile(path) and
+                row[1] == os.path.getsize(path))
+
+    def remove_stage(self, stage):
+        """Deletes the files recorded for a stage and forgets them. Returns the number of files removed."""
+        removed = 0
+        for path in self.artifacts(stage):
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM artifacts WHERE stage = ?", (stage,))
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        return
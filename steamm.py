@@ -0,0 +1,109 @@
+#-------------------------------------------------------------------------------
+# Name:         steamm.py
+#
+# Summary:      Command line entry point for STeAMM. Stage modules (get, prep, model) are only
+#               imported when a command needs them, so the tool starts quickly. When a STeAMM
+#               daemon is running (see daemon.py) commands are run by the daemon, which keeps
+#               GDAL and the STeAMM modules loaded between runs.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import argparse
+import importlib
+
+
+def run(args, module_name, func_name, *func_args, **func_kwargs):
+    """Runs a stage function in the daemon, or in this process if --local is set or no daemon is running."""
+    if args.local:
+        func = getattr(importlib.import_module(module_name), func_name)
+        return func(*func_args, **func_kwargs)
+    import daemon
+    return daemon.call(module_name, func_name, *func_args, **func_kwargs)
+
+
+def cmd_tiles(args):
+    print ' '.join(run(args, 'prep', 'get_rca_tiles', args.rca))
+
+
+def cmd_download(args):
+    products = dict((p, importlib.import_module('get').MODIS_PRODUCTS[p]) for p in args.product)
+    run(args, 'get', 'download_hdf', products, args.years, args.tiles, args.doy_start, args.doy_end,
+        args.project_dir, args.username, args.password)
+
+
+def cmd_prep(args):
+    import process
+    # the reporter runs in this process, also when the request is run by the daemon (see daemon.call)
+    print run(args, 'process', 'run_model_request', args.rca, args.years, args.model, process.print_report,
+              args.project_dir, doy_start=args.doy_start, doy_end=args.doy_end, product=args.product[0])
+
+
+def cmd_find_rca(args):
+    print ' '.join(str(i) for i in run(args, 'prep', 'find_rca', args.rca, args.x, args.y, args.id_field))
+
+
+def cmd_daemon(args):
+    import daemon
+    if args.stop:
+        if not daemon.shutdown():
+            print "No STeAMM daemon is running."
+    else:
+        daemon.serve()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='steamm', description='Stream Temperature Automated Modeler using MODIS')
+    parser.add_argument('--local', action='store_true', help='run in this process, even if a daemon is running')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('tiles', help='list the MODIS tiles that intersect the RCA polygons')
+    p.add_argument('rca', help='RCA polygon shapefile')
+    p.set_defaults(func=cmd_tiles)
+
+    p = subparsers.add_parser('download', help='download HDF files into a project directory')
+    p.add_argument('project_dir')
+    p.add_argument('-y', '--years', nargs='+', required=True)
+    p.add_argument('-t', '--tiles', nargs='+', required=True, help='MODIS tiles, i.e. h09v04')
+    p.add_argument('--product', nargs='+', default=['Daily'], choices=['Daily', '8-day'])
+    p.add_argument('-b', '--doy-start', type=int, default=1)
+    p.add_argument('-e', '--doy-end', type=int, default=-1)
+    p.add_argument('-u', '--username', required=True, help='EarthData username')
+    p.add_argument('-P', '--password', required=True, help='EarthData password')
+    p.set_defaults(func=cmd_download)
+
+    p = subparsers.add_parser('prep', help='pre-process downloaded HDF files into an LST table')
+    p.add_argument('project_dir')
+    p.add_argument('rca', help='RCA polygon shapefile')
+    p.add_argument('-y', '--years', nargs='+', required=True)
+    p.add_argument('--product', nargs=1, default=['Daily'], choices=['Daily', '8-day'])
+    p.add_argument('--model', default='default')
+    p.add_argument('-b', '--doy-start', type=int, default=1)
+    p.add_argument('-e', '--doy-end', type=int, default=366)
+    p.set_defaults(func=cmd_prep)
+
+    p = subparsers.add_parser('find-rca', help='find the RCA polygons containing a coordinate')
+    p.add_argument('rca', help='RCA polygon shapefile')
+    p.add_argument('x', type=float)
+    p.add_argument('y', type=float)
+    p.add_argument('--id-field', default=None)
+    p.set_defaults(func=cmd_find_rca)
+
+    p = subparsers.add_parser('daemon', help='start (or stop) the STeAMM worker daemon')
+    p.add_argument('--stop', action='store_true')
+    p.set_defaults(func=cmd_daemon)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
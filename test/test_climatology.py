@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+
+import climatology
+
+
+class ClimatologyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clim_dir = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.clim_dir)
+
+    def test_matches_full_recompute(self):
+        doy_list = [1, 2, 3, 200]
+        year_cubes = {}
+        for year, ids in [(2014, ['a', 'b']), (2015, ['a', 'b', 'c']), (2016, ['c', 'a'])]:
+            cube = self.rng.uniform(-5, 30, (len(ids), len(doy_list))).astype(np.float32)
+            cube[0, 1] = np.nan
+            year_cubes[year] = (ids, cube)
+            clim = climatology.Climatology(self.clim_dir)
+            clim.update(ids, year, doy_list, cube)
+        # replacing a year removes its old values from the running sums
+        ids, cube = year_cubes[2015]
+        cube = cube + 1.0
+        year_cubes[2015] = (ids, cube)
+        climatology.Climatology(self.clim_dir).update(ids, 2015, doy_list, cube)
+
+        clim = climatology.Climatology(self.clim_dir)
+        self.assertEqual(clim.years, [2014, 2015, 2016])
+        stack = np.empty((3, 3, climatology.CLIM_DAYS))
+        stack.fill(np.nan)
+        for i, year in enumerate([2014, 2015, 2016]):
+            ids, cube = year_cubes[year]
+            for row, loc in enumerate(ids):
+                stack[i, clim.row_index[loc], np.array(doy_list) - 1] = cube[row]
+        cols = np.array(doy_list) - 1
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # DOYs without values
+            np.testing.assert_allclose(clim.mean()[:, cols], np.nanmean(stack, axis=0)[:, cols], rtol=1e-6)
+            np.testing.assert_allclose(clim.std()[:, cols], np.nanstd(stack, axis=0)[:, cols], rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(clim.percentile(50, block_rows=2)[:, cols],
+                                   np.nanpercentile(stack, 50, axis=0)[:, cols], rtol=1e-6)
+        subset = clim.percentile(90, ['c', 'unknown'])
+        np.testing.assert_allclose(subset[0, cols], np.nanpercentile(stack[:, clim.row_index['c'], cols], 90, axis=0),
+                                   rtol=1e-6)
+        self.assertTrue(np.isnan(subset[1]).all())
+        self.assertTrue(np.isnan(clim.mean()[:, 100]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
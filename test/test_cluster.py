@@ -0,0 +1,58 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import cluster
+
+
+def fake_shard(shard):
+    """Shard runner returning one cell per tile, with the DOY as the LST value."""
+    if shard['tile'] == 'h10v04' and shard['doy_start'] == 1:
+        raise ValueError("bad granule")
+    date_list = [int(shard['year']) * 1000 + d for d in range(shard['doy_start'], shard['doy_end'] + 1)]
+    cell_ids = [int(shard['tile'][1:3])]
+    return cell_ids, date_list, np.array([[float(d % 1000) for d in date_list]])
+
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cluster_dir)
+
+    def test_claim_resets_age(self):
+        cluster.submit_shards(self.cluster_dir, cluster.make_shards(['h09v04'], [2016], 1, 10))
+        task_file = os.path.join(self.cluster_dir, 'tasks', 'h09v04_2016_001_010.json')
+        os.utime(task_file, (time.time() - 7200, time.time() - 7200)) # queued two hours ago
+        shard, claimed_file = cluster.claim_task(self.cluster_dir, 'w1')
+        cluster.requeue_stale_tasks(self.cluster_dir, max_age=3600)
+        self.assertTrue(os.path.exists(claimed_file))
+
+    def test_requeued_claim_still_finishes(self):
+        cluster.submit_shards(self.cluster_dir, cluster.make_shards(['h09v04'], [2016], 1, 10))
+        shard, claimed_file = cluster.claim_task(self.cluster_dir, 'w1')
+        os.utime(claimed_file, (0, 0))
+        cluster.requeue_stale_tasks(self.cluster_dir, max_age=3600)
+        self.assertFalse(os.path.exists(claimed_file))
+        # the first worker finishes after its claim was requeued
+        cluster._finish_task(claimed_file, os.path.join(self.cluster_dir, 'done', 'h09v04_2016_001_010.json'), shard)
+        self.assertEqual(os.listdir(os.path.join(self.cluster_dir, 'done')), ['h09v04_2016_001_010.json'])
+
+    def test_failed_shards_are_reported(self):
+        shard_list = cluster.make_shards(['h09v04', 'h10v04'], [2016], 1, 40)
+        self.assertRaises(RuntimeError, cluster.run_local, self.cluster_dir, shard_list, 2, fake_shard)
+        self.assertEqual(cluster.failed_shards(self.cluster_dir), ['h10v04_2016_001_032'])
+        cell_ids, date_list, lst_cube = cluster.merge_results(self.cluster_dir, allow_failed=True)
+        self.assertEqual(list(cell_ids), [9, 10])
+        self.assertEqual(date_list, [2016000 + d for d in range(1, 41)])
+        self.assertTrue(np.isnan(lst_cube[1, :32]).all())
+        self.assertEqual(list(lst_cube[1, 32:]), list(range(33, 41)))
+
+
+if __name__ == '__main__':
+    unittest.main()
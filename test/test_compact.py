@@ -0,0 +1,71 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import prep
+import cluster
+
+
+class CompactLSTTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_encode_decode(self):
+        lst = np.array([[-20.01, 0.01, 12.35], [np.nan, 45.5, -273.15]], dtype=np.float32)
+        encoded = prep.encode_lst(lst)
+        self.assertEqual(encoded.dtype, np.uint16)
+        self.assertEqual(encoded[0].tolist(), [12657, 13658, 14275])
+        self.assertEqual(encoded[1, 0], prep.LST_NODATA)
+        self.assertEqual(encoded[1, 2], 1) # valid values are never encoded as LST_NODATA
+        decoded = prep.decode_lst(encoded)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_allclose(decoded[0], lst[0], atol=prep.LST_SCALE / 2)
+        self.assertTrue(np.isnan(decoded[1, 0]))
+
+    def test_nodata(self):
+        decoded = prep.decode_lst([prep.LST_NODATA, 14275])
+        self.assertTrue(np.isnan(decoded[0]))
+        self.assertAlmostEqual(decoded[1], 12.35, places=4)
+        qc_array = np.array([0b00000000, 0b00000001, 0b00000000])
+        lst_array = np.array([14275, 14275, prep.LST_FILL])
+        filtered = prep.qc_filter(lst_array, qc_array, compact=True)
+        self.assertEqual(filtered.dtype, np.uint16)
+        self.assertEqual(filtered.tolist(), [14275, prep.LST_NODATA, prep.LST_NODATA])
+        self.assertEqual(prep.lst_missing(filtered).tolist(), [False, True, True])
+        self.assertEqual(prep.lst_missing(prep.decode_lst(filtered)).tolist(), [False, True, True])
+
+    def test_compact_table(self):
+        lst_cube = np.array([[14275, prep.LST_NODATA], [prep.LST_NODATA, prep.LST_NODATA], [13658, 13660]],
+                            dtype=np.uint16)
+        xy_array = np.array([[0.5, 0.5], [1.5, 0.5], [2.5, 0.5]])
+        out_csv = prep.cube_to_LST_table(lst_cube, xy_array, ['A2016001', 'A2016002'],
+                                         os.path.join(self.work_dir, 'LST_2016_dn.csv'))
+        with open(out_csv, 'rb') as in_file:
+            rows = list(csv.reader(in_file))
+        self.assertEqual(rows, [['UID', 'X', 'Y', '1', '2'],
+                                ['1', '0.500000', '0.500000', '14275', ''],
+                                ['3', '2.500000', '0.500000', '13658', '13660']])
+        id_rows, doy_list, decoded = prep.read_LST_table(out_csv, compact=True)
+        np.testing.assert_allclose(decoded, prep.decode_lst(lst_cube[[0, 2]]), atol=1e-4)
+
+    def test_merge_compact_partials(self):
+        cluster.make_cluster_dirs(self.work_dir)
+        cluster.save_partial_cube(self.work_dir, 'a', [1, 2], [2016001], np.array([[14000], [0]], dtype=np.uint16))
+        cluster.save_partial_cube(self.work_dir, 'b', [2], [2016001], np.array([[14001]], dtype=np.uint16))
+        cluster.save_partial_cube(self.work_dir, 'c', [1], [2016001], np.array([[14003]], dtype=np.uint16))
+        cell_ids, date_list, lst_cube = cluster.merge_results(self.work_dir)
+        self.assertEqual(lst_cube.dtype, np.uint16)
+        self.assertEqual(lst_cube.tolist(), [[14002], [14001]]) # the nodata value is not averaged in
+        cluster.save_partial_cube(self.work_dir, 'd', [3], [2016001], np.array([[12.0]]))
+        self.assertRaises(ValueError, cluster.merge_results, self.work_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
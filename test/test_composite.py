@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+import prep
+
+
+class CompositeTest(unittest.TestCase):
+
+    def brute_force(self, lst_cube, doy_list, period, weight_cube):
+        period_list = sorted(set((d - 1) // period for d in doy_list))
+        composite = np.empty((lst_cube.shape[0], len(period_list)))
+        composite.fill(np.nan)
+        for row in range(lst_cube.shape[0]):
+            for col, p in enumerate(period_list):
+                value_sum = 0.0
+                weight_sum = 0.0
+                for i, d in enumerate(doy_list):
+                    w = weight_cube[row, i]
+                    if (d - 1) // period == p and not np.isnan(lst_cube[row, i]) and not np.isnan(w):
+                        value_sum += w * lst_cube[row, i]
+                        weight_sum += w
+                if weight_sum > 0:
+                    composite[row, col] = value_sum / weight_sum
+        return composite, [p * period + 1 for p in period_list]
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(3)
+        doy_list = [1, 2, 5, 8, 9, 12, 30, 31, 365]
+        lst_cube = rng.uniform(-5, 30, (6, len(doy_list))).astype(np.float32)
+        lst_cube[rng.uniform(size=lst_cube.shape) < 0.3] = np.nan
+        weight_cube = prep.qc_weights(rng.randint(0, 256, lst_cube.shape))
+        weight_cube[0, 0] = np.nan # a missing weight only drops its own day
+        for period in [8, 16]:
+            composite, period_doy = prep.composite_lst(lst_cube, doy_list, period, weight_cube)
+            expected, expected_doy = self.brute_force(lst_cube, doy_list, period, weight_cube)
+            self.assertEqual(period_doy, expected_doy)
+            np.testing.assert_allclose(composite, expected, rtol=1e-5)
+        self.assertFalse(np.isnan(prep.composite_lst(np.ones((1, 3)), [1, 2, 3], 8, [[np.nan, 1, 1]])[0]).any())
+
+    def test_unweighted_mean(self):
+        lst_cube = np.array([[1.0, np.nan, 3.0, 10.0], [np.nan, np.nan, np.nan, 4.0]])
+        composite, period_doy = prep.composite_lst(lst_cube, [1, 4, 8, 9])
+        self.assertEqual(period_doy, [1, 9])
+        np.testing.assert_allclose(composite, [[2.0, 10.0], [np.nan, 4.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
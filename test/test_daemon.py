@@ -0,0 +1,45 @@
+import threading
+import unittest
+from multiprocessing import Pipe
+
+import daemon
+
+
+def count_to(n, report):
+    """Request function that reports its progress from the daemon."""
+    for i in range(n):
+        report(i, "step %d" % i)
+    return n
+
+
+class DaemonCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (daemon.connect, daemon.DAEMON_MODULES)
+        client_conn, daemon_conn = Pipe()
+        self.handler = threading.Thread(target=daemon._handle, args=(daemon_conn,))
+        self.handler.daemon = True
+        self.handler.start()
+        daemon.connect = lambda address=daemon.DAEMON_ADDRESS: client_conn
+        daemon.DAEMON_MODULES = [__name__]
+
+    def tearDown(self):
+        daemon.connect, daemon.DAEMON_MODULES = self.saved
+        self.handler.join(5)
+
+    def test_progress_is_reported_by_the_client(self):
+        progress = []
+        caller = threading.current_thread()
+
+        def report(percent, message):
+            progress.append((percent, message, threading.current_thread() is caller))
+
+        self.assertEqual(daemon.call(__name__, 'count_to', 3, report=report), 3)
+        self.assertEqual(progress, [(0, "step 0", True), (1, "step 1", True), (2, "step 2", True)])
+
+    def test_errors_are_raised(self):
+        self.assertRaises(RuntimeError, daemon.call, __name__, 'count_to', 3, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
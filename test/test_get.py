@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import get
+import externals.get_modis.get_modis as gm
+
+GRANULE = 'MOD11A1.A2016001.h09v04.006.2016007192412.hdf'
+XML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<GranuleMetaDataFile>
+  <GranuleURMetaData>
+    <DataFiles>
+      <DataFileContainer>
+        <DistributedFileName>%s</DistributedFileName>
+        <FileSize>%d</FileSize>
+        <ChecksumType>CKSUM</ChecksumType>
+        <Checksum>%d</Checksum>
+      </DataFileContainer>
+    </DataFiles>
+  </GranuleURMetaData>
+</GranuleMetaDataFile>
+"""
+
+
+class GranuleStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.work_dir, 'store')
+        self.store_subdir = os.path.join(self.store_dir, 'MOD11A1.006', '2016')
+        os.makedirs(self.store_subdir)
+        self.saved = []
+
+    def tearDown(self):
+        for module, name, value in reversed(self.saved):
+            setattr(module, name, value)
+        shutil.rmtree(self.work_dir)
+
+    def stub(self, module, name, value):
+        self.saved.append((module, name, getattr(module, name)))
+        setattr(module, name, value)
+
+    def write_granule(self, name, data, xml_data=None):
+        """Writes a granule and its .hdf.xml metadata, describing xml_data (by default the granule itself)."""
+        hdf_file = os.path.join(self.store_subdir, name)
+        with open(hdf_file, 'wb') as out_file:
+            out_file.write(data)
+        if xml_data is None:
+            xml_data = data
+        with open(hdf_file + '.tmp', 'wb') as out_file:
+            out_file.write(xml_data)
+        checksum = gm.cksum(hdf_file + '.tmp')
+        os.remove(hdf_file + '.tmp')
+        with open(hdf_file + '.xml', 'w') as out_file:
+            out_file.write(XML_TEMPLATE % (name, len(xml_data), checksum))
+        return hdf_file
+
+    def test_verify_granule(self):
+        good = self.write_granule(GRANULE, 'granule data' * 100)
+        short = self.write_granule(GRANULE.replace('h09v04', 'h09v05'), 'granule', 'granule data' * 100)
+        corrupt = self.write_granule(GRANULE.replace('h09v04', 'h10v04'), 'granule dbta' * 100, 'granule data' * 100)
+        self.assertTrue(gm.verify_granule(good))
+        self.assertFalse(gm.verify_granule(short))
+        self.assertFalse(gm.verify_granule(corrupt))
+        os.remove(good + '.xml')
+        self.assertFalse(gm.verify_granule(good)) # no metadata
+
+    def test_update_store_index(self):
+        good = self.write_granule(GRANULE, 'granule data' * 100)
+        corrupt = self.write_granule(GRANULE.replace('h09v04', 'h10v04'), 'granule dbta' * 100, 'granule data' * 100)
+        store_index = get.update_store_index(self.store_dir, self.store_subdir)
+        self.assertEqual(sorted(store_index), [GRANULE[:-len('.hdf')]])
+        self.assertEqual(store_index[GRANULE[:-len('.hdf')]][1:],
+                         ['1200', os.path.join('MOD11A1.006', '2016', GRANULE)])
+        self.assertFalse(os.path.exists(corrupt)) # removed, so it is downloaded again
+        self.assertEqual(get.read_store_index(self.store_dir), store_index)
+        self.assertTrue(os.path.exists(good))
+
+    def test_update_store_index_mocked(self):
+        for name in [GRANULE, GRANULE.replace('h09v04', 'h10v04'), 'notes.txt']:
+            open(os.path.join(self.store_subdir, name), 'wb').close()
+        verified = []
+        self.stub(gm, 'verify_granule', lambda hdf_file: verified.append(os.path.basename(hdf_file)) or 'h09v04' in hdf_file)
+        self.stub(gm, 'read_xml_metadata', lambda xml_file: (42, 'CKSUM', 1234))
+        store_index = get.update_store_index(self.store_dir, self.store_subdir)
+        self.assertEqual(sorted(verified), [GRANULE, GRANULE.replace('h09v04', 'h10v04')])
+        self.assertEqual(store_index, {GRANULE[:-len('.hdf')]: ['1234', '42', os.path.join('MOD11A1.006', '2016', GRANULE)]})
+        # granules already in the index are not verified again
+        verified[:] = []
+        get.update_store_index(self.store_dir, self.store_subdir)
+        self.assertEqual(verified, [])
+
+    def link_to_new_project(self):
+        self.write_granule(GRANULE, 'granule data')
+        store_index = get.update_store_index(self.store_dir, self.store_subdir)
+        hdf_dir = os.path.join(self.work_dir, 'project', '2016', 'MOD11A1.006') # does not exist yet
+        get.link_granules(self.store_dir, store_index, hdf_dir, ['h09v04'])
+        return os.path.join(hdf_dir, GRANULE)
+
+    def fail(self, *args):
+        raise OSError("links are not supported")
+
+    def test_hardlink(self):
+        dst_file = self.link_to_new_project()
+        self.assertEqual(os.stat(dst_file).st_ino, os.stat(os.path.join(self.store_subdir, GRANULE)).st_ino)
+
+    def test_symlink_fallback(self):
+        self.stub(os, 'link', self.fail)
+        dst_file = self.link_to_new_project()
+        self.assertTrue(os.path.islink(dst_file))
+
+    def test_copy_fallback(self):
+        self.stub(os, 'link', self.fail)
+        self.stub(os, 'symlink', self.fail)
+        dst_file = self.link_to_new_project()
+        self.assertFalse(os.path.islink(dst_file))
+        with open(dst_file, 'rb') as in_file:
+            self.assertEqual(in_file.read(), 'granule data')
+
+
+if __name__ == '__main__':
+    unittest.main()
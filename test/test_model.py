@@ -0,0 +1,118 @@
+import unittest
+import numpy as np
+
+import model
+
+
+class CrossValidationTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.doy = rng.randint(1, 367, 60)
+        self.lst = rng.uniform(-5, 35, 60)
+        self.temp = 2.0 + 0.4 * self.lst + 0.01 * self.doy + rng.normal(0, 1, 60)
+        self.X = model.design_matrix(self.lst, self.doy, julian=True)
+
+    def refit_residuals(self, test_rows):
+        train = np.ones(len(self.temp), dtype=bool)
+        train[test_rows] = False
+        beta = np.linalg.lstsq(self.X[train], self.temp[train], rcond=None)[0]
+        return self.temp[test_rows] - self.X[test_rows].dot(beta)
+
+    def test_leave_one_out(self):
+        expected = np.array([self.refit_residuals([i])[0] for i in range(len(self.temp))])
+        np.testing.assert_allclose(model.cv_residuals(self.X, self.temp), expected, rtol=1e-8, atol=1e-10)
+
+    def test_k_fold(self):
+        folds = 7
+        fold_index = np.random.RandomState(model.CV_SEED).permutation(len(self.temp)) % folds
+        expected = np.empty(len(self.temp))
+        for f in range(folds):
+            rows = np.nonzero(fold_index == f)[0]
+            expected[rows] = self.refit_residuals(rows)
+        np.testing.assert_allclose(model.cv_residuals(self.X, self.temp, folds), expected, rtol=1e-8, atol=1e-10)
+
+    def test_rmse(self):
+        self.assertAlmostEqual(model.rmse([3.0, -4.0, np.nan, np.inf]), np.sqrt(12.5))
+        self.assertTrue(np.isnan(model.rmse([np.nan])))
+
+
+class ThermalMetricsTest(unittest.TestCase):
+
+    def brute_force(self, tmax, doy_list, thresholds, window, tmean):
+        """Metrics of one reach, by looping over the calendar days from the first to the last DOY."""
+        days = range(min(doy_list), max(doy_list) + 1)
+        tmax_day = dict(zip(doy_list, tmax))
+        tmean_day = dict(zip(doy_list, tmean))
+
+        def weekly(day_values):
+            means = {}
+            for d in days:
+                values = [day_values.get(w, np.nan) for w in range(d - window + 1, d + 1)]
+                if d - window + 1 >= days[0] and not np.isnan(values).any():
+                    means[d] = np.mean(values)
+            return means
+
+        def max_and_doy(means):
+            if not means:
+                return [np.nan, np.nan]
+            doy = max(means, key=lambda d: (means[d], -d))
+            return [means[doy], doy]
+
+        dadm = weekly(tmax_day)
+        valid_max = [v for v in tmax if not np.isnan(v)]
+        row = [max(valid_max) if valid_max else np.nan]
+        row += max_and_doy(dadm) + max_and_doy(weekly(tmean_day))
+        row += [sum(1 for v in valid_max if v > t) for t in thresholds]
+        row += [sum(1 for v in dadm.values() if v > t) for t in thresholds]
+        return row
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(2)
+        doy_list = [d for d in range(150, 260) if d % 11 != 0] # missing days break the weekly windows
+        tmax = rng.uniform(8, 24, (5, len(doy_list)))
+        tmax[1, 20:30] = np.nan
+        tmax[2, :] = np.nan
+        tmean = tmax - rng.uniform(1, 4, tmax.shape)
+        thresholds = [13.0, 18.0]
+        metrics = model.thermal_metrics(tmax, doy_list, thresholds, 7, tmean)
+        self.assertEqual(metrics.shape, (5, len(model.metric_names(thresholds, True))))
+        for reach in range(5):
+            expected = self.brute_force(tmax[reach], doy_list, thresholds, 7, tmean[reach])
+            np.testing.assert_allclose(metrics[reach], expected, rtol=1e-10)
+
+
+class SpatialFillTest(unittest.TestCase):
+
+    def brute_force(self, xy_array, lst_cube, k, power, max_distance):
+        filled = lst_cube.astype(np.float64)
+        for j in range(lst_cube.shape[1]):
+            valid = np.nonzero(~np.isnan(lst_cube[:, j]))[0]
+            for i in np.nonzero(np.isnan(lst_cube[:, j]))[0]:
+                distance = np.sqrt(((xy_array[valid] - xy_array[i]) ** 2).sum(axis=1))
+                nearest = [(d, v) for d, v in sorted(zip(distance, valid))[:k] if d < max_distance]
+                if nearest:
+                    weights = [1.0 / d ** power for d, v in nearest]
+                    filled[i, j] = sum(w * lst_cube[v, j] for w, (d, v) in zip(weights, nearest)) / sum(weights)
+        return filled
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(5)
+        xy_array = rng.uniform(0, 10000, (40, 2))
+        mask_list = [rng.uniform(size=40) < 0.3 for m in range(model.IDW_TREE_CACHE + 2)]
+        # masks repeat out of order, so trees are evicted from and re-used from the cache
+        date_masks = [mask_list[m] for m in rng.randint(0, len(mask_list), 30)] + [np.zeros(40, dtype=bool)]
+        lst_cube = rng.uniform(-5, 30, (40, len(date_masks))).astype(np.float32)
+        for j, mask in enumerate(date_masks):
+            lst_cube[mask, j] = np.nan
+        lst_cube[:, 0] = np.nan # no valid cells
+        for k, power, max_distance in [(8, 2.0, 3000.0), (3, 1.0, 20000.0), (1, 2.0, 500.0)]:
+            filled = model.fill_lst_spatial(xy_array, lst_cube, k, power, max_distance)
+            expected = self.brute_force(xy_array, lst_cube, k, power, max_distance)
+            np.testing.assert_allclose(filled, expected, rtol=1e-5)
+            self.assertTrue(np.isnan(filled[:, 0]).all())
+        self.assertTrue(np.isnan(model.fill_lst_spatial(xy_array, lst_cube, 1, 2.0, 500.0)).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+
+import lib.modis_grid as modis_grid
+
+
+class ModisGridTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.lat = rng.uniform(-89, 89, 500)
+        self.lon = rng.uniform(-179, 179, 500) * np.cos(np.radians(self.lat)) # inside the projected globe
+
+    def test_known_tile(self):
+        h, v, row, col = modis_grid.latlon_to_tile(44.2, -114.7)
+        self.assertEqual(modis_grid.tile_name(h, v), 'h09v04')
+        self.assertEqual(modis_grid.parse_tile('h09v04'), (9, 4))
+        x, y = modis_grid.latlon_to_sin(44.2, -114.7)
+        xmin, xmax, ymin, ymax = modis_grid.tile_bounds(9, 4)
+        self.assertTrue(xmin <= x < xmax and ymin < y <= ymax)
+        self.assertEqual(modis_grid.point_tiles([x], [y]), ['h09v04'])
+        self.assertRaises(ValueError, modis_grid.parse_tile, 'h36v04')
+
+    def test_latlon_sin_round_trip(self):
+        lat, lon = modis_grid.sin_to_latlon(*modis_grid.latlon_to_sin(self.lat, self.lon))
+        np.testing.assert_allclose(lat, self.lat, atol=1e-9)
+        np.testing.assert_allclose(lon, self.lon, atol=1e-9)
+        lat, lon = modis_grid.sin_to_latlon(modis_grid.XMIN, 0.0) # west edge at the equator
+        self.assertAlmostEqual(float(lon), -180.0)
+        lat, lon = modis_grid.sin_to_latlon(modis_grid.XMIN, modis_grid.YMAX / 2) # outside the globe
+        self.assertTrue(np.isnan(lat) and np.isnan(lon))
+
+    def test_tile_round_trip(self):
+        for tile_cells in [modis_grid.TILE_CELLS, 2400]:
+            h, v, row, col = modis_grid.latlon_to_tile(self.lat, self.lon, tile_cells)
+            self.assertTrue(((row >= 0) & (row < tile_cells) & (col >= 0) & (col < tile_cells)).all())
+            # the centre of the cell containing a point is within half a cell of it, and in the same cell
+            x, y = modis_grid.latlon_to_sin(self.lat, self.lon)
+            cx, cy = modis_grid.tile_to_sin(h, v, row, col, tile_cells)
+            half_cell = modis_grid.TILE_SIZE / tile_cells / 2
+            self.assertTrue((np.abs(cx - x) <= half_cell + 1e-6).all() and (np.abs(cy - y) <= half_cell + 1e-6).all())
+            lat, lon = modis_grid.tile_to_latlon(h, v, row, col, tile_cells)
+            h2, v2, row2, col2 = modis_grid.latlon_to_tile(lat, lon, tile_cells)
+            for a, b in [(h, h2), (v, v2), (row, row2), (col, col2)]:
+                np.testing.assert_array_equal(a, b)
+
+    def test_grid_and_cell_ids(self):
+        row, col = modis_grid.sin_to_grid(*modis_grid.latlon_to_sin(self.lat, self.lon))
+        np.testing.assert_array_equal(modis_grid.sin_to_grid(*modis_grid.grid_to_sin(row, col)), (row, col))
+        ids = modis_grid.cell_id(row, col)
+        width = modis_grid.H_TILES * modis_grid.TILE_CELLS
+        np.testing.assert_array_equal(ids // width, row)
+        np.testing.assert_array_equal(ids % width, col)
+
+    def test_bbox(self):
+        bbox = (-9000000.0, -8800000.0, 4400000.0, 4500000.0) # across the corner of h09v04
+        xmin, xmax, ymin, ymax = modis_grid.snap_bbox(*bbox, buffer_cells=2)
+        self.assertTrue(xmin <= bbox[0] - 2 * modis_grid.CELL_SIZE and xmax >= bbox[1] + 2 * modis_grid.CELL_SIZE)
+        self.assertTrue(ymin <= bbox[2] - 2 * modis_grid.CELL_SIZE and ymax >= bbox[3] + 2 * modis_grid.CELL_SIZE)
+        for edge in [(xmin - modis_grid.XMIN), (modis_grid.YMAX - ymax)]:
+            self.assertAlmostEqual(edge / modis_grid.CELL_SIZE, round(edge / modis_grid.CELL_SIZE), places=6)
+        tiles = modis_grid.bbox_tiles(*bbox)
+        self.assertEqual(sorted(modis_grid.tile_name(h, v) for h, v in tiles), ['h09v04', 'h09v05', 'h10v04', 'h10v05'])
+        self.assertEqual(modis_grid.bbox_tiles(-1e9, 1e9, -1e9, 1e9)[-1], (35, 17))
+
+    def test_pixel_centres(self):
+        x, y = modis_grid.pixel_centres((100.0, 10.0, 0.0, 500.0, 0.0, -20.0), [0, 2], [0, 1])
+        np.testing.assert_allclose(x, [105.0, 115.0])
+        np.testing.assert_allclose(y, [490.0, 450.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+import os
+import csv
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+import prep
+import process
+import climatology
+
+
+class RunModelRequestTest(unittest.TestCase):
+    """Runs process.run_model_request end to end on a temporary project, with the GDAL stages of prep
+    replaced by stubs that return known mosaics and LST values."""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        self.hdf_dir = os.path.join(self.project_dir, '2016', 'MOD11A1.006')
+        self.add_hdf_files('2016', ['001', '002', '200'])
+        self.calls = {}
+        self.saved = {}
+        self.stub(prep, 'get_rca_tiles', lambda basin: ['h09v04'])
+        self.stub(prep, 'convert_hdf', self.convert_hdf)
+        self.stub(prep, 'build_mosaic_io_array', lambda geotiff_list, hdf_dates: [[d] for d in hdf_dates])
+        self.stub(prep, 'get_modis_wkt', lambda modis_srs: 'MODIS_SIN')
+        self.stub(prep, 'get_sin_bbox', lambda basin: [0.0, 3000.0, 0.0, 1000.0])
+        self.stub(prep, 'convert_to_vrt', self.convert_to_vrt)
+        self.stub(prep, 'get_poly_wkt', lambda basin: '"+proj=longlat"')
+        self.stub(prep, 'get_bbox', lambda basin: [0.0, 3000.0, 0.0, 1000.0])
+        self.stub(prep, 'reproject_to_cube', self.reproject_to_cube)
+        self.stub(climatology, 'rca_lst', lambda id_rows, lst_cube, in_rca, id_field=None:
+                  (['1'], np.nanmean(lst_cube, axis=0)[np.newaxis, :]))
+
+    def tearDown(self):
+        for (module, name), func in self.saved.items():
+            setattr(module, name, func)
+        shutil.rmtree(self.project_dir)
+
+    def add_hdf_files(self, year, doy_list, platform_list=['MOD11A1', 'MYD11A1'], tile='h09v04'):
+        for platform in platform_list:
+            hdf_dir = os.path.join(self.project_dir, year, platform + '.006')
+            if not os.path.exists(hdf_dir):
+                os.makedirs(hdf_dir)
+            for doy in doy_list:
+                open(os.path.join(hdf_dir, '%s.A%s%s.%s.006.2016007192412.hdf' % (platform, year, doy, tile)),
+                     'wb').close()
+
+    def stub(self, module, name, func):
+        self.saved[(module, name)] = getattr(module, name)
+        setattr(module, name, func)
+
+    def convert_hdf(self, proj_dir, dir_list, hdf_filepath_list, hdf_filename_list, compact=False, with_weights=False):
+        self.calls['convert_hdf'] = sorted(self.calls.get('convert_hdf', []) + hdf_filename_list)
+        self.calls.setdefault('convert_dirs', []).append(dir_list)
+        self.calls['with_weights'] = with_weights
+        self.calls['compact'] = compact
+        return [f[:-len('.hdf')] + '.tif' for f in hdf_filepath_list], 1000.0, 1000.0
+
+    def convert_to_vrt(self, mosaic_io_array, swath_ids, input_dir, dir_list, modis_wkt, sin_bbox_list=None):
+        vrt_list = []
+        for hdf_dir in dir_list:
+            for row in mosaic_io_array:
+                vrt_file = os.path.join(hdf_dir, row[0] + '.vrt')
+                open(vrt_file, 'wb').close()
+                vrt_list.append(vrt_file)
+        return vrt_list
+
+    def reproject_to_cube(self, in_vrt_list, poly_wkt, bbox_list, xres, yres, in_ply, cube_file, band=1,
+                          compact=False):
+        self.calls.setdefault('reproject_to_cube', []).append([os.path.basename(v) for v in in_vrt_list])
+        self.calls.setdefault('cube_file', []).append(cube_file)
+        self.calls.setdefault('band', []).append(band)
+        cube = np.memmap(cube_file, dtype=np.float32, mode='w+', shape=(3, len(in_vrt_list)), order='F')
+        cube[:] = np.nan
+        if band <= 4: # LST bands of MOD and MYD
+            cube[0] = 10.0
+            cube[2] = np.arange(len(in_vrt_list), dtype=np.float32)
+        else: # QC weights, which also cover cells without LST values
+            cube[:] = 0.25
+        if compact:
+            encoded = prep.encode_lst(cube)
+            cube = np.memmap(cube_file, dtype=np.uint16, mode='w+', shape=encoded.shape, order='F')
+            cube[:] = encoded
+        xy_array = np.array([[500.0, 500.0], [1500.0, 500.0], [2500.0, 500.0]])
+        return cube, xy_array
+
+    def run_request(self, model='default', doy_end=366, year_list=[2016], qc_weights=False, basin='basin.shp',
+                    compact=False, **options):
+        progress = []
+        table_list = process.run_model_request(basin, year_list, model, lambda pct, msg: progress.append(pct),
+                                               self.project_dir, doy_end=doy_end, qc_weights=qc_weights,
+                                               compact=compact, **options)
+        return table_list, progress
+
+    def test_writes_table_to_temp_dir(self):
+        table_list, progress = self.run_request(doy_end=100)
+        lst_table = os.path.join(self.project_dir, '2temp_files', 'LST_2016_basin_Daily_001-100.csv')
+        self.assertEqual(table_list, [lst_table])
+        self.assertEqual(len(self.calls['convert_hdf']), 4) # DOY 200 is outside the request
+        self.assertEqual(self.calls['reproject_to_cube'], [['A2016001.vrt', 'A2016002.vrt']])
+        self.assertFalse(os.path.exists(self.calls['cube_file'][0]))
+        with open(lst_table, 'rb') as in_file:
+            rows = list(csv.reader(in_file))
+        self.assertEqual(rows, [['UID', 'X', 'Y', '1', '2'],
+                                ['1', '500.000000', '500.000000', '10.00', '10.00'],
+                                ['3', '2500.000000', '500.000000', '0.00', '1.00']])
+        self.assertEqual(progress, sorted(progress))
+        # part of a year does not go into the climatology
+        self.assertFalse(os.path.exists(os.path.join(self.project_dir, 'climatology')))
+
+    def test_one_table_per_year(self):
+        self.add_hdf_files('2017', ['001'])
+        table_list, progress = self.run_request(year_list=[2016, 2017])
+        self.assertEqual([os.path.basename(t) for t in table_list],
+                         ['LST_2016_basin_Daily_001-366.csv', 'LST_2017_basin_Daily_001-366.csv'])
+        self.assertEqual(self.calls['reproject_to_cube'],
+                         [['A2016001.vrt', 'A2016002.vrt', 'A2016200.vrt'], ['A2017001.vrt']])
+        # each year's granules are only written to that year's directory
+        self.assertEqual(self.calls['convert_dirs'], [[self.hdf_dir], [os.path.join(self.project_dir, '2017',
+                                                                                    'MOD11A1.006')]])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.project_dir, '2017', 'MOD11A1.006'))),
+                         ['A2017001.vrt', 'MOD11A1.A2017001.h09v04.006.2016007192412.hdf'])
+        self.assertNotEqual(self.calls['cube_file'][0], self.calls['cube_file'][1])
+        self.assertEqual(climatology.Climatology(process.climatology_dir(self.project_dir, 'basin.shp')).years,
+                         [2016, 2017])
+        with open(table_list[1], 'rb') as in_file:
+            self.assertEqual(next(csv.reader(in_file)), ['UID', 'X', 'Y', '1'])
+
+    def test_skips_compiled_years(self):
+        first_list, progress = self.run_request()
+        self.add_hdf_files('2017', ['001'])
+        self.calls = {}
+        table_list, progress = self.run_request(year_list=[2016, 2017])
+        self.assertEqual(table_list[0], first_list[0])
+        self.assertEqual(len(table_list), 2)
+        self.assertEqual(len(self.calls['convert_hdf']), 2) # only the 2017 granules
+        self.calls = {}
+        self.assertEqual(self.run_request(year_list=[2016, 2017])[0], table_list)
+        self.assertEqual(self.calls, {})
+
+    def test_climatology_per_basin(self):
+        self.run_request()
+        self.run_request(basin='other.shp')
+        clim_dirs = sorted(os.listdir(os.path.join(self.project_dir, 'climatology')))
+        self.assertEqual([d.split('_')[0] for d in clim_dirs], ['basin', 'other'])
+        for basin in ['basin.shp', 'other.shp']:
+            clim = climatology.Climatology(process.climatology_dir(self.project_dir, basin))
+            self.assertEqual(clim.years, [2016])
+            self.assertEqual(clim.ids, ['1', '3'])
+
+    def test_qc_weight_table(self):
+        table_list, progress = self.run_request(doy_end=100, qc_weights=True)
+        self.assertTrue(self.calls['with_weights'])
+        self.assertEqual(self.calls['band'], [1, 5]) # after the day and night bands of MOD and MYD
+        with open(process.weight_table(table_list[0]), 'rb') as in_file:
+            rows = list(csv.reader(in_file))
+        self.assertEqual(os.path.basename(process.weight_table(table_list[0])), 'QCW_2016_basin_Daily_001-100.csv')
+        self.assertEqual(rows, [['UID', 'X', 'Y', '1', '2'],
+                                ['1', '500.000000', '500.000000', '0.25', '0.25'],
+                                ['3', '2500.000000', '500.000000', '0.25', '0.25']])
+
+    def test_cached_weight_table(self):
+        cache = process.ResultCache(os.path.join(self.project_dir, 'cache'), memory_items=0)
+        for message in ["Done", "Done (cached)"]:
+            service = process.JobService(num_workers=1, cache=cache, project_dir=self.project_dir, qc_weights=True)
+            job_id = service.submit('basin.shp', [2016], 'default', doy_end=100)
+            self.assertEqual(list(service.progress(job_id))[-1], (100, message))
+            service.shutdown()
+            table_list = service.status(job_id)['result']
+            self.assertTrue(table_list[0].startswith(cache.cache_dir))
+            self.assertEqual(os.path.basename(table_list[0]), 'LST_2016_basin_Daily_001-100.csv')
+            with open(process.weight_table(table_list[0]), 'rb') as in_file:
+                self.assertEqual(next(csv.reader(in_file)), ['UID', 'X', 'Y', '1', '2'])
+        self.assertEqual(len(self.calls['reproject_to_cube']), 2) # the second request was not run
+
+    def test_compact_table(self):
+        table_list, progress = self.run_request(compact=True)
+        self.assertTrue(self.calls['compact'])
+        self.assertEqual(os.path.basename(table_list[0]), 'LST_2016_basin_Daily_001-366_dn.csv')
+        with open(table_list[0], 'rb') as in_file:
+            rows = list(csv.reader(in_file))
+        self.assertEqual(rows[1], ['1', '500.000000', '500.000000', '14158', '14158', '14158'])
+        id_rows, doy_list, lst_cube = prep.read_LST_table(table_list[0], compact=True)
+        np.testing.assert_allclose(lst_cube[1], [0.0, 1.0, 2.0], atol=prep.LST_SCALE)
+        clim = climatology.Climatology(process.climatology_dir(self.project_dir, 'basin.shp'))
+        self.assertAlmostEqual(clim.mean()[clim.ids.index('1'), 0], 10.0, places=1)
+        self.assertRaises(ValueError, self.run_request, compact=True, qc_weights=True)
+
+    def test_lst_band(self):
+        self.run_request(doy_end=100)
+        self.assertTrue(any(f.startswith('MYD11A1') for f in self.calls['convert_hdf']))
+        table_list, progress = self.run_request(doy_end=100, platform='MYD', lst_sds='LST_Night_1km')
+        self.assertEqual(os.path.basename(table_list[0]), 'LST_2016_basin_Daily_001-100_MYD_LST_Night_1km.csv')
+        self.assertEqual(self.calls['band'], [1, 4]) # MOD day, MOD night, MYD day, MYD night
+        self.assertRaises(ValueError, self.run_request, doy_end=100, lst_sds='LST_Day_5km')
+
+    def test_aqua_only(self):
+        shutil.rmtree(os.path.join(self.project_dir, '2016'))
+        self.add_hdf_files('2016', ['001', '002'], ['MYD11A1'])
+        table_list, progress = self.run_request()
+        self.assertEqual(self.calls['convert_hdf'], ['MYD11A1.A2016001.h09v04.006.2016007192412.hdf',
+                                                     'MYD11A1.A2016002.h09v04.006.2016007192412.hdf'])
+        self.assertEqual(self.calls['band'], [1]) # Aqua day is the first band without Terra granules
+        self.assertTrue(os.path.isdir(self.hdf_dir)) # mosaics still go to the Terra product directory
+        self.assertRaises(ValueError, self.run_request, year_list=[2016], platform='MOD', doy_end=100)
+
+    def test_other_tiles_are_skipped(self):
+        self.add_hdf_files('2016', ['001', '003'], tile='h10v04') # downloaded for another basin
+        self.run_request(doy_end=100)
+        self.assertEqual(len(self.calls['convert_hdf']), 4)
+        self.assertFalse([f for f in self.calls['convert_hdf'] if '.h10v04.' in f])
+
+    def test_no_hdf_files(self):
+        shutil.rmtree(os.path.join(self.project_dir, '2016'))
+        os.makedirs(self.hdf_dir)
+        self.assertRaises(ValueError, self.run_request)
+
+    def test_unknown_model(self):
+        self.assertRaises(ValueError, self.run_request, 'no_such_model')
+        self.run_request('lst_julian_year')
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        self.table = os.path.join(self.work_dir, 'LST_2016.csv')
+        self.write(self.table, 'first')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, path, text):
+        with open(path, 'wb') as out_file:
+            out_file.write(text)
+
+    def read(self, path):
+        with open(path, 'rb') as in_file:
+            return in_file.read()
+
+    def test_result_files_are_copied(self):
+        cache = process.ResultCache(self.cache_dir, memory_items=0)
+        cached = cache.put('key1', [self.table, 'not a file'])
+        self.assertNotEqual(cached[0], self.table)
+        self.assertEqual(cached[1], 'not a file')
+        self.write(self.table, 'second') # a later request rewrites the table
+        result = process.ResultCache(self.cache_dir).get('key1')
+        self.assertEqual(result, cached)
+        self.assertEqual(self.read(result[0]), 'first')
+        os.remove(result[0])
+        self.assertEqual(cache.get('key1'), None)
+
+    def test_key_includes_options(self):
+        cache = process.ResultCache(self.cache_dir)
+        key = cache.cache_key('basin.shp', [2016, 2017], 'default', project_dir=self.work_dir, qc_weights=False)
+        self.assertEqual(cache.cache_key('basin.shp', [2017, 2016], 'default', qc_weights=False,
+                                         project_dir=os.path.join(self.work_dir, '.')), key)
+        self.assertNotEqual(cache.cache_key('basin.shp', [2016, 2017], 'default', project_dir=self.cache_dir,
+                                            qc_weights=False), key)
+        self.assertNotEqual(cache.cache_key('basin.shp', [2016, 2017], 'default', project_dir=self.work_dir,
+                                            qc_weights=True), key)
+        self.assertNotEqual(cache.cache_key('basin.shp', [2016, 2017], 'default'), key)
+
+    def test_evict_counts_copied_files(self):
+        cache = process.ResultCache(self.cache_dir, max_bytes=1000, memory_items=0)
+        self.write(self.table, 'x' * 600)
+        cached = cache.put('key1', self.table)
+        self.write(self.table, 'y' * 600)
+        os.utime(os.path.join(self.cache_dir, 'key1.pkl'), (0, 0)) # least recently used
+        cache.put('key2', self.table)
+        self.assertFalse(os.path.exists(cached))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'key1')))
+        self.assertEqual(cache.get('key1'), None)
+        self.assertEqual(self.read(cache.get('key2')), 'y' * 600)
+
+
+class JobServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.runs = []
+
+    def runner(self, basin, year_list, model, report, doy_start=1, doy_end=366, product='Daily', **options):
+        self.runs.append((basin, year_list, model))
+        report(50, "Half way")
+        self.release.wait(10)
+        if model == 'broken':
+            raise ValueError("no HDF files")
+        return ['%s_%s.csv' % (os.path.basename(basin), y) for y in year_list]
+
+    def test_identical_requests_are_coalesced(self):
+        service = process.JobService(self.runner, num_workers=1)
+        job_id = service.submit('basin.shp', [2016, 2017], 'default')
+        self.assertEqual(service.submit('basin.shp', [2017, 2016], 'default'), job_id)
+        other_id = service.submit('basin.shp', [2016], 'default')
+        self.assertNotEqual(other_id, job_id)
+        self.release.set()
+        service.shutdown()
+        self.assertEqual(len(self.runs), 2)
+        self.assertEqual(service.status(job_id)['result'], ['basin.shp_2016.csv', 'basin.shp_2017.csv'])
+        # a finished job is not coalesced with a new request
+        self.assertNotEqual(service.submit('basin.shp', [2016, 2017], 'default'), job_id)
+
+    def test_progress(self):
+        service = process.JobService(self.runner, num_workers=1)
+        self.release.set()
+        job_id = service.submit('basin.shp', [2016], 'default')
+        self.assertEqual(list(service.progress(job_id)),
+                         [(0, "Queued"), (0, "Running"), (50, "Half way"), (100, "Done")])
+        failed_id = service.submit('basin.shp', [2016], 'broken')
+        self.assertEqual(list(service.progress(failed_id))[-1], (50, "Failed: no HDF files"))
+        self.assertEqual(service.status(failed_id)['status'], process.JOB_FAILED)
+        service.shutdown()
+
+    def test_progress_timeout(self):
+        service = process.JobService(self.runner, num_workers=1)
+        job_id = service.submit('basin.shp', [2016], 'default')
+        events = list(service.progress(job_id, timeout=0.5)) # the runner is still waiting
+        self.assertEqual(events[-1], (50, "Half way"))
+        self.assertEqual(service.status(job_id)['status'], process.JOB_RUNNING)
+        self.release.set()
+        service.shutdown()
+
+    def test_cache_is_keyed_by_options(self):
+        cache = process.ResultCache(tempfile.mkdtemp())
+        try:
+            self.release.set()
+            for project_dir in ['project1', 'project2', 'project1']:
+                service = process.JobService(self.runner, num_workers=1, cache=cache, project_dir=project_dir)
+                list(service.progress(service.submit('basin.shp', [2016], 'default')))
+                service.shutdown()
+            self.assertEqual(len(self.runs), 2) # the second project1 request is cached
+        finally:
+            shutil.rmtree(cache.cache_dir)
+
+    def test_finished_jobs_are_pruned(self):
+        service = process.JobService(self.runner, num_workers=1, job_history=2)
+        self.release.set()
+        job_list = []
+        for year in [2014, 2015, 2016, 2017]:
+            job_list.append(service.submit('basin.shp', [year], 'default'))
+            list(service.progress(job_list[-1]))
+        service.shutdown()
+        self.assertEqual(sorted(service.jobs), sorted(job_list[2:]))
+        self.assertRaises(KeyError, service.status, job_list[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import project
+
+
+class ProjectDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        self.db = project.ProjectDB(self.project_dir)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.project_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.project_dir, name)
+        with open(path, 'wb') as out_file:
+            out_file.write(text)
+        return path
+
+    def test_record(self):
+        table = self.write('LST_2016.csv', 'UID,X,Y')
+        tif = self.write('MOD11A1.A2016001.h09v04.tif', 'tif')
+        self.db.record([table], 'compile_LST_table')
+        self.db.record([tif], 'convert_hdf', project.ARTIFACT_RUNNING)
+        self.assertTrue(self.db.is_done(table))
+        self.assertFalse(self.db.is_done(tif)) # not finished
+        self.assertFalse(self.db.is_done(os.path.join(self.project_dir, 'other.csv')))
+        self.assertEqual(self.db.artifacts(), [table, tif]) # sorted by path
+        self.assertEqual(self.db.artifacts('convert_hdf'), [tif])
+        self.assertEqual(self.db.artifacts(status=project.ARTIFACT_DONE), [table])
+        self.write('LST_2016.csv', 'UID,X,Y,1') # rewritten after it was recorded
+        self.assertFalse(self.db.is_done(table))
+        self.db.record([table], 'compile_LST_table')
+        self.assertTrue(self.db.is_done(table))
+        os.remove(table)
+        self.assertFalse(self.db.is_done(table))
+
+    def test_paths_are_relative(self):
+        table = self.write('LST_2016.csv', 'UID,X,Y')
+        self.db.record([table], 'compile_LST_table')
+        self.db.close()
+        moved_dir = self.project_dir + '_moved'
+        os.rename(self.project_dir, moved_dir)
+        try:
+            self.db = project.ProjectDB(moved_dir)
+            self.assertTrue(self.db.is_done(os.path.join(moved_dir, 'LST_2016.csv')))
+        finally:
+            self.db.close()
+            os.rename(moved_dir, self.project_dir)
+            self.db = project.ProjectDB(self.project_dir)
+
+    def test_remove_stage(self):
+        tif_list = [self.write('A2016001.tif', 'tif'), self.write('A2016002.tif', 'tif')]
+        table = self.write('LST_2016.csv', 'UID,X,Y')
+        self.db.record(tif_list + [os.path.join(self.project_dir, 'gone.tif')], 'convert_hdf')
+        self.db.record([table], 'compile_LST_table')
+        self.assertEqual(self.db.remove_stage('convert_hdf'), 2)
+        self.assertFalse([f for f in tif_list if os.path.exists(f)])
+        self.assertEqual(self.db.artifacts('convert_hdf'), [])
+        self.assertEqual(self.db.artifacts(), [table]) # other stages are kept
+        self.assertTrue(os.path.exists(table))
+        self.assertEqual(self.db.remove_stage('convert_hdf'), 0)
+
+    def test_missing_dirs(self):
+        dir_list = [os.path.join(self.project_dir, d) for d in ['1source_data', '2temp_files', '3model_output']]
+        os.makedirs(dir_list[0])
+        self.db.add_dirs(dir_list[:1])
+        os.makedirs(dir_list[1]) # created by hand, outside the project database
+        self.assertEqual(self.db.missing_dirs(dir_list), dir_list[2:])
+        with self.db.lock:
+            recorded = sorted(row[0] for row in self.db.conn.execute("SELECT path FROM dirs"))
+        self.assertEqual(recorded, ['1source_data', '2temp_files'])
+        shutil.rmtree(dir_list[0])
+        self.assertEqual(self.db.missing_dirs(dir_list), [dir_list[0], dir_list[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+
+import prep
+
+# MOD11A1 QC flags: bits 0-1 mandatory QA, bits 6-7 average LST error
+QA_GOOD = 0b00              # LST produced, good quality
+QA_OTHER = 0b01             # LST produced, other quality
+QA_CLOUD = 0b10             # not produced due to cloud effects
+QA_OTHER_REASONS = 0b11     # not produced for other reasons
+ERROR_1K, ERROR_2K, ERROR_3K, ERROR_OVER_3K = [e << 6 for e in range(4)]
+LST_DN = 14275              # 12.35 degrees C
+
+
+class QCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.qc_array = np.array([[QA_GOOD | ERROR_1K, QA_GOOD | ERROR_3K, QA_OTHER | ERROR_1K, QA_OTHER | ERROR_2K],
+                                  [QA_OTHER | ERROR_3K, QA_CLOUD, QA_OTHER_REASONS, QA_GOOD | ERROR_OVER_3K]])
+        self.lst_array = np.full(self.qc_array.shape, LST_DN)
+        self.lst_array[1, 3] = prep.LST_FILL # no retrieval, whatever the QC flags say
+
+    def test_mandatory_qa(self):
+        filtered = prep.qc_filter(self.lst_array, self.qc_array)
+        self.assertEqual(filtered.dtype, np.float32)
+        keep = [[True, True, False, False], [False, False, False, False]]
+        np.testing.assert_array_equal(~np.isnan(filtered), keep)
+        np.testing.assert_allclose(filtered[0, :2], [12.35, 12.35], atol=1e-4)
+
+    def test_lst_error(self):
+        # also keep "other quality" cells, but only with an average LST error of <= 2K
+        filtered = prep.qc_filter(self.lst_array, self.qc_array, qc_mask=0b10000010, qc_good=0b00000000)
+        keep = [[True, False, True, True], [False, False, False, False]]
+        np.testing.assert_array_equal(~np.isnan(filtered), keep)
+
+    def test_compact_nodata(self):
+        filtered = prep.qc_filter(self.lst_array, self.qc_array, compact=True)
+        self.assertEqual(filtered.dtype, np.uint16)
+        np.testing.assert_array_equal(filtered, [[LST_DN, LST_DN, prep.LST_NODATA, prep.LST_NODATA],
+                                                 [prep.LST_NODATA] * 4])
+        np.testing.assert_array_equal(np.isnan(prep.decode_lst(filtered)),
+                                      np.isnan(prep.qc_filter(self.lst_array, self.qc_array)))
+
+    def test_weights(self):
+        weights = prep.qc_weights(self.qc_array)
+        self.assertEqual(weights.dtype, np.float32)
+        # weighted by the LST error class, and 0 where the mandatory QA rejects the cell
+        np.testing.assert_allclose(weights, [[1.0, 1.0 / 9, 0.0, 0.0], [0.0, 0.0, 0.0, 1.0 / 16]])
+        weights = prep.qc_weights(self.qc_array, qc_mask=0b10000010, qc_good=0b00000000)
+        np.testing.assert_allclose(weights, [[1.0, 0.0, 1.0, 0.25], [0.0, 0.0, 0.0, 0.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+
+import lib.spatial_index as spatial_index
+
+
+class STRtreeTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        xy = rng.uniform(0, 1000, (700, 2))
+        size = rng.uniform(0, 30, (700, 2))
+        self.bounds = np.column_stack([xy, xy + size])
+        self.tree = spatial_index.STRtree(self.bounds)
+        self.rng = rng
+
+    def brute_force_query(self, xmin, ymin, xmax, ymax):
+        b = self.bounds
+        hit = (b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin)
+        return sorted(np.nonzero(hit)[0])
+
+    def box_distance(self, x, y):
+        b = self.bounds
+        return np.hypot(np.maximum(np.maximum(b[:, 0] - x, x - b[:, 2]), 0.0),
+                        np.maximum(np.maximum(b[:, 1] - y, y - b[:, 3]), 0.0))
+
+    def test_query(self):
+        for _ in range(200):
+            x, y = self.rng.uniform(-50, 1050, 2)
+            w, h = self.rng.uniform(0, 100, 2)
+            self.assertEqual(sorted(self.tree.query(x, y, x + w, y + h)), self.brute_force_query(x, y, x + w, y + h))
+        self.assertEqual(sorted(self.tree.query(-1e9, -1e9, 1e9, 1e9)), list(range(len(self.bounds))))
+        self.assertEqual(len(self.tree.query(2000, 2000, 3000, 3000)), 0)
+
+    def test_nearest(self):
+        for _ in range(200):
+            x, y = self.rng.uniform(-200, 1200, 2)
+            distances = self.box_distance(x, y)
+            index, distance = self.tree.nearest(x, y, lambda i: distances[i])
+            self.assertEqual(distance, distances.min())
+            self.assertEqual(distances[index], distances.min())
+        index, distance = self.tree.nearest(5000, 5000, lambda i: self.box_distance(5000, 5000)[i], max_distance=10)
+        self.assertEqual((index, distance), (None, 10))
+
+    def test_small_trees(self):
+        self.assertEqual(len(spatial_index.STRtree(np.zeros((0, 4))).query(0, 0, 1, 1)), 0)
+        self.assertEqual(spatial_index.STRtree(np.zeros((0, 4))).nearest(0, 0, lambda i: 0.0), (None, None))
+        tree = spatial_index.STRtree([[0, 0, 1, 1]])
+        self.assertEqual(list(tree.query(0.5, 0.5, 0.5, 0.5)), [0])
+        self.assertEqual(tree.nearest(3, 1, lambda i: 2.0), (0, 2.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import timeseries
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.work_dir, 'store')
+        self.year_tables = {'2016': self.write_table('2016', [['r1', '1.5', '2.5'], ['r2', '3.0', '']]),
+                            '2017': self.write_table('2017', [['r2', '5.0', '6.0'], ['r3', '7.0', '']])}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_table(self, year, rows):
+        out_csv = os.path.join(self.work_dir, 'predicted_%s.csv' % year)
+        with open(out_csv, 'wb') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['ReachID', '1', '2'])
+            writer.writerows(rows)
+        return out_csv
+
+    def build(self, year_list):
+        timeseries.build_store(self.store_dir, dict((y, self.year_tables[y]) for y in year_list))
+        # the store is re-opened when its metadata file changes, which can be within the same second
+        meta_file = os.path.join(self.store_dir, timeseries.SERIES_META)
+        os.utime(meta_file, (0, os.path.getmtime(meta_file) + len(year_list)))
+
+    def test_append_year(self):
+        self.build(['2016'])
+        store = timeseries.open_store(self.store_dir)
+        self.assertEqual(list(store.dates), [2016001, 2016002])
+        self.assertEqual(store.get('r3'), None)
+        self.build(['2016', '2017'])
+        store = timeseries.open_store(self.store_dir)
+        self.assertEqual(list(store.dates), [2016001, 2016002, 2017001, 2017002])
+        self.assertEqual(store.ids, ['r1', 'r2', 'r3'])
+        np.testing.assert_array_equal(store.get('r1'), [1.5, 2.5, np.nan, np.nan])
+        np.testing.assert_array_equal(store.get('r2'), [3.0, np.nan, 5.0, 6.0])
+        np.testing.assert_array_equal(store.get('r3'), [np.nan, np.nan, 7.0, np.nan]) # new in 2017
+
+    def test_get_many(self):
+        self.build(['2016', '2017'])
+        dates, values = timeseries.open_store(self.store_dir).get_many(['r3', 'zz', 'r1'], 2016002, 2017001)
+        self.assertEqual(list(dates), [2016002, 2017001])
+        np.testing.assert_array_equal(values, [[np.nan, 7.0], [np.nan, np.nan], [2.5, np.nan]])
+
+    def test_reach_series(self):
+        self.build(['2016', '2017'])
+        self.assertEqual(timeseries.reach_series(self.store_dir, ['r2', 'zz'], 2016002, 2017001),
+                         {'dates': [2016002, 2017001], 'series': {'r2': [None, 5.0], 'zz': [None, None]}})
+        series = timeseries.reach_series(self.store_dir, ['r1'])
+        self.assertEqual(series['series']['r1'], [1.5, 2.5, None, None])
+
+    def test_unknown_reach(self):
+        self.build(['2016'])
+        store = timeseries.open_store(self.store_dir)
+        self.assertEqual(store.get('zz'), None)
+        self.assertEqual(store.get('zz'), None) # unknown reaches are not cached
+        self.assertEqual(list(store.cache), [])
+        self.assertEqual(timeseries.reach_series(self.store_dir, ['zz'])['series'], {'zz': [None, None]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#-------------------------------------------------------------------------------
+# Name:         timeseries.py
+#
+# Summary:      The timeseries module stores predicted stream temperatures reach by reach, so
+#               the webSTeAMM charts can fetch the full multi-year series of one reach without
+#               scanning the prediction tables or a layer with one field per day. The series
+#               are held in a single binary file with one row per reach and one column per
+#               date, so a reach's series is one contiguous read, and an ID index maps reach
+#               IDs to rows. Recently requested reaches are also kept in memory.
+#
+# Project:      Stream Temperature Automated Modeler using MODIS (STeAMM)
+#
+# Author:       Jesse Langdon
+#
+# Last Updated: 10/04/2017
+# Copyright:    (c) South Fork Research, Inc. 2017
+# Licence:      FreeBSD License
+# Version:      0.1
+#-------------------------------------------------------------------------------
+
+# Import modules
+import os
+import csv
+import json
+import threading
+import collections
+import numpy as np
+
+# Global constants
+SERIES_FILE = 'series.dat'
+SERIES_META = 'series.json'
+SERIES_IDS = 'series_ids.npy'
+SERIES_DATES = 'series_dates.npy'
+SERIES_CACHE_ITEMS = 256 # reach series kept in memory
+
+_store_cache = {}
+_store_lock = threading.Lock()
+
+
+def _replace(tmp_file, out_file):
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    os.rename(tmp_file, out_file)
+    return
+
+
+def build_store(store_dir, year_tables):
+    """Builds the time-series store from the prediction tables of one or more years. year_tables is a
+    dictionary of {year: prediction table}, where a table has the reach ID in the first column and one
+    column per DOY. Dates are stored as YYYYDDD integers. The tables are read one row at a time and
+    written straight into their block of the store."""
+    print "Building the reach time-series store..."
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    # first pass: reach IDs and dates of every table
+    id_list = []
+    row_index = {}
+    year_cols = []
+    date_list = []
+    for year in sorted(year_tables):
+        with open(year_tables[year], 'rb') as in_file:
+            reader = csv.reader(in_file)
+            doy_list = [int(float(d)) for d in next(reader)[1:]]
+            for row in reader:
+                if row[0] not in row_index:
+                    row_index[row[0]] = len(id_list)
+                    id_list.append(row[0])
+        year_cols.append((year, len(date_list)))
+        date_list += [int(year) * 1000 + d for d in doy_list]
+
+    # second pass: values, written reach-major into the series file
+    tmp_file = os.path.join(store_dir, SERIES_FILE + '.tmp')
+    series = np.memmap(tmp_file, dtype=np.float32, mode='w+', shape=(max(len(id_list), 1), max(len(date_list), 1)))
+    series[:] = np.nan
+    for year, first_col in year_cols:
+        with open(year_tables[year], 'rb') as in_file:
+            reader = csv.reader(in_file)
+            col_count = len(next(reader)) - 1
+            for row in reader:
+                series[row_index[row[0]], first_col:first_col + col_count] = \
+                    [float(v) if v != '' else np.nan for v in row[1:]]
+    series.flush()
+    del series
+
+    np.save(os.path.join(store_dir, SERIES_IDS + '.tmp.npy'), np.array(id_list))
+    np.save(os.path.join(store_dir, SERIES_DATES + '.tmp.npy'), np.array(date_list, dtype=np.int32))
+    with open(os.path.join(store_dir, SERIES_META + '.tmp'), 'w') as out_file:
+        json.dump({'rows': len(id_list), 'cols': len(date_list), 'dtype': 'float32'}, out_file)
+    _replace(tmp_file, os.path.join(store_dir, SERIES_FILE))
+    _replace(os.path.join(store_dir, SERIES_IDS + '.tmp.npy'), os.path.join(store_dir, SERIES_IDS))
+    _replace(os.path.join(store_dir, SERIES_DATES + '.tmp.npy'), os.path.join(store_dir, SERIES_DATES))
+    _replace(os.path.join(store_dir, SERIES_META + '.tmp'), os.path.join(store_dir, SERIES_META))
+    return os.path.join(store_dir, SERIES_FILE)
+
+
+class TimeSeriesStore(object):
+    """Read access to a time-series store. The series file is memory-mapped, so only the rows of the
+    requested reaches are read from disk, and the most recently requested series are cached."""
+
+    def __init__(self, store_dir, cache_items=SERIES_CACHE_ITEMS):
+        with open(os.path.join(store_dir, SERIES_META), 'r') as in_file:
+            meta = json.load(in_file)
+        self.ids = [str(i) for i in np.load(os.path.join(store_dir, SERIES_IDS))]
+        self.row_index = dict((reach_id, row) for row, reach_id in enumerate(self.ids))
+        self.dates = np.load(os.path.join(store_dir, SERIES_DATES))
+        self.series = None
+        if meta['rows'] and meta['cols']:
+            self.series = np.memmap(os.path.join(store_dir, SERIES_FILE), dtype=meta['dtype'], mode='r',
+                                    shape=(meta['rows'], meta['cols']))
+        self.cache_items = cache_items
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, reach_id):
+        """Returns the series of one reach (one value per date, NaN where there is no prediction), or
+        None if the reach is not in the store."""
+        reach_id = str(reach_id)
+        with self.lock:
+            if reach_id in self.cache:
+                self.cache[reach_id] = self.cache.pop(reach_id) # move to most recently used
+                return self.cache[reach_id]
+        row = self.row_index.get(reach_id)
+        if row is None:
+            return None
+        values = np.array(self.series[row]) # one contiguous read
+        with self.lock:
+            self.cache[reach_id] = values
+            while len(self.cache) > self.cache_items:
+                self.cache.popitem(last=False)
+        return values
+
+    def get_many(self, reach_id_list, first_date=None, last_date=None):
+        """Returns (dates, values) for several reaches, with one row of values per reach, optionally
+        limited to dates (YYYYDDD) from first_date to last_date. Unknown reaches have NaN values."""
+        start = 0 if first_date is None else int(np.searchsorted(self.dates, first_date, 'left'))
+        end = len(self.dates) if last_date is None else int(np.searchsorted(self.dates, last_date, 'right'))
+        values = np.empty((len(reach_id_list), end - start), dtype=np.float32)
+        values.fill(np.nan)
+        for i, reach_id in enumerate(reach_id_list):
+            series = self.get(reach_id)
+            if series is not None:
+                values[i] = series[start:end]
+        return self.dates[start:end], values
+
+
+def open_store(store_dir):
+    """Returns the shared TimeSeriesStore of a directory, opening it on first use. The store is re-opened
+    if it has been rebuilt since it was opened."""
+    key = os.path.abspath(store_dir)
+    mtime = os.path.getmtime(os.path.join(store_dir, SERIES_META))
+    with _store_lock:
+        if key not in _store_cache or _store_cache[key][0] != mtime:
+            _store_cache[key] = (mtime, TimeSeriesStore(store_dir))
+        return _store_cache[key][1]
+
+
+def reach_series(store_dir, reach_id_list, first_date=None, last_date=None):
+    """Returns the predicted series of the reaches as a dictionary for the web front end:
+    {'dates': [YYYYDDD, ...], 'series': {reach ID: [value or None, ...]}}."""
+    dates, values = open_store(store_dir).get_many(reach_id_list, first_date, last_date)
+    series = {}
+    for reach_id, row in zip(reach_id_list, values):
+        series[str(reach_id)] = [None if np.isnan(v) else round(float(v), 2) for v in row]
+    return {'dates': [int(d) for d in dates], 'series': series}